@@ -0,0 +1,120 @@
+#!/usr/bin/env python3
+
+"""
+Bandwidth budgets: a token bucket, time-of-day profiles, and a Broker
+that splits a source host's upload budget among its clients.
+
+A profile is a config value, bytes/s:
+    UPLOAD BANDWIDTH: 10m                   # always 10MB/s
+    UPLOAD BANDWIDTH: 8-18: 2m, 18-23: 20m, 0
+                            # 2MB/s 08:00-18:00, 20MB/s til 23:00,
+                            # unlimited (0) otherwise
+Hours are local; a range may wrap past midnight (22-6).
+
+    bucket = bandwidth.TokenBucket(2**20)   # 1MB/s
+    bucket.take(nbytes)                     # blocks til it's allowed
+
+Every source host runs a Broker for its "UPLOAD BANDWIDTH": clients ask
+(Servlet 'bandwidth') before they rsync and get an equal share of
+whatever the profile allows right now.  Every backup host splits its
+"DOWNLOAD BANDWIDTH" among its running transfers (see transfer.py).
+"""
+
+import time, threading
+import config, utils
+
+
+# "8-18: 2m, 0" -> ([ (8, 18, 2097152), ], 0)
+def parse_profile(string):
+    ranges = []
+    default = 0
+    for item in str(string or "0").split(","):
+        item = item.strip()
+        if not item:
+            continue
+        if ":" in item:
+            hours, rate = item.split(":", 1)
+            start, end = hours.split("-")
+            ranges.append((int(start), int(end), utils.str_to_bytes(rate.strip())))
+        else:
+            default = utils.str_to_bytes(item)
+    return ranges, default
+
+
+# bytes/s allowed at hour (0-23); 0 == unlimited
+def rate_at(profile, hour):
+    ranges, default = profile
+    for start, end, rate in ranges:
+        if start <= end and start <= hour < end:
+            return rate
+        if start > end and (hour >= start or hour < end):
+            return rate
+    return default
+
+
+def rate_now(string):
+    return rate_at(parse_profile(string), time.localtime().tm_hour)
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=None):
+        self.lock = threading.Lock()
+        self.tokens = float("inf")      # start full
+        self.stamp = time.monotonic()
+        self.set_rate(rate, burst)
+
+
+    # rate: bytes/s, 0 == unlimited; burst defaults to a second's worth
+    def set_rate(self, rate, burst=None):
+        with self.lock:
+            self.rate = rate
+            self.burst = burst or max(rate, 1)
+            self.tokens = min(self.tokens, self.burst)
+
+
+    # block til n bytes are allowed; a big n may overdraw the bucket,
+    #   and the next taker waits for it to refill
+    def take(self, n):
+        while True:
+            with self.lock:
+                if not self.rate:
+                    return
+                now = time.monotonic()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.stamp)*self.rate)
+                self.stamp = now
+                needed = min(n, self.burst)
+                if self.tokens >= needed:
+                    self.tokens -= n
+                    return
+                wait = (needed - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# a source host's upload budget, shared equally by every client that's
+#   asked within the last "BANDWIDTH LEASE"
+class Broker:
+    def __init__(self):
+        self.config = config.Config.instance()
+        self.lock = threading.Lock()
+        self.clients = {}       # { client: last asked }
+        self.bucket = TokenBucket(self.rate())
+
+
+    def rate(self):
+        return rate_now(self.config.get("global", "UPLOAD BANDWIDTH", 0))
+
+
+    # bytes/s for client, 0 == unlimited
+    def grant(self, client):
+        lease = self.config.get_duration("global", "BANDWIDTH LEASE", "5m")
+        now = time.time()
+        with self.lock:
+            self.clients[client] = now
+            for other in list(self.clients):
+                if self.clients[other] + lease < now:
+                    del self.clients[other]
+            nclients = len(self.clients)
+        rate = self.rate()
+        self.bucket.set_rate(rate)
+        return rate // nclients
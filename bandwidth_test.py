@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+
+import unittest, logging, time
+import config, bandwidth
+
+class TestMethods(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(format='%(asctime)s [%(name)s] %(message)s',
+                            level=logging.ERROR)
+
+    def tearDown(self):
+        config.Config.instance().reset()
+
+
+    def test_profile(self):
+        profile = bandwidth.parse_profile("8-18: 2m, 22-6: 50m, 1k")
+        self.assertEqual(bandwidth.rate_at(profile, 9), 2*2**20)
+        self.assertEqual(bandwidth.rate_at(profile, 18), 1024)
+        self.assertEqual(bandwidth.rate_at(profile, 23), 50*2**20)
+        self.assertEqual(bandwidth.rate_at(profile, 3), 50*2**20)
+        self.assertEqual(bandwidth.rate_at(bandwidth.parse_profile("10m"), 3),
+                            10*2**20)
+        self.assertEqual(bandwidth.rate_at(bandwidth.parse_profile(None), 3),
+                            0)
+
+
+    def test_token_bucket(self):
+        bucket = bandwidth.TokenBucket(100000)      # 100KB/s
+        start = time.monotonic()
+        bucket.take(100000)     # the first second's free
+        for i in range(4):
+            bucket.take(5000)
+        self.assertGreater(time.monotonic() - start, 0.15)
+        bucket.set_rate(0)
+        start = time.monotonic()
+        bucket.take(10**9)
+        self.assertLess(time.monotonic() - start, 0.1)
+
+
+    def test_broker(self):
+        cfg = config.Config.instance()
+        cfg.data = { "global": { "UPLOAD BANDWIDTH": "9m" } }
+        broker = bandwidth.Broker()
+        self.assertEqual(broker.grant("one"), 9*2**20)
+        self.assertEqual(broker.grant("two"), 9*2**20 // 2)
+        self.assertEqual(broker.grant("three"), 3*2**20)
+        cfg.data = { "global": { "UPLOAD BANDWIDTH": "9m",
+                                 "BANDWIDTH LEASE": "0" } }
+        time.sleep(0.01)
+        self.assertEqual(broker.grant("one"), 9*2**20)
+
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestMethods)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+
+"""
+A file's checksum, keyed by what the file is rather than where it is:
+(device, inode, size, mtime_ns), and by hash algorithm.  A rename or a move within the
+filesystem keeps all four, so the Scanner reuses the checksum instead of
+re-reading the file.
+
+    cache = ChecksumCache(f"{path}/.cb.{context}-checksums.json.bz2")
+    cache.clear_dirtybits()             # start of a scan
+    checksum = cache.lookup(state)      # a FileState's data, or None
+    cache.store(state)
+    cache.prune()                       # end of a scan: drop the unseen
+
+ctime is deliberately not part of the key: a rename changes it.
+"""
+
+from persistent_dict import PersistentDict
+from file_state import hash_algorithm
+
+
+class ChecksumCache(PersistentDict):
+    def key(self, data, algorithm):
+        if 'ino' not in data or 'mtime_ns' not in data:
+            return None
+        return f"{algorithm}:{data['dev']}:{data['ino']}:" \
+                f"{data['size']}:{data['mtime_ns']}"
+
+
+    # a checksum in the current "HASH" algorithm
+    def lookup(self, data):
+        key = self.key(data, hash_algorithm())
+        if key is None or key not in self:
+            return None
+        self.touch(key)
+        return self[key]
+
+
+    def store(self, data):
+        if data.get('checksum') in (None, 'deferred'):
+            return
+        key = self.key(data, data.get('algorithm', 'sha256'))
+        if key is None:
+            return
+        with self.lock:
+            self[key] = data['checksum']
+
+
+    # forget files that weren't seen since clear_dirtybits()
+    def prune(self):
+        with self.lock:
+            for key in self.clean_keys():
+                del self[key]
@@ -1,8 +1,8 @@
 #!/usr/bin/env python3
 
 import random, time
-from threading import Thread
-import config, scanner, utils, elapsed, stats
+from threading import Thread, Event
+import config, scanner, utils, elapsed, stats, transfer, tracing, profiler
 from utils import *
 from datagram import Datagram
 from persistent_dict import PersistentDict
@@ -19,7 +19,7 @@ Clientlet will:
         { filename: (source, size, nclients) }
         build the copy list into a per-source rsync task list
         execute the rsync (confirm success)
-    push a set of (renewed) claims to the source(s)
+    push new and dropped claims to the source(s), renewing a lease
         run the scanner, reconcile what-I-want vs. what-I-have
     iterate
 
@@ -42,6 +42,121 @@ class URI:
         return f"{self.source_context}:{self.filename}, {size}, {self.have}/{self.need}"
 
 
+# owned, overserved URIs, most-overserved first (the tail of a priority
+# list, reversed).  reclaim() hands them out from a cursor, so each URI
+# is looked at ~once per rebalance instead of once per underserved file
+class OverservedIndex:
+    def __init__(self, priority_list, is_owned):
+        self.is_owned = is_owned
+        self.uris = []
+        for uri in reversed(priority_list):
+            if uri.ratio <= 1.0:        # sorted list; the rest are served
+                break
+            if is_owned(uri):
+                self.uris.append(uri)
+        self.cursor = 0
+
+
+    def __len__(self):
+        return len(self.uris) - self.cursor
+
+
+    # returns (a list of URIs (ratio > ratio_target) adding up to at least
+    #   size_target bytes, bytes found), consuming them; or (None, bytes
+    #   found) if there weren't enough, consuming nothing
+    def reclaim(self, size_target, ratio_target):
+        bytes_found = 0
+        index = self.cursor
+        candidates = []
+        while index < len(self.uris) and bytes_found < size_target:
+            uri = self.uris[index]
+            if uri.ratio <= ratio_target:
+                break
+            index += 1
+            if self.is_owned(uri):
+                bytes_found += uri.size
+                candidates.append(uri)
+        if bytes_found < size_target:
+            return None, bytes_found
+        self.cursor = index
+        return candidates, bytes_found
+
+
+# what I intend to hold of one source, { filename: size }: what I have
+# (a scanner snapshot, never copied) overlaid with the pseudo-copies and
+# pseudo-drops made since.  release() when done with it
+class Backups:
+    def __init__(self, base=None):
+        self.base = base if base is not None else {}
+        self.added = {}         # { filename: size } pseudo-copied
+        self.dropped = set()    # in base, pseudo-dropped
+
+
+    def release(self):
+        if hasattr(self.base, "release"):
+            self.base.release()
+
+
+    def __contains__(self, filename):
+        if filename in self.added:
+            return True
+        return filename not in self.dropped and filename in self.base
+
+
+    def __getitem__(self, filename):
+        if filename in self.added:
+            return self.added[filename]
+        if filename in self.dropped:
+            raise KeyError(filename)
+        return self.base[filename]
+
+
+    def get(self, filename, default=None):
+        return self[filename] if filename in self else default
+
+
+    def __setitem__(self, filename, size):
+        self.dropped.discard(filename)
+        self.added[filename] = size
+
+
+    def __delitem__(self, filename):
+        if filename not in self:
+            raise KeyError(filename)
+        self.added.pop(filename, None)
+        if filename in self.base:
+            self.dropped.add(filename)
+
+
+    def __len__(self):
+        extra = sum(1 for filename in self.added if filename not in self.base)
+        return len(self.base) - len(self.dropped) + extra
+
+
+    def items(self):
+        for filename, size in self.base.items():
+            if filename not in self.dropped and filename not in self.added:
+                yield filename, size
+        yield from self.added.items()
+
+
+    def __iter__(self):
+        return (filename for filename, size in self.items())
+
+
+    def keys(self):
+        return iter(self)
+
+
+    def values(self):
+        return (size for filename, size in self.items())
+
+
+    def __repr__(self):
+        return f"Backups({len(self.base)} held, +{len(self.added)}, " \
+                f"-{len(self.dropped)})"
+
+
  #####
 #     # #      # ###### #    # ##### #      ###### #####
 #       #      # #      ##   #   #   #      #        #
@@ -77,6 +192,11 @@ class Clientlet(Thread):
         self.state_timer = elapsed.ElapsedTimer()
         self.states = {'startup': 0}
         self.efficiency = {}
+        self.transfers = transfer.TransferScheduler.instance()
+        self.wakeup = Event()
+        self.sources_changed = False
+        self.config.subscribe(self.reconfigure, ("size", "reserve", "copies",
+                                    "rescan", "source", "ignore source"))
 
 
     # todo: use a small number of types-of-filelists
@@ -86,33 +206,102 @@ class Clientlet(Thread):
         self.inventory = {}     # { source_context: source:inventory() }
                                 # { filename: (size, ncopies), }
         self.backups = {}       # local backups (intended or actual)
-                                #  { source_context: {filename: size,}, }
+                                #  { source_context: Backups, }
+        self.probable = 0       # running total of bytes in self.backups
         self.scanners = {}      # my local storage (actual)
         self.claims = {}        # { source_context: { filename : time() }, }
+                                #   what each source has as my claims
+        self.leases = {}        # { source_context: [ token, renewed time() ] }
         self.random_source_list = []   # [ list, of, sources ]
         self.datagrams = {}     # internal storage of connections
         self.metadata = {}      # internal storage of server metadata
+        self.overserved = OverservedIndex([], self.is_owned)
+                                # owned, overserved URIs; pseudo_rebalance
 
-        lazy_write = get_interval(self.config, "LAZY WRITE", (self.context,))
         source_contexts = self.config.get_contexts_for_key("source")
         self.prune_sources(source_contexts)
 
         for source_context, source in source_contexts.items():
-            self.sources[source_context] = source
-            path = f"{self.path}/{source_context}"
-            self.paths[source_context] = path
-            self.scanners[source_context] = \
-                scanner.ScannerLite(source_context, path,
-                                pd_path=self.path, loglevel=logging.INFO,
-                                name=f"{self.context}:{source_context}")
-            claims = f"{self.path}/claims-{self.context}:{source_context}.bz2"
-            self.claims[source_context] = PersistentDict(claims,
-                                                    lazy_write=lazy_write)
-            self.backups[source_context] = {}
-            self.random_source_list.append(source_context)
+            self.add_source(source_context, source)
         random.shuffle(self.random_source_list)
 
 
+    def add_source(self, source_context, source):
+        lazy_write = get_interval(self.config, "LAZY WRITE", (self.context,))
+        self.sources[source_context] = source
+        path = f"{self.path}/{source_context}"
+        self.paths[source_context] = path
+        self.scanners[source_context] = \
+            scanner.ScannerLite(source_context, path,
+                            pd_path=self.path, loglevel=logging.INFO,
+                            name=f"{self.context}:{source_context}")
+        claims = f"{self.path}/claims-{self.context}:{source_context}.bz2"
+        self.claims[source_context] = PersistentDict(claims,
+                                                lazy_write=lazy_write)
+        self.backups[source_context] = Backups()
+        self.random_source_list.append(source_context)
+
+
+    # forget a source; what I hold for it stays on disk (see prune_sources)
+    def drop_source(self, source_context):
+        if source_context in self.datagrams:
+            self.del_datagram(source_context)
+        backups = self.backups.pop(source_context, Backups())
+        self.probable -= sum(backups.values())
+        backups.release()
+        self.random_source_list.remove(source_context)
+        for state in (self.sources, self.paths, self.scanners, self.claims,
+                        self.leases, self.inventory, self.metadata):
+            state.pop(source_context, None)
+        self.overserved = OverservedIndex([], self.is_owned)
+
+
+    # sources came, went or got ignored: catch up, between crawls
+    def refresh_sources(self):
+        self.sources_changed = False
+        source_contexts = self.config.get_contexts_for_key("source")
+        self.prune_sources(source_contexts)
+        for source_context in list(self.sources):
+            if source_context not in source_contexts:
+                self.logger.info(f"dropping source {self.sources[source_context]}")
+                self.drop_source(source_context)
+        for source_context, source in source_contexts.items():
+            if source_context not in self.sources:
+                self.logger.info(f"adding source {source}")
+                self.add_source(source_context, source)
+                self.scanners[source_context].scan()
+
+
+    # Config subscriber, called on whichever thread load()ed.  Numbers
+    # change in place; sources change at the top of the next loop,
+    # which starts right away
+    def reconfigure(self, changes):
+        mine = set(changes.get(self.context, [])) | \
+                set(changes.get("global", []))
+        if mine & { "size", "reserve" }:
+            self.update_allocation()
+            self.logger.info(f"allocation now {bytes_to_str(self.allocation)}")
+        for source_context in list(self.metadata):
+            keys = set(changes.get(source_context, [])) | \
+                    set(changes.get("global", []))
+            if { "copies", "rescan" } & keys:
+                self.metadata[source_context] = {
+                    'copies': int(self.config.get(source_context, "copies")),
+                    'rescan': get_interval(self.config, 'rescan',
+                                            (source_context,)) }
+        if "ignore source" in mine or \
+                any("source" in keys for keys in changes.values()):
+            self.sources_changed = True
+            self.wakeup.set()
+
+
+    # my backup went away
+    def stop(self):
+        self.config.unsubscribe(self.reconfigure)
+        self.bailing = True
+        self.wakeup.set()
+
+
     # TODO: if I'm holding files for a pruned source, remove them
     def prune_sources(self, source_contexts):
         ignored_sources = self.config.get(self.context, "ignore source")
@@ -150,12 +339,9 @@ class Clientlet(Thread):
 
     # calculate my *probable* consumed storage 
     # (if I actually copy all the files in self.backups)
+    # (maintained as a running total by build_backups & pseudo_*_uri)
     def probable_consumption(self):
-        consumed = 0
-        for source_context in self.backups:
-            for filename in self.backups[source_context]:
-                consumed += self.backups[source_context][filename]
-        return consumed
+        return self.probable
 
 
 
@@ -179,19 +365,28 @@ class Clientlet(Thread):
         return self.allocation - self.consumption()
 
 
+    # a leased claim lasts as long as its lease
     def claim_is_valid(self, source_context, filename):
         if filename not in self.claims[source_context]:
             return False
         claim_time = self.claims[source_context][filename]
+        if source_context in self.leases:
+            claim_time = self.leases[source_context][1]
         rescan = self.metadata[source_context]['rescan']
         return claim_time + rescan >= time.time()
 
 
-    # update (or create) the claim timestamp for files in source_context
+    # update (or create) the claim timestamp for files in source_context;
+    #   forget claims on anything else
     def renew_claims(self, source_context):
         stamp = time.time()
-        for filename in self.backups[source_context]:
-            self.claims[source_context][filename] = stamp
+        claims = self.claims[source_context]
+        backups = self.backups[source_context]
+        for filename in backups:
+            claims[filename] = stamp
+        for filename in [ filename for filename in claims \
+                            if filename not in backups ]:
+            del claims[filename]
 
 
     def get_metadata(self):
@@ -220,16 +415,25 @@ class Clientlet(Thread):
                     self.inventory[source_context] = response.value()
 
 
-    # re-populates self.backups based on reality
+    # re-populates self.backups based on reality: a snapshot of each
+    #   scanner, which the pseudo-copies and -drops overlay
     def build_backups(self):
+        self.probable = 0
         for source_context in self.scanners:
-            self.backups[source_context] = \
-                self.scanners[source_context].data.copy()
-        
+            if source_context in self.backups:
+                self.backups[source_context].release()
+            scanner = self.scanners[source_context]
+            self.backups[source_context] = Backups(scanner.snapshot())
+            self.probable += scanner.consumption()
+
 
     # fake-copy one URI
     def pseudo_copy_uri(self, uri):
-        self.backups[uri.source_context][uri.filename] = uri.size
+        backups = self.backups[uri.source_context]
+        if uri.filename in backups:
+            self.probable -= backups[uri.filename]
+        backups[uri.filename] = uri.size
+        self.probable += uri.size
         uri.have += 1
         if not uri.filename in self.efficiency:
             self.efficiency[uri.filename] = 0
@@ -247,6 +451,7 @@ class Clientlet(Thread):
         self.logger.log(9, f"dropping {uri.filename}")
         self.scanners[uri.source_context].drop(uri.filename)
         if uri.filename in self.backups[uri.source_context]:
+            self.probable -= self.backups[uri.source_context][uri.filename]
             del self.backups[uri.source_context][uri.filename]
             uri.have -= 1
             assert uri.have >= 0
@@ -293,34 +498,21 @@ class Clientlet(Thread):
         return priority_list
 
 
-    # read-only scan of priority list to find size_target bytes
-    def scan_overserved(self, priority_list, size_target, ratio_target):
-        bytes_found = 0
-        index = len(priority_list) - 1
-        candidates = []
+    # find (and reserve) size_target bytes of overserved files
+    #   from self.overserved, which pseudo_rebalance builds
+    def scan_overserved(self, size_target, ratio_target):
         self.logger.debug(f"Trying to find {bytes_to_str(size_target)}")
-        while index >= 0 and bytes_found < size_target:
-            uri = priority_list[index]
-            index -= 1
-            if uri.ratio < ratio_target:   # sorted list; never drop underserved
-                break
-            if self.is_owned(uri) and uri.ratio > ratio_target:
-                self.logger.log(9, f"found candidate: {uri.filename}:{uri.ratio}, {uri.size}")
-                bytes_found += uri.size
-                candidates.append(uri)
-        if bytes_found >= size_target:
+        candidates, bytes_found = self.overserved.reclaim(size_target,
+                                                            ratio_target)
+        if candidates:
             return candidates, bytes_found
-        else:
-            found = bytes_to_str(bytes_found)
-            self.logger.debug(f"Only found {found}, it's not enough")
+        found = bytes_to_str(bytes_found)
+        self.logger.debug(f"Only found {found}, it's not enough")
         return None, 0
 
 
-
-    # potential optimization: use a running list of oversized
-    def pseudo_drop_overserved(self, priority_list, size_target, ratio_target):
-        candidates, reclaimed = self.scan_overserved(priority_list,
-                                                    size_target, ratio_target)
+    def pseudo_drop_overserved(self, size_target, ratio_target):
+        candidates, reclaimed = self.scan_overserved(size_target, ratio_target)
         if not candidates:
             self.logger.debug(f"No space to be reclaimed")
             return 0
@@ -348,12 +540,12 @@ class Clientlet(Thread):
             return
         free = self.allocation - self.probable_consumption()
         self.logger.debug(f"rebalancing; starting with {bytes_to_str(free)} to spare")
+        self.overserved = OverservedIndex(priority_list, self.is_owned)
         if free < 0:               # would happen with reserved storage
             needed = -1*free
             ratio_target = 1.0     # drop any overserved
             self.logger.warn(f"underwater, need {bytes_to_str(needed)}")
-            reclaimed = self.pseudo_drop_overserved(priority_list, needed,
-                                                    ratio_target)
+            reclaimed = self.pseudo_drop_overserved(needed, ratio_target)
             if not reclaimed:
                 self.logger.debug(":( no space reclaimed (underwater)")
                 return
@@ -377,7 +569,7 @@ class Clientlet(Thread):
                 else:
                     ratio_target = uri.ratio + 2
                 self.logger.debug(f"trying to make space for {uri.filename}:{uri.ratio}, need {bytes_to_str(space_needed)}")
-                reclaimed = self.pseudo_drop_overserved(priority_list, space_needed, ratio_target)
+                reclaimed = self.pseudo_drop_overserved(space_needed, ratio_target)
                 if not reclaimed:
                     self.logger.debug(":( no space reclaimed; giving up")
                     return
@@ -394,7 +586,8 @@ class Clientlet(Thread):
     def unclaim_all(self):
         self.logger.debug("unclaiming all")
         for source_context in self.random_source_list:
-            self.send(source_context, "unclaim all")
+            self.send(source_context, "unclaim all")    # and the lease
+        self.leases = {}
 
 
     # TODO: queue this if a source isn't available
@@ -405,76 +598,160 @@ class Clientlet(Thread):
 
 
     # this tracks local state (the claim) so we don't have to queue it
+    # one lease per source holds all my claims there: a "renew lease"
+    #   carries just the claims added and removed since, and extends the
+    #   lot; a source without my lease (new, restarted, lapsed) gets
+    #   everything, once, with a new "lease"
     def claim_everything(self):
         for source_context in self.backups:
-            claim = list(self.backups[source_context].keys())
-            if claim:
-                response = self.send(source_context, "claim", claim)
-                if response and response.value() == "ack":
-                    self.logger.debug(f"renewing claims for {source_context}")
-                    self.renew_claims(source_context)
-                else:
-                    self.logger.warn(f"send failed, not reclaiming for {source_context}")
-            
+            if source_context in self.leases \
+                    and self.renew_lease(source_context):
+                continue
+            self.take_lease(source_context)
+
+
+    def take_lease(self, source_context):
+        claim = list(self.backups[source_context].keys())
+        response = self.send(source_context, "lease", claim)
+        if response and isinstance(response.value(), str):
+            self.logger.debug(f"leased {len(claim)} claims on {source_context}")
+            self.leases[source_context] = [ response.value(), time.time() ]
+            self.renew_claims(source_context)
+        else:
+            self.logger.warn(f"send failed, not reclaiming for {source_context}")
+
+
+    # returns False if the source no longer has the lease
+    def renew_lease(self, source_context):
+        backups = self.backups[source_context]
+        claims = self.claims[source_context]
+        added = [ filename for filename in backups if filename not in claims ]
+        removed = [ filename for filename in claims if filename not in backups ]
+        token = self.leases[source_context][0]
+        response = self.send(source_context, "renew lease", token,
+                                added, removed)
+        if not response:
+            self.logger.warn(f"send failed, not renewing on {source_context}")
+            return True     # next time
+        if response.value() != "ack":
+            self.logger.info(f"lease on {source_context} lapsed")
+            del self.leases[source_context]
+            return False
+        self.logger.debug(f"renewed lease on {source_context}: " \
+                            f"+{len(added)} -{len(removed)} claims")
+        stamp = time.time()
+        for filename in added:
+            claims[filename] = stamp
+        for filename in removed:
+            del claims[filename]
+        self.leases[source_context][1] = stamp
+        return True
+
 
     # returns (nfiles, total_size) of backups[source_context]
     def sizeof(self, source_context):
         if source_context not in self.backups:
             return (0, 0)
         nfiles = total_size = 0
-        for filename in self.backups[source_context].keys():
+        for filename, size in self.backups[source_context].items():
             nfiles += 1
-            total_size += self.backups[source_context][filename]
+            total_size += size
         return (nfiles, total_size)
 
 
-    # returns the name of a file full of rsync-able sources
-    # rsync --files-from=FILE
-    def generate_rsync_list(self, source_context):
-        if source_context not in self.backups:
-            self.logger.debug(f"No files for {source_context}; not generating rsync list")
+    # { filename: weight } for the transfer scheduler's shards: files
+    # I don't have yet weigh their size, files I have are ~free to check
+    def transfer_list(self, source_context):
+        scanner = self.scanners[source_context]
+        return { filename: 1 if filename in scanner else size \
+                    for filename, size in self.backups[source_context].items() }
+
+
+    # queue a copy of everything in backups[source_context] on batch;
+    #   returns a transfer.Job, or None if there's nothing to copy
+    def rsync_from_list(self, batch, source_context):
+        files = self.transfer_list(source_context)
+        if not files:
+            self.logger.debug(f"No files for {source_context}; not rsyncing")
             return None
         (n, size) = self.sizeof(source_context)
-        size = bytes_to_str(size)
-        self.logger.debug(f"rsync {source_context}: {n} files, {size}")
-        rsync_filename = f"{self.path}/{source_context}.rsync.txt"
-        nfiles = total_size = 0
-        with open(rsync_filename, "w") as rsync_file:
-            for filename in self.backups[source_context].keys():
-                try:
-                    rsync_file.write(f"{filename}\n")
-                except UnicodeEncodeError:
-                    self.logger.exception(f"JFYI, caught this while writing {filename}")
-                    self.logger.warn(f"Skipping this file, but plz fixit")
-        return rsync_filename
-
-
-    def rsync_from_list(self, source_context, filename):
-        self.logger.debug(f"rsync {source_context}: {filename}")
-        verbose = self.config.get("global", "verbose", False)
-        dryrun = self.config.get("global", "dryrun", False)
-        timer = elapsed.ElapsedTimer()
-        (n, size) = self.sizeof(source_context)
+        self.logger.debug(f"rsync {source_context}: {n} files, {bytes_to_str(size)}")
         source = self.sources[source_context]
         src_host = config.host_for(source)
         hostname = config.host_for(self.config.get(self.context, "backup"))
-        if src_host == hostname: # a local copy, just use path
+        local = src_host == hostname
+        if local: # a local copy, just use path
             source = config.path_for(source)
         dest = f"{self.paths[source_context]}/"
-        filesfrom = f"--files-from={filename}"
-        # self.logger.debug(f"rsync --delete {source} {dest} --files-from={filename}")
         prefix = f"{self.context}:{source_context}"
-        rsync_exit = rsync(source, dest, (filesfrom, "-v", "--progress"), prefix=prefix)
-        bps = size/timer.elapsed()
-        self.logger.debug(f"rsync returned {rsync_exit}: {bytes_to_str(bps)}B/s effective")
-        return rsync_exit
-
-
+        servlet, stream, bundled = None, False, ()
+        if not local:
+            PORT = int(self.config.get("global", "PORT", "5005"))
+            servlet = { 'server': src_host, 'port': PORT,
+                        'server_context': source_context,
+                        'client_context': self.context }
+            stream = self.config.get(self.context, "TRANSFER") == "stream"
+            bundled = self.bundle_list(source_context)
+        bwlimit = 0 if local else self.bandwidth_grant(source_context)
+        return batch.add(source, dest, files, host=src_host,
+                            listdir=self.path, name=source_context,
+                            prefix=prefix, local=local, servlet=servlet,
+                            stream=stream, bundled=bundled, bwlimit=bwlimit)
+
+
+    # my share of the source host's upload budget, bytes/s; 0 == unlimited
+    def bandwidth_grant(self, source_context):
+        response = self.send(source_context, "bandwidth")
+        if response and isinstance(response.value(), int):
+            return response.value()
+        return 0
+
+
+    # new files under "BUNDLE THRESHOLD" (0, the default, is off) are
+    #   cheaper to send as a tar than one at a time
+    def bundle_list(self, source_context):
+        threshold = self.config.get(self.context, "BUNDLE THRESHOLD", "0")
+        threshold = str_to_bytes(threshold)
+        if not threshold:
+            return set()
+        scanner = self.scanners[source_context]
+        return { filename for filename, size \
+                    in self.backups[source_context].items() \
+                    if size < threshold and filename not in scanner }
+
+
+    # copy every source at once, as the scheduler allows; a failed
+    #   shard just means those files get picked up next crawl
     def rsync_everything(self):
+        timer = elapsed.ElapsedTimer()
+        batch = self.transfers.batch()
+        jobs = {}
         for source_context in self.backups:
-            rsync_list = self.generate_rsync_list(source_context)
-            if rsync_list:
-                self.rsync_from_list(source_context, rsync_list)
+            job = self.rsync_from_list(batch, source_context)
+            if job:
+                jobs[source_context] = job
+        batch.wait()
+        copied = 0
+        for source_context, job in jobs.items():
+            job.metrics.record(self.stats)
+            self.stats.histogram("rsync").merge(job.latency)
+            if job.metrics.files:
+                rate = bytes_to_str(job.metrics.rate())
+                self.logger.info(f"{source_context}: rsync'd " \
+                                 f"{len(job.metrics.files)} files, " \
+                                 f"{bytes_to_str(job.metrics.bytes)} at {rate}B/s")
+            failed = job.failed()
+            if failed:
+                self.logger.warn(f"{source_context}: {len(failed)} of " \
+                                 f"{len(job.results)} files failed to copy")
+            scanner = self.scanners[source_context]     # not rescanned yet
+            copied += sum(size for filename, size in job.files.items() \
+                            if filename not in scanner \
+                                and job.results.get(filename) == 0)
+        bps = copied/max(timer.elapsed(), 0.001)
+        self.logger.debug(f"rsync'd {bytes_to_str(copied)}: {bytes_to_str(bps)}B/s effective")
+        self.logger.debug(f"rsync latency: {self.stats.histogram('rsync')}")
+        return jobs
 
 
     # virtually "crawl" the inventories of servers, ~randomly
@@ -485,14 +762,29 @@ class Clientlet(Thread):
     #       * drop the overserved file(s)
     #       * copy the underserved file(s)
     def crawl(self):
+        with tracing.span("crawl", context=self.context):
+            self.plan()
+            self.execute()
+
+
+    # learn about sources & myself, then decide (in pseudo-state)
+    # what to copy and what to drop
+    def plan(self):
+        with tracing.span("plan"):
+            self.plan_copies()
+
+
+    def plan_copies(self):
         self.stats.reset()
         # learn about sources
         self.get_metadata()
-        self.get_inventories()
+        with tracing.span("get inventories"):
+            self.get_inventories()
 
         self.logger.debug("generating internal state")
         # learn about me: generate pseudo-state
-        self.build_backups() # copy state from disk to pseudo-state
+        with tracing.span("build backups"):
+            self.build_backups() # copy state from disk to pseudo-state
         self.logger.debug(f"built backups: {str(self.backups)[:140]}...")
         alloc = bytes_to_str(self.allocation)
         pc = bytes_to_str(self.probable_consumption())
@@ -501,8 +793,9 @@ class Clientlet(Thread):
 
         self.logger.debug("pseudo-copying")
         # priority fake-copy a much as I can
-        priority_list = self.generate_priority_list(self.inventory)
-        self.pseudo_copy(priority_list)
+        with tracing.span("pseudo copy"):
+            priority_list = self.generate_priority_list(self.inventory)
+            self.pseudo_copy(priority_list)
 
         self.logger.debug(f"actual: {self.consumption()}")
 
@@ -512,22 +805,35 @@ class Clientlet(Thread):
 
         self.logger.debug("pseudo-balancing")
         # rebalance, if needed
-        self.pseudo_rebalance(priority_list)
+        with tracing.span("pseudo rebalance"):
+            self.pseudo_rebalance(priority_list)
         pc = bytes_to_str(self.probable_consumption())
         ac = bytes_to_str(self.consumption())
         self.logger.debug(f"post pseudo-rebalance: probable: {pc}, actual: {ac} of {alloc}")
 
+
+    # make the pseudo-state real: claim, copy, rescan & re-claim
+    def execute(self):
+        with tracing.span("execute"):
+            self.execute_copies()
+
+
+    def execute_copies(self):
+        alloc = bytes_to_str(self.allocation)
         self.logger.debug("executing copies & claims")
         self.restate("copying & claiming")
         # execute the copies: 
-        self.claim_everything()             # claim everything
-        self.rsync_everything()             # copy everything
+        with tracing.span("claim"):
+            self.claim_everything()         # claim everything
+        with tracing.span("rsync"):
+            self.rsync_everything()         # copy everything
         # self.logger.warn("CHECK IT NOW\n" * 10)
         # time.sleep(9999)
         self.run_all_scanners_once()        # scan everything
         self.build_backups() # re-copy state from disk to pseudo-state
         self.logger.debug(f"re-built backups: {str(self.backups)[:140]}...")
-        self.claim_everything()             # re-claim everything
+        with tracing.span("reclaim"):
+            self.claim_everything()         # re-claim everything
         pc = bytes_to_str(self.probable_consumption())
         ac = bytes_to_str(self.consumption())
         self.logger.debug(f"post copy: probable: {pc}, actual: {ac} of {alloc}")
@@ -587,15 +893,23 @@ class Clientlet(Thread):
         commandlist = [ command, source_context, self.context ]
         for arg in args:
             commandlist.append(arg)
-        datagram.set(commandlist)
-
-        if datagram.send():
-            datagram.receive()
-        else:
-            self.logger.info("send() failed")
+        with tracing.span(f"send {command}", source=source_context):
+            trailer = tracing.header()
+            if trailer:
+                commandlist.append(trailer)
+            datagram.set(commandlist)
+            self.timed_send(datagram, command)
         return datagram
 
 
+    def timed_send(self, datagram, command):
+        with self.stats.histogram(f"send {command}").timer():
+            if datagram.send():
+                datagram.receive()
+            else:
+                self.logger.info("send() failed")
+
+
     def audit(self):
         self.update_allocation()
         nfiles = 0
@@ -609,6 +923,9 @@ class Clientlet(Thread):
             self.logger.info(f"copy in progress: {consumed} of {probable} so far")
         for stat in self.stats:
             self.logger.debug(f"{stat}/s: {self.stats[stat].qps()}")
+        for name, histogram in list(self.stats.histograms.items()):
+            if histogram.count:
+                self.logger.info(f"{name} latency: {histogram}")
         self.show_states()
         self.logger.debug(f"Efficiency: {self.compute_efficiency()}")
 
@@ -666,7 +983,8 @@ class Clientlet(Thread):
     def run_all_scanners_once(self):
         self.restate("scanning")
         for source_context in self.scanners:
-            self.scanners[source_context].scan()
+            with tracing.span("scan", source=source_context):
+                self.scanners[source_context].scan()
             nfiles = len(self.scanners[source_context])
             self.logger.debug(f"scan complete, {nfiles} files")
     
@@ -679,6 +997,8 @@ class Clientlet(Thread):
         self.claim_everything()
         while not self.bailing:
             timer = elapsed.ElapsedTimer()
+            if self.sources_changed:
+                self.refresh_sources()
             self.update_allocation()
             self.run_all_scanners_once()
             self.crawl()
@@ -691,7 +1011,10 @@ class Clientlet(Thread):
             sleep_time = max(rescan - timer.elapsed(), 10)
             sleep_msg = duration_to_str(sleep_time)
             self.logger.info(f"sleeping {sleep_msg} til next rescan")
-            time.sleep(sleep_time)
+            self.wakeup.wait(sleep_time)
+            self.wakeup.clear()
+        self.unclaim_all()      # let the other backups take over
+        self.logger.info("Stopped")
 
 
 
@@ -719,7 +1042,9 @@ class Client(Thread):
         self.backup_contexts = \
             self.config.get_contexts_for_key_and_target("backup", hostname)
         self.clientlets = {}
+        self.running = False
         self.build_clientlets()
+        self.config.subscribe(self.reconfigure, ("backup", ))
 
 
     def build_clientlets(self):
@@ -727,14 +1052,32 @@ class Client(Thread):
             self.clientlets[context] = Clientlet(context)
 
 
+    # Config subscriber: backups came or went; spin clientlets up or down
+    def reconfigure(self, changes):
+        self.backup_contexts = \
+            self.config.get_contexts_for_key_and_target("backup", self.hostname)
+        for context in self.backup_contexts:
+            if context not in self.clientlets:
+                self.logger.info(f"new backup {self.backup_contexts[context]}")
+                self.clientlets[context] = Clientlet(context)
+                if self.running:
+                    self.clientlets[context].start()
+        for context in list(self.clientlets):
+            if context not in self.backup_contexts:
+                self.logger.info(f"backup {context} is gone")
+                self.clientlets.pop(context).stop()
+
+
     def run(self):
         self.logger.info("Client running...")
-        for context, clientlet in self.clientlets.items():
+        for context, clientlet in list(self.clientlets.items()):
             clientlet.start()
             time.sleep(15) # stagger multi-client startups
+        self.running = True
         self.logger.info("Clientlets started")
         while True:
-            for context, clientlet in self.clientlets.items():
+            self.config.load()      # subscribers do the rest
+            for context, clientlet in list(self.clientlets.items()):
                 clientlet.audit()
             time.sleep(60)
 
@@ -788,6 +1131,8 @@ def main(args):
     assert type(options["hostname"]) is str
 
     cfg.init(options['configfile'], "source", "backup")
+    tracing.configure()
+    profiler.install("client")
 
     c = Client(options['hostname'])
     c.start()
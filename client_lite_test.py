@@ -1,7 +1,7 @@
 #!/usr/bin/env python3
 
-import unittest, logging
-import client_lite, config
+import unittest, logging, tempfile
+import client_lite, config, persistent_dict
 
 class TestMethods(unittest.TestCase):
 
@@ -50,6 +50,58 @@ class TestMethods(unittest.TestCase):
         self.assertEquals(len(pl), 10)
 
 
+# no config needed: just URIs
+class TestOverservedIndex(unittest.TestCase):
+
+    def test_overserved_index(self):
+        uris = [ client_lite.URI("s", f"f{i}", 100, have, 2) \
+                    for i, have in enumerate((0, 1, 2, 3, 3, 4, 5)) ]
+        owned = { "f1", "f3", "f4", "f6" }
+        index = client_lite.OverservedIndex(uris, lambda uri: uri.filename in owned)
+        # only owned, overserved, most-overserved first
+        self.assertEqual([ uri.filename for uri in index.uris ], 
+                            [ "f6", "f4", "f3" ])
+        # not enough over ratio 2.0: nothing consumed
+        self.assertEqual(index.reclaim(200, 2.0), (None, 100))
+        self.assertEqual(len(index), 3)
+        reclaimed, found = index.reclaim(150, 1.0)
+        self.assertEqual([ uri.filename for uri in reclaimed ], [ "f6", "f4" ])
+        self.assertEqual(found, 200)
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.reclaim(200, 1.0), (None, 100))
+        self.assertEqual(index.reclaim(100, 1.0)[0][0].filename, "f3")
+
+
+# no config needed: a PersistentDict stands in for a scanner
+class TestBackups(unittest.TestCase):
+
+    def test_overlay(self):
+        with tempfile.TemporaryDirectory() as path:
+            held = persistent_dict.PersistentDict(f"{path}/held.json")
+            for i in range(5):
+                held[f"f{i}"] = 100
+            backups = client_lite.Backups(held.snapshot())
+            backups["f9"] = 900             # pseudo-copy
+            backups["f0"] = 50              # re-copy of one I have
+            del backups["f1"]               # pseudo-drop
+            del held["f2"]                  # the base is a snapshot:
+            held["f8"] = 800                #   nothing changes under it
+            self.assertNotIn("f1", backups)
+            self.assertIn("f2", backups)
+            self.assertEqual(backups["f0"], 50)
+            self.assertEqual(len(backups), 5)
+            self.assertEqual(sorted(backups), [ "f0", "f2", "f3", "f4", "f9" ])
+            self.assertEqual(sum(backups.values()), 1250)
+            with self.assertRaises(KeyError):
+                del backups["f1"]
+            backups["f1"] = 10              # and back again
+            self.assertEqual(backups.get("f1"), 10)
+            self.assertEqual(len(backups), 6)
+            backups.release()
+            self.assertEqual(held.readers, {})
+
+
 if __name__ == "__main__":
-    suite = unittest.TestLoader().loadTestsFromTestCase(TestMethods)
-    unittest.TextTestRunner(verbosity=2).run(suite)
+    for case in TestMethods, TestOverservedIndex, TestBackups:
+        suite = unittest.TestLoader().loadTestsFromTestCase(case)
+        unittest.TextTestRunner(verbosity=2).run(suite)
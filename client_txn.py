@@ -2,7 +2,7 @@
 
 import sys, random, time, socket, logging, os
 from threading import Thread
-import config, scanner, file_state, utils, elapsed, stats
+import config, scanner, file_state, utils, elapsed, stats, local_copy
 from utils import logger_str
 from datagram import Datagram
 from persistent_dict import PersistentDict
@@ -277,15 +277,22 @@ class Clientlet(Thread):
         source = self.config.get(source_context, "source") + "/" + filename
         src_host = config.host_for(source)
         hostname = config.host_for(self.config.get(self.context, "backup"))
-        if src_host == hostname: # a local copy, just use path
+        local = src_host == hostname
+        if local: # a local copy, just use path
             source = config.path_for(source)
         dest = f"{self.path}/{source_context}/{filename}"
 
         # 2: make the transfer
-        self.logger.debug(f"rsync {source} {dest}")
         self.makedirs(dest)
-        rsync_stat = file_state.rsync(source, dest)
-        self.logger.debug(f"rsync returned {rsync_stat}")
+        if local:
+            self.logger.debug(f"copy {source} {dest}")
+            rsync_stat = 0 if local_copy.copy_file(source, dest) else 1
+        else:
+            self.logger.debug(f"rsync {source} {dest}")
+            metrics = utils.RsyncMetrics()
+            rsync_stat = file_state.rsync(source, dest, metrics=metrics)
+            metrics.record(self.stats)
+        self.logger.debug(f"transfer returned {rsync_stat}")
 
         if rsync_stat == 0:
             # 3: record it
@@ -1,6 +1,6 @@
 #! python3.x
 
-import platform, os, re, logging, sys, json
+import platform, os, re, logging, sys, json, hashlib, time, threading
 import utils, file_state
 from singleton import Singleton
 
@@ -31,21 +31,54 @@ Note that multiple keys will stomp; the last one takes precendece
 Structure:
     self.data[context]{ key: value, key: value ... }
 
+load() only re-reads the file when its mtime *and* contents changed,
+and then builds a whole new self.data and swaps it in: a reader sees
+the old config or the new one, never half of each.  The master config
+is pulled at most once per "CONFIG PULL INTERVAL" (default 1m).
+
+Typed values are parsed once per loaded config, for hot paths:
+    cfg.get_bytes(context, "BLOCKSIZE", "1MB")      # utils.str_to_bytes
+    cfg.get_duration(context, "rescan", "1h")       # utils.str_to_duration
+    cfg.get_int(context, "copies", 2)
+
+Whoever cares about a key can subscribe to changes instead of
+re-reading it every loop:
+    cfg.subscribe(callback, ("copies", "rescan"), (context, "global"))
+After a load() that changed any of those keys in any of those contexts
+(contexts=None: any context), callback(changes) is called on the
+loading thread, changes = { context: [ key, ] }.  A context that came
+or went has changed every one of its keys, so a subscriber to "source"
+hears about new and removed sources.
 """
 
 
 @Singleton
 class Config:
     def __init__(self):
-        self.data = {}
         # self.config = {}
         self.logger = logging.getLogger(utils.logger_str(__class__))
         self.logger.setLevel(logging.INFO)
+        self.reset()
+
+
+    # forget everything; init() starts from here, so re-initializing
+    # with another file doesn't inherit the old file's contexts
+    def reset(self):
+        self.data = {}
         self.master = None
+        self.master_config = None
+        self.stamp = None           # (mtime_ns, size) of the file read
+        self.digest = None          # its sha256
+        self.pulled = 0
+        self.parsed = {}            # { (parser, context, key, default): value }
+        self.parsed_for = None      # ... for this self.data
+        self.lock = threading.RLock()
+        self.subscribers = []       # [ (callback, keys, contexts), ]
 
 
     def init(self, filename, *primary_keys, **kwargs):
         # print("Config initializaing (ONCE?!???!!!?)")
+        self.reset()
         self.filename = filename
         self.primary_keys = primary_keys
         if "hostname" in kwargs:
@@ -57,7 +90,6 @@ class Config:
         else:
             self.testing = False
 
-        self.master_config = None
         # prime the config (can't pull yet)
         self.read_config()
         # load for realz
@@ -72,9 +104,50 @@ class Config:
         self.data = json.loads(data)
 
 
+    # returns True if the config changed
     def load(self):
-        self.pull_master_config()
-        self.read_config()
+        with self.lock:
+            old = self.data
+            interval = self.get_duration("global", "CONFIG PULL INTERVAL", "1m")
+            if time.time() - self.pulled >= interval:
+                self.pull_master_config()
+                self.pulled = time.time()
+            changed = self.read_config()
+        if changed:
+            self.notify(diff(old, self.data))
+        return changed
+
+
+    # callback(changes) when keys change in contexts (None: any context)
+    def subscribe(self, callback, keys, contexts=None):
+        with self.lock:
+            self.subscribers.append((callback, set(keys),
+                                     None if contexts is None else set(contexts)))
+
+
+    def unsubscribe(self, callback):
+        with self.lock:
+            self.subscribers = [ subscriber for subscriber in self.subscribers \
+                                    if subscriber[0] != callback ]
+
+
+    # changes: { context: set(key, ) }
+    def notify(self, changes):
+        with self.lock:
+            subscribers = list(self.subscribers)
+        for callback, keys, contexts in subscribers:
+            relevant = {}
+            for context, changed_keys in changes.items():
+                if contexts is not None and context not in contexts:
+                    continue
+                if keys & changed_keys:
+                    relevant[context] = sorted(keys & changed_keys)
+            if not relevant:
+                continue
+            try:
+                callback(relevant)
+            except Exception:
+                self.logger.exception(f"config subscriber {callback} failed")
 
 
     # if testing, just copy the thing (rsync w/o hostnames)
@@ -99,10 +172,14 @@ class Config:
         file_state.rsync(master_config, self.filename, stfu=True)
 
 
+    # returns True if the file changed (and was re-read)
     def read_config(self):
+        if not self.file_changed():
+            return False
         self.logger.debug("Loading the config")
         primary_key = None
         context = "global"
+        data = {}
         self.logger.debug(f"hunting for {self.primary_keys}")
         try:
             with open(self.filename, "r") as file:
@@ -116,16 +193,36 @@ class Config:
                     elif tokens[0] in self.primary_keys:
                         self.logger.debug(f"got one: {tokens[0]} :: {tokens[1]}")
                         context = utils.hash(tokens[1])
-                        self.data[context] = {}
-                        self.data[context][tokens[0]] = tokens[1]
+                        data[context] = {}
+                        data[context][tokens[0]] = tokens[1]
                     elif len(tokens) == 2:
                         # not a "master" or "slave", must be a config option
-                        self.set(context, tokens[0], tokens[1])
-            self.logger.debug(self.data)
+                        set_value(data, context, tokens[0], tokens[1])
+            self.logger.debug(data)
         except BaseException:
             self.logger.exception("Fatal error reading config")
             self.logger.error(f"Confirm {self.filename} is readable")
             sys.exit(1)
+        self.data = data
+        return True
+
+
+    # mtime & size first (cheap), then the contents; a touch isn't a change
+    def file_changed(self):
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return True     # read_config will complain
+        stamp = (stat.st_mtime_ns, stat.st_size)
+        if stamp == self.stamp:
+            return False
+        self.stamp = stamp
+        with open(self.filename, "rb") as file:
+            digest = hashlib.sha256(file.read()).hexdigest()
+        if digest == self.digest:
+            return False
+        self.digest = digest
+        return True
 
 
     def DEADget_dirs(self, hostname = None):
@@ -145,22 +242,47 @@ class Config:
 
     def set(self, context, key, value):
         # print(f"setting {key} => {value}")
-        if context not in self.data:
-            self.data[context] = {}
-        if ", " in value:
-            self.data[context][key] = value.split(", ")
-        else:
-            self.data[context][key] = value
+        with self.lock:
+            set_value(self.data, context, key, value)
+            self.parsed = {}
+            self.parsed_for = None
+
+
 
-            
     def get(self, context, key, default=None):
-        if context in self.data:
-            if key in self.data[context]:
-                return self.data[context][key]
-        if "global" in self.data and key in self.data["global"]:
-            return self.data["global"][key]
-        return default
+        return get_value(self.data, context, key, default)
+
+
+
+    # get(), run through parser, remembered til the config changes;
+    #   parsed outside the lock, and only kept if nothing changed meanwhile
+    def get_parsed(self, parser, context, key, default=None):
+        index = (parser, context, key, default)
+        with self.lock:
+            data = self.data
+            if self.parsed_for is not data:
+                self.parsed = {}
+                self.parsed_for = data
+            parsed = self.parsed
+            if index in parsed:
+                return parsed[index]
+        value = parser(get_value(data, context, key, default))
+        with self.lock:
+            if self.parsed_for is data and self.parsed is parsed:
+                parsed[index] = value
+        return value
+
 
+    def get_bytes(self, context, key, default=None):
+        return self.get_parsed(utils.str_to_bytes, context, key, default)
+
+
+    def get_duration(self, context, key, default=None):
+        return self.get_parsed(utils.str_to_duration, context, key, default)
+
+
+    def get_int(self, context, key, default=None):
+        return self.get_parsed(int, context, key, default)
 
 
     def get_contexts_for_key(self, key):
@@ -194,6 +316,37 @@ class Config:
 
 
 
+# { context: set(key, ) } whose values differ between old and new
+def diff(old, new):
+    changes = {}
+    for context in set(old) | set(new):
+        before = old.get(context, {})
+        after = new.get(context, {})
+        keys = { key for key in set(before) | set(after) \
+                    if before.get(key) != after.get(key) }
+        if keys:
+            changes[context] = keys
+    return changes
+
+
+def get_value(data, context, key, default=None):
+    if context in data:
+        if key in data[context]:
+            return data[context][key]
+    if "global" in data and key in data["global"]:
+        return data["global"][key]
+    return default
+
+
+def set_value(data, context, key, value):
+    if context not in data:
+        data[context] = {}
+    if ", " in value:
+        data[context][key] = value.split(", ")
+    else:
+        data[context][key] = value
+
+
 def host_for(host_path):
     return host_path.split(":")[0]
 
@@ -262,7 +262,7 @@ class Datagram:
 
     # low(er)-level "receive"; returns a hunk of data
     def _receive(self, **kwargs):
-        BUFFER_SIZE = 1024
+        BUFFER_SIZE = 2**20
         self.logger.debug("Receiving")
         sock = self._get_connection(**kwargs)
         # data = str(sock.recv(BUFFER_SIZE), 'ascii')
@@ -270,25 +270,30 @@ class Datagram:
             return None
 
         try:
-            data = sock.recv(16)
+            data = self._receive_exactly(sock, 16)
             self.logger.debug(f"_receive: data is {data}")
             if data.decode('ascii').startswith("SIZE: "):
                 size = int(data[6:16])
-                data = data[16:]
             else:
                 self.logger.debug(f"Invalid header?  data={data}")
                 return b''
-            # sock.setblocking(False)
-            while len(data) < size:
+            # straight into one buffer: appending to bytes is quadratic
+            buffer = bytearray(size)
+            view = memoryview(buffer)
+            received = 0
+            while received < size:
                 try:
-                    buffer = sock.recv(BUFFER_SIZE)
+                    # never read past this hunk: raw data may follow
+                    n = sock.recv_into(view[received:],
+                                        min(BUFFER_SIZE, size - received))
                 except BlockingIOError:
-                    buffer = None
-                # self.logger.debug(f"got {buffer}")
-                if not buffer:
+                    n = 0
+                if not n:
                     break
-                data = data + buffer
-            # sock.setblocking(True)
+                received += n
+            view.release()
+            del buffer[received:]
+            data = bytes(buffer)
         except ConnectionResetError:
             self.logger.debug("Connection closed :(")
             self.close()
@@ -300,6 +305,80 @@ class Datagram:
         return data
 
 
+    # raw hunks, no JSON: for streams that follow a response
+    def send_raw(self, data):
+        return self._send(data)
+
+
+    def receive_raw(self):
+        return self._receive()
+
+
+    # stream length bytes of an open file, from offset, as one hunk of
+    #   raw (not JSON) data; the kernel does the copying.  returns T/F
+    #   throttle(nbytes), if given, is called before each piece is sent
+    def send_file(self, file, offset, length, throttle=None):
+        PIECE_SIZE = 2**20
+        header = f"SIZE: {length:10d}".encode('ascii')
+        sock = self._get_connection()
+        if not sock:
+            return False
+        try:
+            sock.sendall(header)
+            sent = 0
+            while sent < length:
+                piece = length - sent
+                if throttle:
+                    piece = min(piece, PIECE_SIZE)
+                    throttle(piece)
+                n = sock.sendfile(file, offset + sent, piece)
+                if not n:
+                    break
+                sent += n
+        except (socket.timeout, BrokenPipeError, ConnectionResetError):
+            self.logger.debug("send_file() failed")
+            self.close()
+            return False
+        return sent == length
+
+
+    # the other end of send_file(): writes the hunk to sink (a file)
+    #   as it arrives; returns the number of bytes written or None
+    def receive_file(self, sink):
+        BUFFER_SIZE = 2**16
+        sock = self._get_connection()
+        if not sock:
+            return None
+        try:
+            header = self._receive_exactly(sock, 16)
+            if not header or not header.startswith(b"SIZE: "):
+                self.logger.debug(f"Invalid header?  header={header}")
+                return None
+            size = int(header[6:16])
+            received = 0
+            while received < size:
+                buffer = sock.recv(min(BUFFER_SIZE, size - received))
+                if not buffer:
+                    break
+                sink.write(buffer)
+                received += len(buffer)
+        except ConnectionResetError:
+            self.logger.debug("Connection closed :(")
+            self.close()
+            return None
+        return received
+
+
+    def _receive_exactly(self, sock, size):
+        data = b''
+        while len(data) < size:
+            buffer = sock.recv(size - len(data))
+            if not buffer:
+                break
+            data += buffer
+        return data
+
+
     def close(self):
         self.logger.debug("closing connection")
         if self.connection:
@@ -308,6 +387,55 @@ class Datagram:
 
 
 
+# file-likes for streaming (eg, tarfile 'w|' & 'r|') over a datagram's
+#   connection: every write() goes out as one raw hunk, close() sends an
+#   empty hunk to mark the end; read() pulls hunks until then
+class DatagramWriter:
+    def __init__(self, datagram, throttle=None):
+        self.datagram = datagram
+        self.throttle = throttle    # called with len(data) before a write
+
+
+    def write(self, data):
+        if self.throttle:
+            self.throttle(len(data))
+        if not self.datagram.send_raw(bytes(data)):
+            raise BrokenPipeError("datagram connection lost")
+        return len(data)
+
+
+    def close(self):
+        self.datagram.send_raw(b'')
+
+
+class DatagramReader:
+    def __init__(self, datagram):
+        self.datagram = datagram
+        self.buffer = b''
+        self.done = False
+
+
+    def read(self, size=-1):
+        while not self.done and (size < 0 or len(self.buffer) < size):
+            hunk = self.datagram.receive_raw()
+            if not hunk:
+                self.done = True
+            else:
+                self.buffer += hunk
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+    # read to the end marker, so the connection can carry on
+    def drain(self):
+        while not self.done:
+            self.buffer = b''
+            self.read(2**20)
+        self.buffer = b''
+
+
 """
 # Server (threaded or non)
 ds = DatagramServer("localhost", 5000)
@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+
+"""
+Pull files straight from a Servlet over the Datagram port: no ssh, no
+rsync, nothing to configure but the PORT that's already there.
+
+    fetcher = fetch.Fetcher(server, port, server_context, client_context)
+    fetcher.fetch("a/file", "/backup/a/file")    # True/False
+    results = fetch.fetch_files(server, port, server_context,
+                                client_context, "/backup", [ "a/file", ],
+                                workers=2)      # { filename: exit code }
+
+A file is pulled in "read range" chunks into dest.partial; an interrupted
+fetch picks up where the .partial left off.  Once complete the .partial
+is checked against the servlet's checksum, gets the source's mtime, and
+is renamed into place.  A mismatch (the source changed underneath us)
+throws the .partial away.
+
+Each fetch_files() worker has its own connection.
+
+Small files cost more in round trips than in bytes, so they can come as
+bundles instead: one "bundle" request, one tar streamed back, extracted
+on the fly.
+
+    results = fetch.fetch_bundles(server, port, server_context,
+                                  client_context, "/backup", [ "a/small", ])
+
+Only regular files that were asked for are extracted; anything else in
+the tar (links, devices, ../ paths) is skipped and counted as failed.
+"""
+
+import os, logging, threading, tarfile
+from concurrent.futures import ThreadPoolExecutor
+from datagram import Datagram, DatagramReader
+import tracing, file_state
+
+CHUNK = 2**24
+BUNDLE_FILES = 1000
+
+
+class Fetcher:
+    def __init__(self, server, port, server_context, client_context,
+                    chunk=CHUNK):
+        self.server_context = server_context
+        self.client_context = client_context
+        self.chunk = chunk
+        self.logger = logging.getLogger(f"Fetcher {client_context}")
+        self.datagram = Datagram("Bogus", server=server, port=port,
+                                    name=f"Datagram {client_context}",
+                                    compress=True)
+
+
+    # [ action, server context, client context, args ] -> response or None
+    def request(self, action, *args):
+        request = [ action, self.server_context, self.client_context, *args ]
+        trailer = tracing.header()
+        if trailer:
+            request.append(trailer)
+        self.datagram.set(request)
+        if not self.datagram.send():
+            return None
+        return self.datagram.receive()
+
+
+    def fetch(self, filename, dest):
+        metadata = self.request("checksum", filename)
+        if not metadata:
+            self.logger.debug(f"{filename}: no such file")
+            return False
+        size = metadata['size']
+        partial = f"{dest}.partial"
+        os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+        with open(partial, "ab") as f:
+            offset = f.tell()
+            if offset > size:       # a stale .partial from a bigger file
+                f.truncate(0)
+                offset = 0
+            while offset < size:
+                header = self.request("read range", filename, offset,
+                                        self.chunk)
+                if not header or header[0] != offset or not header[1]:
+                    self.logger.debug(f"{filename}: bad range {header}")
+                    return False
+                received = self.datagram.receive_file(f)
+                offset += received or 0
+                if received != header[1]:
+                    self.logger.debug(f"{filename}: short read at {offset}")
+                    return False
+        algorithm = metadata.get('algorithm', 'sha256')
+        if checksum(partial, algorithm) != metadata['checksum']:
+            self.logger.info(f"{filename}: checksum mismatch; discarding")
+            os.remove(partial)
+            return False
+        os.utime(partial, (metadata['mtime'], metadata['mtime']))
+        os.replace(partial, dest)
+        return True
+
+
+    # returns { filename: exit code }
+    def fetch_bundle(self, filenames, dest_dir):
+        results = { filename: 1 for filename in filenames }
+        accepted = self.request("bundle", list(filenames))
+        if accepted is None:
+            return results
+        wanted = set(accepted) & set(filenames)
+        reader = DatagramReader(self.datagram)
+        try:
+            with tarfile.open(fileobj=reader, mode="r|", bufsize=2**20) as tar:
+                for member in tar:
+                    if member.name not in wanted or not member.isfile() \
+                            or not safe(member.name):
+                        self.logger.info(f"bundle: skipping {member.name}")
+                        continue
+                    self.extract(tar, member, f"{dest_dir}/{member.name}")
+                    results[member.name] = 0
+            reader.drain()
+        except (tarfile.TarError, OSError):
+            self.logger.exception("bundle: extraction failed")
+            self.close()
+        return results
+
+
+    def extract(self, tar, member, dest):
+        os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+        partial = f"{dest}.partial"
+        with tar.extractfile(member) as fsrc, open(partial, "wb") as fdst:
+            for block in iter(lambda: fsrc.read(2**20), b''):
+                fdst.write(block)
+        os.chmod(partial, member.mode & 0o7777)
+        os.utime(partial, (member.mtime, member.mtime))
+        os.replace(partial, dest)
+
+
+    def close(self):
+        self.datagram.close()
+
+
+# a relative path that stays put
+def safe(filename):
+    return not os.path.isabs(filename) \
+        and ".." not in filename.split("/")
+
+
+def checksum(filename, algorithm="sha256"):
+    return file_state.sum_hash(filename, algorithm)
+
+
+# fetch dest_dir/filename for each filename;
+#   returns { filename: exit code } (0 == good, like rsync)
+def fetch_files(server, port, server_context, client_context, dest_dir,
+                filenames, workers=2, chunk=CHUNK):
+    local = threading.local()
+    fetchers = []
+
+    def fetch_one(filename):
+        if not hasattr(local, "fetcher"):
+            local.fetcher = Fetcher(server, port, server_context,
+                                    client_context, chunk=chunk)
+            fetchers.append(local.fetcher)
+        try:
+            ok = local.fetcher.fetch(filename, f"{dest_dir}/{filename}")
+        except OSError:
+            logging.getLogger("fetch").exception(f"fetching {filename}")
+            ok = False
+        if not ok:      # start the next one on a fresh connection
+            local.fetcher.close()
+        return filename, 0 if ok else 1
+
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            return dict(pool.map(fetch_one, filenames))
+    finally:
+        for fetcher in fetchers:
+            fetcher.close()
+
+
+# fetch dest_dir/filename for each filename, BUNDLE_FILES at a time on
+#   one connection; returns { filename: exit code }
+def fetch_bundles(server, port, server_context, client_context, dest_dir,
+                    filenames, bundle_files=BUNDLE_FILES):
+    filenames = list(filenames)
+    fetcher = Fetcher(server, port, server_context, client_context)
+    results = {}
+    try:
+        for i in range(0, len(filenames), bundle_files):
+            bundle = filenames[i:i+bundle_files]
+            results.update(fetcher.fetch_bundle(bundle, dest_dir))
+    finally:
+        fetcher.close()
+    return results
@@ -0,0 +1,217 @@
+#!/usr/bin/env python3
+
+import unittest, logging, tempfile, threading, socket, time, os, tarfile
+import config, server_lite, fetch, file_state
+
+class TestMethods(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(format='%(asctime)s [%(name)s] %(message)s',
+                            level=logging.ERROR)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        source = f"{self.tmpdir.name}/source"
+        os.makedirs(f"{source}/a")
+        self.contents = os.urandom(100000)
+        with open(f"{source}/a/file", "wb") as f:
+            f.write(self.contents)
+        with socket.socket() as sock:
+            sock.bind(("localhost", 0))
+            self.port = sock.getsockname()[1]
+        filename = f"{self.tmpdir.name}/config.txt"
+        with open(filename, "w") as f:
+            f.write(f"PORT: {self.port}\n")
+            f.write(f"source: localhost:{source}\n")
+        cfg = config.Config.instance()
+        cfg.init(filename, "source", "backup", hostname="localhost")
+        self.server = server_lite.Server("localhost")
+        self.context, servlet = list(self.server.servlets.items())[0]
+        servlet.scanner.scan()
+        servlet.handling = True
+        threading.Thread(target=self.server.serve, daemon=True).start()
+        for i in range(100):     # wait for it to listen
+            try:
+                socket.create_connection(("localhost", self.port)).close()
+                break
+            except ConnectionRefusedError:
+                time.sleep(0.01)
+        self.dest = f"{self.tmpdir.name}/backup"
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+        for state in ("clients", "checksums"):
+            filename = f"/tmp/cb.{self.context}-{state}.json.bz2"
+            if os.path.exists(filename):
+                os.remove(filename)
+        config.Config.instance().reset()
+
+
+    def fetcher(self, chunk=fetch.CHUNK):
+        return fetch.Fetcher("localhost", self.port, self.context, "client",
+                                chunk=chunk)
+
+
+    def test_fetch(self):
+        fetcher = self.fetcher(chunk=30000)     # several ranges
+        self.assertTrue(fetcher.fetch("a/file", f"{self.dest}/a/file"))
+        fetcher.close()
+        with open(f"{self.dest}/a/file", "rb") as f:
+            self.assertEqual(f.read(), self.contents)
+        self.assertFalse(os.path.exists(f"{self.dest}/a/file.partial"))
+        self.assertEqual(int(os.path.getmtime(f"{self.dest}/a/file")),
+            int(os.path.getmtime(f"{self.tmpdir.name}/source/a/file")))
+
+
+    # the servlet hashes a file once, in the "HASH" algorithm, while its
+    #   size and mtime hold
+    def test_checksum_cache(self):
+        hashed = []
+        sum_hash = file_state.sum_hash
+        def counting_sum_hash(fname, *args, **kwargs):
+            hashed.append(fname)
+            return sum_hash(fname, *args, **kwargs)
+        file_state.sum_hash = counting_sum_hash
+        cfg = config.Config.instance()
+        cfg.data = { **cfg.data, "global": { **cfg.data.get("global", {}),
+                                             "HASH": "blake2b" } }
+        try:
+            fetcher = self.fetcher()
+            for name in "first", "second":
+                metadata = fetcher.request("checksum", "a/file")
+                self.assertEqual(metadata['algorithm'], "blake2b")
+                self.assertTrue(fetcher.fetch("a/file",
+                                                f"{self.dest}/{name}"))
+            fetcher.close()
+        finally:
+            file_state.sum_hash = sum_hash
+        source = f"{self.tmpdir.name}/source/a/file"
+        self.assertEqual(hashed.count(source), 1)
+        self.assertEqual(metadata['checksum'], sum_hash(source, "blake2b"))
+
+
+    def test_resume(self):
+        os.makedirs(f"{self.dest}/a")
+        with open(f"{self.dest}/a/file.partial", "wb") as f:
+            f.write(self.contents[:40000])
+        fetcher = self.fetcher()
+        self.assertTrue(fetcher.fetch("a/file", f"{self.dest}/a/file"))
+        fetcher.close()
+        with open(f"{self.dest}/a/file", "rb") as f:
+            self.assertEqual(f.read(), self.contents)
+
+
+    def test_bad_partial(self):
+        os.makedirs(f"{self.dest}/a")
+        with open(f"{self.dest}/a/file.partial", "wb") as f:
+            f.write(b"garbage")
+        fetcher = self.fetcher()
+        self.assertFalse(fetcher.fetch("a/file", f"{self.dest}/a/file"))
+        self.assertFalse(os.path.exists(f"{self.dest}/a/file.partial"))
+        # second time's the charm
+        self.assertTrue(fetcher.fetch("a/file", f"{self.dest}/a/file"))
+        fetcher.close()
+
+
+    def test_fetch_files(self):
+        results = fetch.fetch_files("localhost", self.port, self.context,
+                                    "client", self.dest,
+                                    [ "a/file", "../config.txt" ])
+        self.assertEqual(results, { "a/file": 0, "../config.txt": 1 })
+
+
+    def test_bundle(self):
+        fetcher = self.fetcher()
+        results = fetcher.fetch_bundle([ "a/file", "a/missing" ], self.dest)
+        self.assertEqual(results, { "a/file": 0, "a/missing": 1 })
+        with open(f"{self.dest}/a/file", "rb") as f:
+            self.assertEqual(f.read(), self.contents)
+        # the connection's still good for the next request
+        self.assertTrue(fetcher.fetch("a/file", f"{self.dest}/b/file"))
+        fetcher.close()
+        self.assertFalse(fetch.safe("../etc/passwd"))
+        self.assertFalse(fetch.safe("/etc/passwd"))
+        self.assertTrue(fetch.safe("a/file"))
+
+
+    # a file that shrinks as it's sent ends the bundle, not the server
+    def test_bundle_shrinks(self):
+        with open(f"{self.tmpdir.name}/source/a/small", "wb") as f:
+            f.write(b"small")
+        self.server.servlets[self.context].scanner.scan()
+        copyfileobj = tarfile.copyfileobj
+        def shrinking(src, dst, length=None, *args, **kwargs):
+            if length == len(self.contents):
+                raise OSError("unexpected end of data")
+            return copyfileobj(src, dst, length, *args, **kwargs)
+        tarfile.copyfileobj = shrinking
+        try:
+            fetcher = self.fetcher()
+            results = fetcher.fetch_bundle([ "a/small", "a/file" ], self.dest)
+            fetcher.close()
+        finally:
+            tarfile.copyfileobj = copyfileobj
+        self.assertEqual(results, { "a/small": 0, "a/file": 1 })
+        self.assertFalse(os.path.exists(f"{self.dest}/a/file"))
+        fetcher = self.fetcher()
+        self.assertTrue(fetcher.fetch("a/file", f"{self.dest}/a/file"))
+        fetcher.close()
+
+
+# the same servlet, in a worker process behind the Server
+class TestProcesses(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        source = f"{self.tmpdir.name}/source"
+        os.makedirs(f"{source}/a")
+        self.contents = os.urandom(100000)
+        with open(f"{source}/a/file", "wb") as f:
+            f.write(self.contents)
+        with socket.socket() as sock:
+            sock.bind(("localhost", 0))
+            self.port = sock.getsockname()[1]
+        filename = f"{self.tmpdir.name}/config.txt"
+        with open(filename, "w") as f:
+            f.write(f"PORT: {self.port}\n")
+            f.write(f"SERVLET PROCESSES: 1\n")
+            f.write(f"source: localhost:{source}\n")
+        cfg = config.Config.instance()
+        cfg.init(filename, "source", "backup", hostname="localhost")
+        self.server = server_lite.Server("localhost")
+        self.server.daemon = True
+        self.server.start()
+        self.context = list(self.server.servlets)[0]
+        self.dest = f"{self.tmpdir.name}/backup"
+
+    def tearDown(self):
+        for shard in self.server.shards:
+            shard.stop()
+        self.tmpdir.cleanup()
+        for state in ("clients", "checksums"):
+            filename = f"/tmp/cb.{self.context}-{state}.json.bz2"
+            if os.path.exists(filename):
+                os.remove(filename)
+        config.Config.instance().reset()
+
+
+    def test_fetch(self):
+        servlet = self.server.servlets[self.context]
+        self.assertIsInstance(servlet, server_lite.RemoteServlet)
+        for i in range(300):     # wait for the worker's pre-scan
+            if servlet.handle('list', [ "client" ]):
+                break
+            time.sleep(0.1)
+        self.assertEqual(servlet.handle('list', [ "client" ]),
+                         { "a/file": [ 100000, 0 ] })
+        fetcher = fetch.Fetcher("localhost", self.port, self.context, "client",
+                                chunk=30000)
+        self.assertTrue(fetcher.fetch("a/file", f"{self.dest}/a/file"))
+        results = fetcher.fetch_bundle([ "a/file" ], f"{self.dest}/bundled")
+        fetcher.close()
+        self.assertEqual(results, { "a/file": 0 })
+        with open(f"{self.dest}/a/file", "rb") as f:
+            self.assertEqual(f.read(), self.contents)
+
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestMethods)
+    unittest.TextTestRunner(verbosity=2).run(suite)
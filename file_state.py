@@ -2,15 +2,21 @@
 
 import logging, os, json, time, hashlib, random, subprocess, re
 import config
-from utils import logger_str, str_to_bytes
+from utils import logger_str, ssh_transport, run_rsync, \
+                    RSYNC_OUT_FORMAT
 
 
 # { 'name' : filename, 
 #   'size': int, 
-#   'checksum' : sha256, 
+#   'checksum' : hex digest, 
+#   'algorithm' : "sha256", etc,
 #   'checksum_time' : time_t,
 #   'ctime' : time_t,
-#   'mtime' : time_t }
+#   'mtime' : time_t,
+#   'ctime_ns' : int,
+#   'mtime_ns' : int,
+#   'dev' : int,
+#   'ino' : int }
 class FileState:
     def __init__(self, filename, genChecksums = True, **kwargs):
         self.data = {'filename' : filename}
@@ -18,6 +24,8 @@ class FileState:
             self.prefix = kwargs["prefix"]
         else:
             self.prefix = None
+        # a bandwidth.TokenBucket shared by checksummers, or None
+        self.limiter = kwargs.get("limiter")
         self.logger = logging.getLogger(logger_str(__class__) + " " + \
                                 os.path.basename(filename))
         self.update(genChecksums)
@@ -25,17 +33,22 @@ class FileState:
 
     def update(self, genChecksums = True):
         cfg = config.Config.instance()
-        BLOCKSIZE = str_to_bytes(cfg.get("global", "BLOCKSIZE", "1MB"))
-        NBLOCKS = int(cfg.get("global", "NBLOCKS", 0))
-        IO_RATELIMIT = str_to_bytes(cfg.get("global", "IO_RATELIMIT", "0"))
+        BLOCKSIZE = cfg.get_bytes("global", "BLOCKSIZE", "1MB")
+        NBLOCKS = cfg.get_int("global", "NBLOCKS", 0)
+        IO_RATELIMIT = cfg.get_bytes("global", "IO_RATELIMIT", "0")
+        HASH = hash_algorithm()
         if self.prefix is not None:
             filename = f"{self.prefix}/{self.data['filename']}"
         else:
             filename = self.data['filename']
         
         if genChecksums:
+            if self.limiter is not None:    # the bucket does the limiting
+                IO_RATELIMIT = 0
             self.data['checksum'] = \
-                sum_sha256(filename, BLOCKSIZE, NBLOCKS, IO_RATELIMIT)
+                sum_hash(filename, HASH, BLOCKSIZE, NBLOCKS, IO_RATELIMIT,
+                            limiter=self.limiter)
+            self.data['algorithm'] = HASH
         else:
             self.data['checksum'] = 'deferred'
         self.data['checksum_time'] = time.time()
@@ -43,6 +56,10 @@ class FileState:
         self.data['size'] = filestat.st_size
         self.data['ctime'] = filestat.st_ctime
         self.data['mtime'] = filestat.st_mtime
+        self.data['ctime_ns'] = filestat.st_ctime_ns
+        self.data['mtime_ns'] = filestat.st_mtime_ns
+        self.data['dev'] = filestat.st_dev
+        self.data['ino'] = filestat.st_ino
 
 
     def from_dict(self, data):
@@ -53,7 +70,12 @@ class FileState:
         return self.data
 
 
+    # exact integer times if the old state has them (older states don't)
     def maybechanged(self, filestate_data):
+        if 'mtime_ns' in filestate_data:
+            return self.data['ctime_ns'] != filestate_data['ctime_ns'] \
+                or self.data['mtime_ns'] != filestate_data['mtime_ns'] \
+                or self.data['size'] != filestate_data['size']
         return self.data['ctime'] != filestate_data['ctime'] \
             or self.data['mtime'] != filestate_data['mtime'] \
             or self.data['size'] != filestate_data['size']
@@ -76,6 +98,9 @@ class FileState:
 # https://stackoverflow.com/questions/3431825/generating-an-md5-checksum-of-a-file
 # https://gist.github.com/aunyks/042c2798383f016939c40aa1be4f4aaf
 #
+# algorithm: one of HASH_ALGORITHMS ("HASH" in the config); md5 is only
+#  good for catching accidents, not tampering
+#
 # NBLOCKS & BLOCKSIZE > 0: sampling
 #  randomly (seeded on filesize, so consistent) sample
 #  NBLOCKS of BLOCKSIZE in the file.  This should make
@@ -84,9 +109,32 @@ class FileState:
 #
 # For tuning to an FS, set NBLOCKS to 0 (no sampling) and
 #  BLOCKSIZE to an integer multiple of the FS chunk size
-def sum_sha256(fname, BLOCKSIZE = 2**20, NBLOCKS = 0, IO_RATELIMIT = 0):
+#
+# limiter: a bandwidth.TokenBucket, taken from before each block; it
+#  can be shared by many threads, unlike IO_RATELIMIT's sleep per block
+#
+# Whole files are readinto() one reusable buffer, no per-block copies;
+#  not an mmap: a file truncated under a mapping is a SIGBUS, not an
+#  error.  Sampled files are read()
+HASH_ALGORITHMS = ("sha256", "blake2b", "blake2s", "md5")
+
+def hash_algorithm():
+    return config.Config.instance().get("global", "HASH", "sha256")
+
+
+# a FileState's data whose checksum needs (re)doing: none yet, or from
+#   some other algorithm (states from before 'algorithm' are sha256)
+def stale_checksum(data):
+    return data['checksum'] == 'deferred' \
+        or data.get('algorithm', 'sha256') != hash_algorithm()
+
+
+def sum_hash(fname, algorithm = "sha256", BLOCKSIZE = 2**20, NBLOCKS = 0,
+                IO_RATELIMIT = 0, limiter = None):
     if not os.path.isfile(fname):
         return None
+    if algorithm not in HASH_ALGORITHMS:
+        raise ValueError(f"unknown hash algorithm {algorithm}")
 
     # print(f"{NBLOCKS} blocks @ {BLOCKSIZE}, limit {IO_RATELIMIT}")
     def figure_ratelimiter(IO_RATELIMIT, BLOCKSIZE):
@@ -98,38 +146,48 @@ def sum_sha256(fname, BLOCKSIZE = 2**20, NBLOCKS = 0, IO_RATELIMIT = 0):
         # print(f"{BLOCKSIZE} / {IO_RATELIMIT} == {delay}")
         return delay
 
+    def hash_block(block):
+        if limiter: limiter.take(len(block))
+        hasher.update(block)
+        if ratelimit_time: time.sleep(ratelimit_time)
+
     ratelimit_time = figure_ratelimiter(IO_RATELIMIT, BLOCKSIZE)
-    hash_sha256 = hashlib.sha256()
+    hasher = hashlib.new(algorithm)
     filestat = os.lstat(fname)
     with open(fname, "rb") as f:
-        # for chunk in iter(lambda: f.read(BLOCKSIZE), b""):
-        #    hash_sha256.update(chunk)
         if NBLOCKS*BLOCKSIZE == 0 or filestat.st_size < NBLOCKS*BLOCKSIZE:
             # "small" files, 10MB or less
             if BLOCKSIZE == 0:
                 BLOCKSIZE = 2**20 # 1MB
-            file_buffer = f.read(BLOCKSIZE)
-            while len(file_buffer) > 0:
-                hash_sha256.update(file_buffer)
-                file_buffer = f.read(BLOCKSIZE)
-                if ratelimit_time: time.sleep(ratelimit_time)
+            with memoryview(bytearray(BLOCKSIZE)) as view:
+                while True:
+                    n = f.readinto(view)
+                    if not n:
+                        break
+                    hash_block(view[:n])
         else:
             # "large" files > 10MB; randomly sample (up to) 10 blocks
+            #   (a private Random: the global one isn't ours to seed)
+            rng = random.Random(filestat.st_size)
             file_buffer = f.read(BLOCKSIZE)
-            random.seed(filestat.st_size)
             count = 0
             step = int(filestat.st_size/NBLOCKS)
-            jump = random.randrange(step)
+            jump = rng.randrange(step)
             f.seek(jump)
             # print(f"size: {filestat.st_size} step: {step} jump: {jump}")
             while len(file_buffer) > 0: # and count < NBLOCKS:
-                # print(f"So far @ {count}:{f.tell()}: {hash_sha256.hexdigest()}")
-                hash_sha256.update(file_buffer)
+                # print(f"So far @ {count}:{f.tell()}: {hasher.hexdigest()}")
+                hash_block(file_buffer)
                 file_buffer = f.read(BLOCKSIZE)
-                if ratelimit_time: time.sleep(ratelimit_time)
                 f.seek(step, 1)
                 count += 1
-    return hash_sha256.hexdigest()
+    return hasher.hexdigest()
+
+
+def sum_sha256(fname, BLOCKSIZE = 2**20, NBLOCKS = 0, IO_RATELIMIT = 0,
+                limiter = None):
+    return sum_hash(fname, "sha256", BLOCKSIZE, NBLOCKS, IO_RATELIMIT,
+                    limiter)
 
 
 def escape_special_chars(string):
@@ -189,44 +247,26 @@ def rsync(source, dest, options = [], **kwargs):
     RSYNC_TIMEOUT = str(cfg.get("global", "RSYNC TIMEOUT", 180))
     RSYNC_BWLIMIT = str(cfg.get("global", "RSYNC BWLIMIT", 0))
     command = [ RSYNC, "-a", "--inplace", "--partial", \
-                "--timeout", RSYNC_TIMEOUT, source, dest ]
+                "--timeout", RSYNC_TIMEOUT, \
+                f"--out-format={RSYNC_OUT_FORMAT}", source, dest ]
     if len(options) > 0:
         command += options
     # if len(ignorals) > 0:
     #     command += [ f"--exclude={item}" for item in ignorals ] 
-    if True or verbose:
+    if verbose:
         command += ["-v", "--progress"]
     if RSYNC_BWLIMIT != "0":
         command += ["--bwlimit", RSYNC_BWLIMIT]
+    if looks_remote(source) or looks_remote(dest):
+        command += ssh_transport(cfg)
     logger = logging.getLogger("rsync")
     logger.debug(command)
     if dryrun:
         logger.info("> " + " ".join(command))
         return 0
     else:
-        # https://stackoverflow.com/questions/21953835/run-subprocess-and-print-output-to-logging#comment33261012_21953835
-        from subprocess import Popen, PIPE, STDOUT
-
-        if "stfu" in kwargs and kwargs["stfu"]:
-            loghole = logger.debug
-        else:
-            loghole = logger.info
-
-        command = [ s.encode() for s in command ]
-
-        process = Popen(command, stdout=PIPE, stderr=STDOUT)
-        try:
-            with process.stdout:
-                for line in iter(process.stdout.readline, b''):
-                    # b'\n'-separated lines
-                    loghole("> %s", line.decode().strip())
-                exitcode = process.wait()
-            return exitcode
-        except BaseException:
-            process.terminate()
-            logger.exception("Caught ...something")
-            sys.exit()
-        return None
+        verbose = verbose and not kwargs.get("stfu")
+        return run_rsync(command, logger, kwargs.get("metrics"), verbose)
 
 
 if __name__ == "__main__":
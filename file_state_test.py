@@ -36,6 +36,21 @@ class TestMethods(unittest.TestCase):
         self.assertFalse(file_state.looks_remote(string))
 
 
+    # a file truncated mid-hash hashes what was read; an mmap would SIGBUS
+    def test_truncated(self):
+        global tempdir
+        filename = f"{tempdir}/file_0.1k"
+        with open(filename, "wb") as f:
+            f.write(b"x" * 2**16)
+        class Truncator:
+            def take(self, n):
+                os.truncate(filename, 0)
+        checksum = file_state.sum_hash(filename, BLOCKSIZE=4096,
+                                        limiter=Truncator())
+        self.assertEqual(len(checksum), 64)
+        self.assertNotEqual(checksum, file_state.sum_hash(filename))
+
+
     def test_rsync(self):
         return
         global tempdir
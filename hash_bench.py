@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+"""
+Hash benchmark: time file_state.sum_hash over a scratch file for every
+algorithm, block size and NBLOCKS (0 == hash the whole file, via readinto;
+otherwise sample NBLOCKS blocks, via read).
+
+usage:
+    ./hash_bench.py [-s size] [-b blocksize[,blocksize...]] [-n nblocks[,nblocks...]]
+        defaults: -s 256m -b 64k,1m,8m -n 0,10
+
+The scratch file is written once, then hashed once untimed so every
+run reads from the page cache: this measures hashing, not the disk.
+"""
+
+import sys, os, time, getopt, tempfile
+import file_state, utils
+
+
+def bench(filename, algorithm, blocksize, nblocks):
+    start = time.perf_counter()
+    file_state.sum_hash(filename, algorithm, blocksize, nblocks)
+    return time.perf_counter() - start
+
+
+def main():
+    size = utils.str_to_bytes("256m")
+    blocksizes = [ utils.str_to_bytes(b) for b in ("64k", "1m", "8m") ]
+    nblockses = [ 0, 10 ]
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "s:b:n:")
+    except getopt.GetoptError as err:
+        print(err)
+        print(__doc__)
+        sys.exit(1)
+    for opt, arg in opts:
+        if opt == "-s":
+            size = utils.str_to_bytes(arg)
+        elif opt == "-b":
+            blocksizes = [ utils.str_to_bytes(b) for b in arg.split(",") ]
+        elif opt == "-n":
+            nblockses = [ int(n) for n in arg.split(",") ]
+
+    with tempfile.NamedTemporaryFile() as scratch:
+        for i in range(0, size, 2**20):
+            scratch.write(os.urandom(min(2**20, size - i)))
+        scratch.flush()
+        file_state.sum_hash(scratch.name)       # warm the page cache
+        print(f"{size // 2**20}MB file")
+        print(f"{'algorithm':>10} {'block':>8} {'nblocks':>8} {'time':>9} {'MB/s':>9}")
+        for algorithm in file_state.HASH_ALGORITHMS:
+            for blocksize in blocksizes:
+                for nblocks in nblockses:
+                    elapsed = bench(scratch.name, algorithm, blocksize, nblocks)
+                    hashed = size if not nblocks \
+                                else min(size, nblocks * blocksize)
+                    rate = hashed / max(elapsed, 1e-9) / 2**20
+                    print(f"{algorithm:>10} {blocksize // 1024:>7}k " \
+                          f"{nblocks:8d} {elapsed:8.3f}s {rate:9.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+
+"""
+In-process copies for when the source and the backup are on the same
+host; no rsync, no delta machinery, just the kernel.
+
+    import local_copy
+    local_copy.copy_file("/src/a/file", "/backup/a/file")  # True/False
+    results = local_copy.copy_files("/src", "/backup", [ "a/file", ],
+                                    workers=4)  # { filename: exit code }
+
+Per file, fastest first:
+    FICLONE reflink (btrfs, xfs, ...): shares extents, no data copied
+    os.copy_file_range: in-kernel copy
+    os.sendfile: in-kernel copy, older kernels
+    shutil.copyfileobj: anything else
+then times & permissions are copied, as rsync -a would.
+
+Like rsync's quick check, a destination with the same size and mtime
+is left alone.
+"""
+
+import os, shutil, stat, logging, errno, tempfile
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:     # not on Linux/Unix; no reflinks
+    fcntl = None
+
+FICLONE = 0x40049409    # _IOW(0x94, 9, int), linux/fs.h
+CHUNK = 2**30
+
+logger = logging.getLogger("local_copy")
+
+
+def reflink(src, dst):
+    if fcntl is None:
+        return False
+    try:
+        fcntl.ioctl(dst, FICLONE, src)
+        return True
+    except OSError:
+        return False
+
+
+def kernel_copy(src, dst, size):
+    copied = 0
+    try:
+        if hasattr(os, "copy_file_range"):
+            while copied < size:
+                n = os.copy_file_range(src, dst, min(CHUNK, size - copied))
+                if n == 0:
+                    break
+                copied += n
+            return copied == size
+    except OSError as err:
+        if err.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL,
+                                errno.EOPNOTSUPP):
+            raise
+    # copy_file_range refused (cross-device on old kernels, etc)
+    try:
+        while copied < size:
+            n = os.sendfile(dst, src, copied, min(CHUNK, size - copied))
+            if n == 0:
+                break
+            copied += n
+        return copied == size
+    except OSError as err:
+        if err.errno not in (errno.EINVAL, errno.ENOSYS):
+            raise
+    return False
+
+
+def unchanged(source_stat, dest):
+    try:
+        dest_stat = os.lstat(dest)
+    except FileNotFoundError:
+        return False
+    return dest_stat.st_size == source_stat.st_size \
+        and dest_stat.st_mtime_ns == source_stat.st_mtime_ns
+
+
+# copy one file (or symlink); returns True on success.  A file is
+#   copied to a temporary name beside dest, then renamed over it: dest
+#   is never left half-written, and a symlink at dest is replaced, not
+#   followed
+def copy_file(source, dest):
+    temp = None
+    try:
+        source_stat = os.lstat(source)
+        if unchanged(source_stat, dest):
+            return True
+        os.makedirs(os.path.dirname(dest), exist_ok=True)
+        if stat.S_ISLNK(source_stat.st_mode):
+            if os.path.lexists(dest):
+                os.remove(dest)
+            os.symlink(os.readlink(source), dest)
+            return True
+        fd, temp = tempfile.mkstemp(dir=os.path.dirname(dest),
+                                    prefix=f".{os.path.basename(dest)}.")
+        with open(source, "rb") as fsrc, open(fd, "wb") as fdst:
+            src, dst = fsrc.fileno(), fdst.fileno()
+            if not reflink(src, dst):
+                os.lseek(dst, 0, os.SEEK_SET)
+                os.ftruncate(dst, 0)
+                if not kernel_copy(src, dst, source_stat.st_size):
+                    fsrc.seek(0)
+                    fdst.seek(0)
+                    fdst.truncate()
+                    shutil.copyfileobj(fsrc, fdst)
+        shutil.copystat(source, temp)
+        os.replace(temp, dest)
+        temp = None
+        return True
+    except OSError:
+        logger.exception(f"copying {source} -> {dest}")
+        return False
+    finally:
+        if temp is not None:
+            try:
+                os.remove(temp)
+            except OSError:
+                pass
+
+
+# copy source_dir/filename -> dest_dir/filename for each filename;
+#   returns { filename: exit code } (0 == good, like rsync)
+def copy_files(source_dir, dest_dir, filenames, workers=4):
+    def copy_one(filename):
+        ok = copy_file(f"{source_dir}/{filename}", f"{dest_dir}/{filename}")
+        return filename, 0 if ok else 1
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        return dict(pool.map(copy_one, filenames))
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+import unittest, logging, tempfile, os
+import local_copy
+
+class TestMethods(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(format='%(asctime)s [%(name)s] %(message)s',
+                            level=logging.ERROR)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.source = f"{self.tmpdir.name}/source"
+        self.dest = f"{self.tmpdir.name}/dest"
+        os.makedirs(f"{self.source}/a")
+        with open(f"{self.source}/a/file", "wb") as f:
+            f.write(os.urandom(100000))
+        os.chmod(f"{self.source}/a/file", 0o640)
+        os.utime(f"{self.source}/a/file", ns=(10**18, 10**18))
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+
+    def test_copy_file(self):
+        source = f"{self.source}/a/file"
+        dest = f"{self.dest}/a/file"
+        self.assertTrue(local_copy.copy_file(source, dest))
+        with open(source, "rb") as f, open(dest, "rb") as g:
+            self.assertEqual(f.read(), g.read())
+        source_stat, dest_stat = os.stat(source), os.stat(dest)
+        self.assertEqual(source_stat.st_mtime_ns, dest_stat.st_mtime_ns)
+        self.assertEqual(source_stat.st_mode, dest_stat.st_mode)
+
+
+    # a symlink at dest is replaced, not written through
+    def test_dest_symlink(self):
+        source = f"{self.source}/a/file"
+        dest = f"{self.dest}/a/file"
+        target = f"{self.tmpdir.name}/target"
+        with open(target, "wb") as f:
+            f.write(b"leave me be")
+        os.makedirs(f"{self.dest}/a")
+        os.symlink(target, dest)
+        self.assertTrue(local_copy.copy_file(source, dest))
+        self.assertFalse(os.path.islink(dest))
+        with open(target, "rb") as f:
+            self.assertEqual(f.read(), b"leave me be")
+        self.assertEqual(os.listdir(f"{self.dest}/a"), [ "file" ])
+        # a failed copy leaves nothing behind
+        self.assertFalse(local_copy.copy_file(f"{self.source}/nope",
+                                                f"{self.dest}/a/nope"))
+        self.assertEqual(os.listdir(f"{self.dest}/a"), [ "file" ])
+
+
+    def test_unchanged(self):
+        source = f"{self.source}/a/file"
+        dest = f"{self.dest}/a/file"
+        local_copy.copy_file(source, dest)
+        # same size & mtime: left alone
+        with open(dest, "r+b") as f:
+            f.write(b"x")
+        os.utime(dest, ns=(10**18, 10**18))
+        local_copy.copy_file(source, dest)
+        with open(dest, "rb") as f:
+            self.assertEqual(f.read(1), b"x")
+
+
+    def test_copy_files(self):
+        os.symlink("file", f"{self.source}/a/link")
+        results = local_copy.copy_files(self.source, self.dest,
+                                        [ "a/file", "a/link", "a/missing" ])
+        self.assertEqual(results, { "a/file": 0, "a/link": 0, "a/missing": 1 })
+        self.assertEqual(os.readlink(f"{self.dest}/a/link"), "file")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -69,7 +69,7 @@ class Lock:
 
     def __bool__(self):
         self._update()
-        return self.depth is not 0 and len(self) >= self.depth
+        return self.depth != 0 and len(self) >= self.depth
 
 
     def __delitem__(self, key):
@@ -0,0 +1,180 @@
+#!/usr/bin/env python3
+
+"""
+Counters, gauges and histograms, kept up to date as things happen and
+rendered in the Prometheus text exposition format for server_lite's
+WebServer (GET /metrics):
+
+    registry = metrics.Registry.instance()
+    registry.counter("cb_requests_total", "requests handled",
+                        context=context, action=action).incr()
+    registry.gauge("cb_open_connections", "client connections").incr()
+    registry.histogram("cb_fetch_seconds", "time to fetch a file",
+                        context=context).observe(seconds)
+    with registry.summary("cb_handle_seconds", "time to handle a request",
+                        action=action).timer():     # a stats.Histogram
+        ...
+    registry.render()       # text/plain; version=0.0.4
+
+A summary is rendered as its p50, p90 and p99 (quantile="0.5", ...).
+
+Recording is a lock and an add.  Rendering only reads what's been
+recorded: nothing is counted or scanned at scrape time.
+"""
+
+import threading
+from singleton import Singleton
+import stats
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+
+class Counter:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+
+    def incr(self, value=1):
+        with self.lock:
+            self.value += value
+
+
+    def samples(self, name, labels):
+        return [ (name, labels, self.value) ]
+
+
+class Gauge(Counter):
+    def decr(self, value=1):
+        self.incr(-value)
+
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+
+# cumulative buckets, as Prometheus wants them
+class Histogram:
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.lock = threading.Lock()
+        self.bounds = tuple(buckets)
+        self.counts = [ 0 ] * (len(self.bounds) + 1)    # the last is +Inf
+        self.sum = 0
+
+
+    def observe(self, value):
+        i = 0
+        while i < len(self.bounds) and value > self.bounds[i]:
+            i += 1
+        with self.lock:
+            self.counts[i] += 1
+            self.sum += value
+
+
+    def samples(self, name, labels):
+        with self.lock:
+            counts = list(self.counts)
+            total = self.sum
+        samples = []
+        cumulative = 0
+        for bound, count in zip(self.bounds + ("+Inf", ), counts):
+            cumulative += count
+            samples.append((f"{name}_bucket", labels + (("le", str(bound)), ),
+                            cumulative))
+        samples.append((f"{name}_sum", labels, total))
+        samples.append((f"{name}_count", labels, cumulative))
+        return samples
+
+
+# a stats.Histogram, as Prometheus quantiles
+class Summary(stats.Histogram):
+    QUANTILES = (50, 90, 99)
+
+    def samples(self, name, labels):
+        samples = [ (name, labels + (("quantile", str(p / 100)), ),
+                        self.percentile(p)) for p in self.QUANTILES ]
+        samples.append((f"{name}_sum", labels, self.sum))
+        samples.append((f"{name}_count", labels, self.count))
+        return samples
+
+
+@Singleton
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.families = {}      # { name: (type, help, { labels: metric }) }
+
+
+    def metric(self, cls, kind, name, help, labels):
+        labels = tuple(sorted(labels.items()))
+        with self.lock:
+            if name not in self.families:
+                self.families[name] = (kind, help, {})
+            series = self.families[name][2]
+            if labels not in series:
+                series[labels] = cls()
+            return series[labels]
+
+
+    def counter(self, name, help, **labels):
+        return self.metric(Counter, "counter", name, help, labels)
+
+
+    def gauge(self, name, help, **labels):
+        return self.metric(Gauge, "gauge", name, help, labels)
+
+
+    def histogram(self, name, help, **labels):
+        return self.metric(Histogram, "histogram", name, help, labels)
+
+
+    def summary(self, name, help, **labels):
+        return self.metric(Summary, "summary", name, help, labels)
+
+
+    # { labels: metric } for name
+    def series(self, name):
+        with self.lock:
+            if name not in self.families:
+                return {}
+            return dict(self.families[name][2])
+
+
+    # drop every series with these labels, eg a servlet that's gone
+    def forget(self, **labels):
+        labels = set(labels.items())
+        with self.lock:
+            for kind, help, series in self.families.values():
+                for key in [ key for key in series if labels <= set(key) ]:
+                    del series[key]
+
+
+    def clear(self):
+        with self.lock:
+            self.families = {}
+
+
+    def render(self):
+        with self.lock:
+            families = [ (name, kind, help, list(series.items())) \
+                            for name, (kind, help, series) \
+                                in sorted(self.families.items()) ]
+        lines = []
+        for name, kind, help, series in families:
+            lines.append(f"# HELP {name} {help}")
+            lines.append(f"# TYPE {name} {kind}")
+            for labels, metric in series:
+                for sample, sample_labels, value in metric.samples(name, labels):
+                    lines.append(f"{sample}{format_labels(sample_labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def format_labels(labels):
+    if not labels:
+        return ""
+    def escape(value):
+        return str(value).replace("\\", "\\\\").replace("\"", "\\\"") \
+                            .replace("\n", "\\n")
+    pairs = ",".join(f"{key}=\"{escape(value)}\"" for key, value in labels)
+    return f"{{{pairs}}}"
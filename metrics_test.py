@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+
+import unittest, urllib.request
+import metrics, server_lite
+
+class TestMethods(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = metrics.Registry.instance()
+        self.registry.clear()
+
+    def tearDown(self):
+        self.registry.clear()
+
+
+    def test_render(self):
+        self.registry.counter("cb_requests_total", "requests",
+                                context="c", action="list").incr(3)
+        self.registry.gauge("cb_open_connections", "connections").set(2)
+        histogram = self.registry.histogram("cb_handle_seconds", "latency",
+                                            action="list")
+        for seconds in (0.0005, 0.02, 0.02, 100):
+            histogram.observe(seconds)
+        text = self.registry.render()
+        self.assertIn("# TYPE cb_requests_total counter\n", text)
+        self.assertIn('cb_requests_total{action="list",context="c"} 3\n', text)
+        self.assertIn("cb_open_connections 2\n", text)
+        self.assertIn('cb_handle_seconds_bucket{action="list",le="0.001"} 1\n', text)
+        self.assertIn('cb_handle_seconds_bucket{action="list",le="0.05"} 3\n', text)
+        self.assertIn('cb_handle_seconds_bucket{action="list",le="+Inf"} 4\n', text)
+        self.assertIn('cb_handle_seconds_count{action="list"} 4\n', text)
+
+        summary = self.registry.summary("cb_send_seconds", "latency",
+                                        action="claim")
+        summary.record(0.25)
+        text = self.registry.render()
+        self.assertIn("# TYPE cb_send_seconds summary\n", text)
+        self.assertIn('cb_send_seconds{action="claim",quantile="0.5"}', text)
+        self.assertIn('cb_send_seconds_count{action="claim"} 1\n', text)
+
+        self.registry.forget(context="c")
+        self.assertNotIn("cb_requests_total{", self.registry.render())
+
+
+    def test_web_server(self):
+        self.registry.gauge("cb_open_connections", "connections").set(1)
+        web_server = server_lite.WebServer({}, port=0)
+        web_server.start()
+        try:
+            url = f"http://localhost:{web_server.port}"
+            with urllib.request.urlopen(f"{url}/metrics") as response:
+                self.assertIn(b"cb_open_connections 1\n", response.read())
+            with self.assertRaises(urllib.error.HTTPError):
+                urllib.request.urlopen(f"{url}/nope")
+        finally:
+            web_server.stop()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -9,11 +9,35 @@ pd["key"] = "value"
 If kwargs "cls" is provided, this will be a dict of the named class.
 The class should provide serialize(), deserialize(data), and set(value)
 functions.
+
+Threads may read and iterate while others write.  Iterating hands out
+the dict itself, marked shared; the next mutation copies it before
+changing it (copy on write), so a reader's dict never changes size
+under it.  Mutations hold the lock only for the change itself, and the
+file is written outside it.  Values are not copied: change one with
+modify(), not in place.
+
+A long reader takes a snapshot instead:
+with pd.snapshot() as snapshot:
+    for key, value in snapshot.items(): ...
+... a read-only view of one generation of the dict.  Writers copy the
+dict (not its values: those are shared) only while some snapshot of
+its generation is open, and the copy starts a new generation; once the
+readers are done, writes go back to changing it in place.
+
+For very big dicts:
+sd = ShardedDict("dict.json.bz2", shards=8)
+... is used like a PersistentDict, but keeps keys in 8 PersistentDicts
+(dict.0-of-8.json.bz2, ...) by crc32(key): each has its own lock, file
+and lazy writer, so a write rewrites an eighth of the state.  Iteration
+walks the shards one after another, never merging them, and a snapshot
+is one of every shard.  An unsharded file is split up the first time,
+and kept as .unsharded.
 """
 
-import os, json, logging, threading, bz2
+import os, json, logging, threading, bz2, time, zlib, itertools
 from utils import logger_str
-import elapsed, config
+import elapsed, config, metrics
 
 class PersistentDict:
     def __init__(self, filename, loglevel=logging.INFO, *args, **kwargs):
@@ -32,6 +56,10 @@ class PersistentDict:
         else:
             self.cls = None
         self.lock = threading.RLock()
+        self.write_lock = threading.Lock()      # one writer of the file
+        self.shared = False     # self.data is being read: copy on write
+        self.generation = 0     # bumped whenever self.data is replaced
+        self.readers = {}       # { generation: open snapshots }
         self.read()
         self.clear_dirtybits()
         self.timer = elapsed.ElapsedTimer()
@@ -43,31 +71,52 @@ class PersistentDict:
         if not os.path.exists(filename):
             self.logger.debug("whoopsie, no file")
             return None
-        self.lock.acquire()
         try:
         # https://stackoverflow.com/questions/39450065/python-3-read-write-compressed-json-objects-from-to-gzip-file
             with bz2.open(filename, "r") as statefile:
                 data = json.loads(statefile.read().decode('utf-8'))
-                self.data = self.classify(data)
-                if self.data is None:
+                data = self.classify(data)
+                if data is None:
                     self.logger.debug("json.load() -> self.data is None")
-                    self.data = {}
+                    data = {}
         except (json.decoder.JSONDecodeError, EOFError):
             os.rename(filename, f"{filename}.busted")
             self.logger.warn(f"whoopsie, JSONDecodeError;" \
                         f" saved in {filename}.busted")
-            self.data = {}
-        self.logger.debug(f"read {len(self.data.items())} items")
-        self.lock.release()
+            data = {}
+        with self.lock:
+            self.data = data
+            self.generation += 1
+            self.shared = False
+        self.logger.debug(f"read {len(data)} items")
 
 
     def write(self, verbose = False):
+        with self.write_lock:
+            self.dump()
+
+
+    # with self.write_lock held; writers carry on meanwhile
+    def dump(self):
         filename = self.masterFilename
         self.mkdir(filename)
-        with bz2.open(f"{filename}.tmp", "w") as statefile:
-            statefile.write(json.dumps(self.de_classify(), \
+        start = time.monotonic()
+        with self.snapshot() as snapshot, \
+                bz2.open(f"{filename}.tmp", "w") as statefile:
+            data = self.de_classify(snapshot.dicts[0])
+            statefile.write(json.dumps(data, \
                         sort_keys=True, indent=4).encode('utf-8'))
         os.rename(f"{filename}.tmp", filename)
+        self.publish(time.monotonic() - start, os.path.getsize(filename))
+
+
+    def publish(self, duration, size):
+        registry = metrics.Registry.instance()
+        name = os.path.basename(self.masterFilename)
+        registry.gauge("cb_state_write_seconds", "duration of the last write",
+                        file=name).set(duration)
+        registry.gauge("cb_state_write_bytes", "size of the last write",
+                        file=name).set(size)
         # self.logger.warn(f"wrote {filename}")
 
 
@@ -78,27 +127,57 @@ class PersistentDict:
         return data
 
 
-    def de_classify(self):
-        data = {}
+    def de_classify(self, data):
         if self.cls:
-            for key in self.data.keys():
-                data[key] = self.data[key].serialize()
-            return data
-        return self.data
+            return { key: value.serialize() for key, value in data.items() }
+        return data
 
 
     def lazy_write(self):
         # self.logger.warn(f"PD{id(self)} trying to lazy_write?")
         if self.lazy_timer == 0 or self.timer.elapsed() > self.lazy_timer:
-            # self.logger.warn(f"PD{id(self)} trying to lazy_write, locking:")
-            self.lock.acquire()
-            # self.logger.warn(f"PD{id(self)} locked in lazy_write")
-            if self.lazy_timer == 0 or self.timer.elapsed() > self.lazy_timer:
-                self.write()
-                self.timer.reset()
-            # else:
-                # self.logger.warn(f"PD{id(self)} not writing")
-            self.lock.release()
+            # someone else is writing it already: that'll do, unless
+            #   every change has to be on disk
+            if not self.write_lock.acquire(self.lazy_timer == 0):
+                return
+            try:
+                if self.lazy_timer == 0 or self.timer.elapsed() > self.lazy_timer:
+                    self.timer.reset()
+                    self.dump()
+            finally:
+                self.write_lock.release()
+
+
+    # self.data, for a reader: it won't change from here on
+    def frozen(self):
+        with self.lock:
+            self.shared = True
+            return self.data
+
+
+    # self.data, for a writer holding self.lock: copied if it's shared
+    def writable(self):
+        if self.shared or self.generation in self.readers:
+            self.data = dict(self.data)
+            self.generation += 1
+            self.shared = False
+        return self.data
+
+
+    # the dict as it is now, until the snapshot's released
+    def snapshot(self):
+        with self.lock:
+            generation = self.generation
+            self.readers[generation] = self.readers.get(generation, 0) + 1
+            data = self.data
+        return Snapshot([ data ], release=lambda: self.release(generation))
+
+
+    def release(self, generation):
+        with self.lock:
+            self.readers[generation] -= 1
+            if not self.readers[generation]:
+                del self.readers[generation]
 
 
     def __enter__(self):
@@ -120,29 +199,44 @@ class PersistentDict:
 
     def mkdir(self, filename):
         dir = os.path.dirname(filename)
-        if dir is not "" and not os.path.exists(dir):
+        if dir != "" and not os.path.exists(dir):
             os.makedirs(dir)
 
 
     def touch(self, key):
-        self.dirtybits[key] = 1
+        with self.lock:
+            self.dirtybits[key] = 1
 
 
     def set(self, key, value):
         self[key] = value
 
 
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+
     def __setitem__(self, key, value):
-        # self.lock.acquire()
-        if self.cls:
-            if key not in self.data:
-                self.data[key] = self.cls(*self.args, **self.kwargs)
-            self.data[key].set(value)
-        else:
-            self.data[key] = value
-        self.touch(key)
+        with self.lock:
+            data = self.writable()
+            if self.cls:
+                if key not in data:
+                    data[key] = self.cls(*self.args, **self.kwargs)
+                data[key].set(value)
+            else:
+                data[key] = value
+            self.dirtybits[key] = 1
+        self.lazy_write()
+
+
+    # self[key] = function(self[key], or default), atomically: for values
+    #   that are themselves dicts, say, which readers may be iterating
+    def modify(self, key, function, default=None):
+        with self.lock:
+            data = self.writable()
+            data[key] = function(data.get(key, default))
+            self.dirtybits[key] = 1
         self.lazy_write()
-        # self.lock.release()
 
 
     def __getitem__(self, key):
@@ -158,7 +252,7 @@ class PersistentDict:
 
 
     def __iter__(self):
-        return iter(self.data)
+        return iter(self.frozen())
 
 
     def __len__(self):
@@ -166,40 +260,266 @@ class PersistentDict:
 
 
     def keys(self):
-        # self.lock.acquire()
-        keys = self.data.keys()
-        # self.lock.release()
-        return keys
+        return self.frozen().keys()
 
 
     def __delitem__(self, key):
-        # self.lock.acquire()
-        del self.data[key]
+        with self.lock:
+            del self.writable()[key]
+            if key in self.dirtybits:
+                del self.dirtybits[key]
         self.lazy_write()
-        if key in self.dirtybits:
-            del self.dirtybits[key]
-        # self.lock.release()
 
 
     def items(self):
-        # self.lock.acquire()
-        items = self.data.items()
-        # self.lock.release()
-        return items
-            
+        return self.frozen().items()
+
+
+    def values(self):
+        return self.frozen().values()
+
 
     def contains_p(self, key):
         return key in self.data
 
 
     def clear_dirtybits(self):
-        self.dirtybits = {}
+        with self.lock:
+            self.dirtybits = {}
 
 
     # returns the keys which haven't been touched
     # https://stackoverflow.com/questions/3462143/get-difference-between-two-lists
     def clean_keys(self):
-        return [key for key in self.data if key not in self.dirtybits]
+        with self.lock:
+            return [key for key in self.data if key not in self.dirtybits]
+
+
+# a read-only view of some dicts, one per shard; shard(key) -> which
+class Snapshot:
+    def __init__(self, dicts, shard=None, release=None):
+        self.dicts = dicts
+        self.shard = shard
+        self.releaser = release
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+    def release(self):
+        if self.releaser is not None:
+            self.releaser()
+            self.releaser = None
+
+
+    def part(self, key):
+        if self.shard is None:
+            return self.dicts[0]
+        return self.dicts[self.shard(key)]
+
+
+    def __getitem__(self, key):
+        return self.part(key)[key]
+
+
+    def get(self, key, default=None):
+        return self.part(key).get(key, default)
+
+
+    def __contains__(self, key):
+        return key in self.part(key)
+
+
+    def __len__(self):
+        return sum(len(data) for data in self.dicts)
+
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.dicts)
+
+
+    def keys(self):
+        return iter(self)
+
+
+    def items(self):
+        return itertools.chain.from_iterable(data.items() \
+                                                for data in self.dicts)
+
+
+    def values(self):
+        return itertools.chain.from_iterable(data.values() \
+                                                for data in self.dicts)
+
+
+# dict.json.bz2, 2, 8 -> dict.2-of-8.json.bz2
+def shard_filename(filename, shard, nshards):
+    if nshards == 1:
+        return filename
+    stem, suffix = filename, ""
+    for extension in (".json.bz2", ".bz2", ".json"):
+        if filename.endswith(extension):
+            stem, suffix = filename[:-len(extension)], extension
+            break
+    return f"{stem}.{shard}-of-{nshards}{suffix}"
+
+
+class ShardedDict:
+    def __init__(self, filename, shards=1, loglevel=logging.INFO,
+                    *args, **kwargs):
+        self.logger = logging.getLogger(logger_str(__class__))
+        self.logger.setLevel(loglevel)
+        self.masterFilename = filename
+        nshards = max(1, int(shards))
+        unsharded = nshards > 1 and os.path.exists(filename) and \
+            not os.path.exists(shard_filename(filename, 0, nshards))
+        self.shards = [ PersistentDict(shard_filename(filename, i, nshards),
+                                        loglevel, *args, **kwargs) \
+                            for i in range(nshards) ]
+        if unsharded:
+            self.split(filename, loglevel)
+
+
+    # one-time: spread an unsharded file's contents over the shards
+    def split(self, filename, loglevel):
+        old = PersistentDict(filename, loglevel)
+        for key, value in old.data.items():
+            shard = self.shard(key)
+            shard.data[key] = value
+            shard.touch(key)
+        self.write()
+        os.rename(filename, f"{filename}.unsharded")
+        self.logger.info(f"split {len(old)} keys from {filename} " \
+                         f"into {len(self.shards)} shards")
+
+
+    def index(self, key):
+        if len(self.shards) == 1:
+            return 0
+        return zlib.crc32(str(key).encode()) % len(self.shards)
+
+
+    def shard(self, key):
+        return self.shards[self.index(key)]
+
+
+    # every shard's snapshot, as one
+    def snapshot(self):
+        snapshots = [ shard.snapshot() for shard in self.shards ]
+        def release():
+            for snapshot in snapshots:
+                snapshot.release()
+        return Snapshot([ snapshot.dicts[0] for snapshot in snapshots ],
+                        self.index, release)
+
+
+    def read(self, verbose = False):
+        for shard in self.shards:
+            shard.read(verbose)
+
+
+    def write(self, verbose = False):
+        for shard in self.shards:
+            shard.write(verbose)
+
+
+    def lazy_write(self):
+        for shard in self.shards:
+            shard.lazy_write()
+
+
+    # every shard's lock, always in order
+    def __enter__(self):
+        for shard in self.shards:
+            shard.lock.acquire()
+
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        for shard in reversed(self.shards):
+            shard.lock.release()
+
+
+    def locked(self):
+        return any(shard.locked() for shard in self.shards)
+
+
+    def touch(self, key):
+        self.shard(key).touch(key)
+
+
+    def set(self, key, value):
+        self[key] = value
+
+
+    def get(self, key, default=None):
+        return self.shard(key).get(key, default)
+
+
+    def modify(self, key, function, default=None):
+        self.shard(key).modify(key, function, default)
+
+
+    def __setitem__(self, key, value):
+        self.shard(key)[key] = value
+
+
+    def __getitem__(self, key):
+        return self.shard(key)[key]
+
+
+    def __contains__(self, key):
+        return key in self.shard(key)
+
+
+    def __delitem__(self, key):
+        del self.shard(key)[key]
+
+
+    def __iter__(self):
+        return itertools.chain.from_iterable(self.shards)
+
+
+    def __len__(self):
+        return sum(len(shard) for shard in self.shards)
+
+
+    # lists, not views: there's no one dict to view
+    def keys(self):
+        return list(self)
+
+
+    def items(self):
+        return [ item for shard in self.shards for item in shard.items() ]
+
+
+    def values(self):
+        return [ value for shard in self.shards for value in shard.values() ]
+
+
+    # a plain dict of everything; with one shard, its own dict
+    @property
+    def data(self):
+        if len(self.shards) == 1:
+            return self.shards[0].data
+        return dict(self.items())
+
+
+    def contains_p(self, key):
+        return key in self
+
+
+    def clear_dirtybits(self):
+        for shard in self.shards:
+            shard.clear_dirtybits()
+
+
+    def clean_keys(self):
+        return [ key for shard in self.shards for key in shard.clean_keys() ]
 
 
 if __name__ == "__main__":
@@ -10,8 +10,9 @@ class TestCacheMethods(unittest.TestCase):
         pass
 
     def tearDown(self):
-        if os.path.exists("testfile.txt"):
-            os.remove("testfile.txt")
+        for filename in os.listdir("."):
+            if filename.startswith("testfile."):
+                os.remove(filename)
 
 
     def test_set(self):
@@ -81,6 +82,57 @@ class TestCacheMethods(unittest.TestCase):
         self.assertTrue("two" in pd)
 
 
+    def test_sharded(self):
+        pd = persistent_dict.PersistentDict("testfile.json")
+        for i in range(100):
+            pd[f"file {i}"] = i
+        pd.write()
+        # an unsharded file is split on first use
+        sd = persistent_dict.ShardedDict("testfile.json", shards=4)
+        self.assertFalse(os.path.exists("testfile.json"))
+        self.assertTrue(os.path.exists("testfile.json.unsharded"))
+        self.assertTrue(os.path.exists("testfile.3-of-4.json"))
+        self.assertEqual(len(sd), 100)
+        self.assertEqual(sd["file 42"], 42)
+        self.assertTrue(all(len(shard) < 100 for shard in sd.shards))
+        sd["file 100"] = 100
+        del sd["file 0"]
+        sd.write()
+        sd2 = persistent_dict.ShardedDict("testfile.json", shards=4)
+        self.assertEqual(sorted(sd2.values()), list(range(1, 101)))
+        self.assertNotIn("file 0", sd2)
+        sd2.clear_dirtybits()
+        sd2["file 1"] = 1
+        self.assertEqual(len(sd2.clean_keys()), 99)
+
+
+    def test_snapshot(self):
+        pd = persistent_dict.PersistentDict("testfile.json", lazy_write=60)
+        pd["one"] = { "a": 1 }
+        pd["two"] = 2
+        with pd.snapshot() as snapshot:
+            pd["three"] = 3
+            del pd["two"]
+            self.assertEqual(sorted(snapshot.keys()), [ "one", "two" ])
+            self.assertEqual(snapshot["two"], 2)
+            self.assertNotIn("three", snapshot)
+            self.assertIs(snapshot["one"], pd["one"])   # shared, not copied
+        self.assertEqual(pd.readers, {})
+        data = pd.data
+        pd["four"] = 4          # nobody's reading: no copy
+        self.assertIs(pd.data, data)
+
+        sd = persistent_dict.ShardedDict("testfile.json", shards=3)
+        for i in range(30):
+            sd[i] = i
+        with sd.snapshot() as snapshot:
+            for key in snapshot:
+                del sd[key]
+            self.assertEqual(len(sd), 0)
+            self.assertEqual(sorted(snapshot.values()), list(range(30)))
+            self.assertEqual(snapshot.get(7), 7)
+
+
 if __name__ == "__main__":
     suite = unittest.TestLoader().loadTestsFromTestCase(TestCacheMethods)
     unittest.TextTestRunner(verbosity=2).run(suite)
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+
+"""
+Planner benchmark: time Clientlet.plan() on synthetic inventories,
+using the simulator (no servers, rsync or real files).
+
+The interesting case is a full clientlet holding N overserved files
+when a new source shows up with N uncopied (underserved) files of the
+same size: every underserved file needs one overserved file dropped.
+
+usage:
+    ./planner_bench.py [N [N ...]]      # default: 1000 2000 4000 8000
+
+Times should grow ~linearly with N.
+"""
+
+import sys, time, logging
+import config, simulator
+
+
+# held: N files from the first source, each with 3 of 2 copies;
+# new:  N files from the second source, nobody has them yet
+def build(n):
+    cluster = simulator.SimCluster(nsources=2, nbackups=1, nfiles=n,
+                                    copies=2, allocation=f"{n}m",
+                                    distribution="fixed", mean="1m")
+    old = sorted(cluster.servlets)[0]
+    servlet = cluster.servlets[old]
+    context, clientlet = list(cluster.clientlets.items())[0]
+    expiry = time.time() + 3600
+    for filename in servlet.scanner:
+        servlet.clients[filename] = { context: expiry,
+                                      "other1": expiry, "other2": expiry }
+        clientlet.scanners[old][filename] = servlet.scanner[filename]
+    clientlet.update_allocation()       # exactly full
+    return cluster, clientlet
+
+
+def bench(n):
+    cluster, clientlet = build(n)
+    try:
+        start = time.process_time()
+        clientlet.plan()
+        elapsed = time.process_time() - start
+        copied = int(clientlet.stats['copies'])
+        dropped = int(clientlet.stats['drops'])
+    finally:
+        cluster.cleanup()
+    return elapsed, copied, dropped
+
+
+if __name__ == "__main__":
+    logging.basicConfig(format='%(asctime)s [%(name)s] %(message)s',
+                            level=logging.ERROR)
+    sizes = [ int(n) for n in sys.argv[1:] ] or [ 1000, 2000, 4000, 8000 ]
+    print(f"{'N':>10} {'cpu':>9} {'us/file':>9} {'copies':>8} {'drops':>8}")
+    for n in sizes:
+        elapsed, copied, dropped = bench(n)
+        print(f"{n:10d} {elapsed:8.3f}s {1e6*elapsed/n:9.1f} {copied:8d} {dropped:8d}")
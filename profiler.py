@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+
+"""
+Profile a running daemon without restarting it (and losing its state).
+
+    profiler.install("server")  # once, from the main thread: SIGUSR1
+                                #   starts a profile; another stops it early
+    profiler.start(seconds=30, name="server")   # or start one directly
+    kill -USR1 <pid>
+or over the Datagram port, the Servlet 'profile' action:
+    [ "profile", server context, client context, seconds ]
+
+For "PROFILE SECONDS" (default 30s) a thread samples every thread's
+stack every "PROFILE INTERVAL" seconds (default 0.01), then writes to
+"PROFILE DIR" (default /tmp):
+    profile-{name}-{time}.folded    collapsed stacks, one per line:
+                                    thread;outer;...;inner count
+                                    (flamegraph.pl, speedscope)
+    profile-{name}-{time}.pstats    the same samples as pstats: "calls"
+                                    are samples, times are samples x
+                                    interval (python -m pstats, snakeviz)
+Sampling, not cProfile: cProfile only sees the thread that turned it on,
+and the time goes in Servlet, Clientlet and transfer threads.  Costs
+one thread waking every interval, and only while it runs.
+"""
+
+import sys, os, time, signal, threading, logging, pstats, collections
+import config
+
+logger = logging.getLogger("profiler")
+lock = threading.RLock()      # the signal handler may interrupt a holder
+sampler = None
+
+
+class Sampler(threading.Thread):
+    def __init__(self, seconds, interval, prefix):
+        super().__init__(name="profiler", daemon=True)
+        self.seconds = seconds
+        self.interval = interval
+        self.prefix = prefix
+        self.stopping = threading.Event()
+        self.stacks = collections.Counter()     # { (thread, frames): n }
+        self.samples = 0
+
+
+    def run(self):
+        deadline = time.monotonic() + self.seconds
+        names = {}
+        while time.monotonic() < deadline and \
+                not self.stopping.wait(self.interval):
+            self.sample(names)
+        self.write()
+
+
+    def sample(self, names):
+        me = threading.get_ident()
+        if len(names) != threading.active_count():
+            names.clear()
+            names.update({ thread.ident: thread.name \
+                            for thread in threading.enumerate() })
+        for ident, frame in sys._current_frames().items():
+            if ident == me:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append((code.co_filename, code.co_firstlineno,
+                                code.co_name))
+                frame = frame.f_back
+            stack.reverse()
+            self.stacks[(names.get(ident, str(ident)), tuple(stack))] += 1
+        self.samples += 1
+
+
+    def stop(self):
+        self.stopping.set()
+
+
+    def write(self):
+        try:
+            with open(f"{self.prefix}.folded", "w") as f:
+                for (thread, stack), n in self.stacks.most_common():
+                    frames = ";".join(f"{name} ({os.path.basename(filename)}:{line})" \
+                                        for filename, line, name in stack)
+                    f.write(f"{thread};{frames} {n}\n")
+            pstats.Stats(SampledStats(self.stacks, self.interval)) \
+                .dump_stats(f"{self.prefix}.pstats")
+            logger.info(f"profiled {self.samples} samples -> {self.prefix}.*")
+        except OSError:
+            logger.exception(f"writing {self.prefix}.*")
+
+
+# samples in the shape pstats.Stats() loads: { function: (primitive
+#   calls, calls, own time, cumulative time, { caller: calls }) }
+class SampledStats:
+    def __init__(self, stacks, interval):
+        self.stats = {}
+        own = collections.Counter()
+        total = collections.Counter()
+        callers = collections.defaultdict(collections.Counter)
+        for (thread, stack), n in stacks.items():
+            if not stack:
+                continue
+            own[stack[-1]] += n
+            for function in set(stack):
+                total[function] += n
+            for caller, callee in zip(stack, stack[1:]):
+                callers[callee][caller] += n
+        for function, n in total.items():
+            self.stats[function] = (n, n, own[function] * interval,
+                                    n * interval, dict(callers[function]))
+
+
+    def create_stats(self):
+        pass
+
+
+# returns the files' prefix, or None if a profile's already running
+def start(seconds=None, name="cb"):
+    global sampler
+    cfg = config.Config.instance()
+    if seconds is None:
+        seconds = cfg.get_duration("global", "PROFILE SECONDS", "30s")
+    interval = float(cfg.get("global", "PROFILE INTERVAL", 0.01))
+    directory = cfg.get("global", "PROFILE DIR", "/tmp")
+    with lock:
+        if sampler is not None and sampler.is_alive():
+            return None
+        stamp = time.strftime("%Y%m%d-%H%M%S")
+        prefix = f"{directory}/profile-{name}-{stamp}"
+        sampler = Sampler(float(seconds), interval, prefix)
+        sampler.start()
+    logger.info(f"profiling for {seconds}s -> {prefix}.*")
+    return prefix
+
+
+# returns True if there was a profile running
+def stop():
+    with lock:
+        if sampler is None or not sampler.is_alive():
+            return False
+        sampler.stop()
+        return True
+
+
+def install(name, signum=signal.SIGUSR1):
+    def toggle(signum, frame):
+        if not stop():
+            start(name=name)
+    signal.signal(signum, toggle)
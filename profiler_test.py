@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+
+import unittest, tempfile, threading, time, os, pstats, signal
+import config, profiler
+
+def spin(stop):
+    while not stop.is_set():
+        sum(range(1000))
+
+class TestMethods(unittest.TestCase):
+
+    def setUp(self):
+        self.cfg = config.Config.instance()
+        self.cfg.reset()
+
+    def tearDown(self):
+        profiler.stop()
+        self.cfg.reset()
+
+
+    def test_profile(self):
+        stop = threading.Event()
+        spinner = threading.Thread(target=spin, args=(stop, ), name="spinner")
+        spinner.start()
+        try:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                self.cfg.data = { "global": { "PROFILE DIR": tmpdir,
+                                              "PROFILE INTERVAL": "0.001" } }
+                prefix = profiler.start(seconds=0.2, name="test")
+                self.assertTrue(prefix.startswith(f"{tmpdir}/profile-test-"))
+                self.assertIsNone(profiler.start(seconds=1))    # one at a time
+                profiler.sampler.join()
+                with open(f"{prefix}.folded") as f:
+                    folded = f.read()
+                self.assertIn("spinner;", folded)
+                self.assertIn("spin (profiler_test.py:", folded)
+                stats = pstats.Stats(f"{prefix}.pstats")
+                self.assertTrue(any(name == "spin" for filename, line, name \
+                                        in stats.stats))
+        finally:
+            stop.set()
+            spinner.join()
+
+
+    def test_signal(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.cfg.data = { "global": { "PROFILE DIR": tmpdir } }
+            previous = signal.getsignal(signal.SIGUSR1)
+            try:
+                profiler.install("test")
+                os.kill(os.getpid(), signal.SIGUSR1)    # on
+                time.sleep(0.1)
+                self.assertTrue(profiler.sampler.is_alive())
+                os.kill(os.getpid(), signal.SIGUSR1)    # off, early
+                profiler.sampler.join(5)
+                self.assertFalse(profiler.sampler.is_alive())
+                self.assertEqual(len(os.listdir(tmpdir)), 2)
+            finally:
+                signal.signal(signal.SIGUSR1, previous)
+
+
+if __name__ == "__main__":
+    unittest.main()
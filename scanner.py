@@ -10,13 +10,22 @@ TODONE:
 TODO:
     return directories (trailing /)
 
+Checksums are computed by a pool of "CHECKSUM WORKERS" threads (default
+4): the walk records a changed file's stat with checksum "deferred" and
+queues it, and scan() returns once the pool has filled them all in.
+"IO_RATELIMIT" is one token bucket shared by the whole pool.
+
+Checksums are also kept in a ChecksumCache keyed by (device, inode,
+size, mtime_ns), so a renamed or moved file isn't re-read.
 """
 
 import os, logging, threading
-import config, utils, elapsed
-from persistent_dict import PersistentDict
+from concurrent.futures import ThreadPoolExecutor
+import config, utils, elapsed, bandwidth
+from persistent_dict import PersistentDict, ShardedDict
 from utils import logger_str
-from file_state import FileState
+from file_state import FileState, stale_checksum, hash_algorithm
+from checksum_cache import ChecksumCache
 
 class Scanner(PersistentDict):
     def __init__(self, context, path, **kwargs):
@@ -37,11 +46,17 @@ class Scanner(PersistentDict):
         lazy_write = utils.str_to_duration(self.config.get(context, "LAZY WRITE", 5))
         super().__init__(f"{self.path}/{self.pd_filename}",
                             lazy_write=lazy_write, **kwargs) 
+        self.cache_filename = f".cb.{context}-checksums.json.bz2"
+        self.cache = ChecksumCache(f"{self.path}/{self.cache_filename}",
+                                    lazy_write=lazy_write)
         self.logger = logging.getLogger(logger_str(__class__) + " " + name)
         # self.logger.setLevel(logging.INFO)
         self.ignored_suffixes = {}
         self.report_timer = elapsed.ElapsedTimer()
         self.stat = stats.Statistic(buckets=(0, 5, 10, 30))
+        self.limiter = bandwidth.TokenBucket(0)
+        self.pool = None
+        self.pending = []
 
 
     def report(self, restart = False):
@@ -64,7 +79,7 @@ class Scanner(PersistentDict):
 
     # returns a list
     def build_ignorals(self):
-        ignorals = [ self.pd_filename ]
+        ignorals = [ self.pd_filename, self.cache_filename ]
         global_ignore_suffix = self.config.get("global", "ignore suffix")
         if type(global_ignore_suffix) is str:
             ignorals.append(global_ignore_suffix)
@@ -80,7 +95,8 @@ class Scanner(PersistentDict):
 
     def ignoring(self, ignorals, filename):
         # always ignore state files
-        if filename.endswith(self.pd_filename):
+        if filename.endswith(self.pd_filename) \
+            or filename.endswith(self.cache_filename):
             return True
         for suffix in ignorals:
            # we only ignore suffixes "magically"
@@ -103,7 +119,17 @@ class Scanner(PersistentDict):
         ignorals = self.build_ignorals()
         self.report(True)
         gen_checksums = not turbo and self.checksums
-        changed = self.scandir(".", ignorals, gen_checksums)
+        if gen_checksums:
+            self.cache.clear_dirtybits()
+            self.start_checksummers()
+        try:
+            changed = self.scandir(".", ignorals, gen_checksums)
+        finally:
+            if gen_checksums:
+                self.finish_checksummers()
+        if gen_checksums:
+            self.cache.prune()
+            self.cache.write()
         if self.removeDeleteds():
             changed = True
         self.write() # should be redundant
@@ -145,24 +171,75 @@ class Scanner(PersistentDict):
             else:
                 actualState = FileState(fqde, False, prefix=self.path)
                 if actualState.maybechanged(self[fqde]) or \
-                    (gen_checksums and self[fqde]["checksum"] == "deferred"):
+                    (gen_checksums and stale_checksum(self[fqde])):
                     self.update(fqde, gen_checksums)
                     changed = True
                 else:
-                    # ... probably same.  preserve the old one (touch it)
+                    # ... probably same.  preserve the old one (touch it),
+                    #   and its cached checksum, or prune() drops that
                     self.touch(fqde)
+                    if gen_checksums and \
+                            self.cache.lookup(self[fqde]) is None:
+                        self.cache.store(self[fqde])
         return changed
 
 
-    # update one file
+    def start_checksummers(self):
+        IO_RATELIMIT = self.config.get("global", "IO_RATELIMIT", "0")
+        self.limiter.set_rate(utils.str_to_bytes(IO_RATELIMIT))
+        workers = int(self.config.get(self.context, "CHECKSUM WORKERS", 4))
+        self.pool = ThreadPoolExecutor(max_workers=max(1, workers))
+        self.pending = []
+
+
+    # wait for every queued checksum
+    def finish_checksummers(self):
+        self.pool.shutdown(wait=True)
+        for future in self.pending:
+            if future.exception():
+                self.logger.error(f"checksum failed: {future.exception()}")
+        self.pool = None
+        self.pending = []
+
+
+    # update one file: its stat now, its checksum (if any) on the pool;
+    #   outside of a scan (eg, a claim), there's no pool: do it now
     def update(self, fqde, gen_checksums=True):
         try:
-            actualState = FileState(fqde, gen_checksums, 
-                                    prefix=self.path)
-            self[fqde] = actualState.to_dict()
+            actualState = FileState(fqde, False, prefix=self.path)
         except FileNotFoundError:
             if fqde in self:
                 del self[fqde]
+            return
+        checksum = self.cache.lookup(actualState.to_dict())
+        if checksum is not None:        # seen it, maybe by another name
+            actualState.data['checksum'] = checksum
+            actualState.data['algorithm'] = hash_algorithm()
+            self[fqde] = actualState.to_dict()
+            return
+        if gen_checksums and self.pool is None:
+            self.checksum(fqde, inline=True)
+            return
+        self[fqde] = actualState.to_dict()
+        if gen_checksums:
+            self.pending.append(self.pool.submit(self.checksum, fqde))
+
+
+    # on a worker: fill in a deferred checksum, unless the file changed
+    #   since its stat was recorded (then the next scan gets it)
+    def checksum(self, fqde, inline=False):
+        try:
+            actualState = FileState(fqde, True, prefix=self.path,
+                                    limiter=self.limiter)
+        except FileNotFoundError:
+            if inline and fqde in self:
+                del self[fqde]
+            return
+        self.cache.store(actualState.to_dict())
+        with self.lock:
+            if inline or (fqde in self \
+                            and not actualState.maybechanged(self[fqde])):
+                self[fqde] = actualState.to_dict()
 
 
     def drop(self, filename):
@@ -214,7 +291,9 @@ class Scanner(PersistentDict):
         return string
 
 import stats
-class ScannerLite(PersistentDict):
+# "STATE SHARDS: n" (default 1) keeps the state in n files; see
+#   persistent_dict.ShardedDict
+class ScannerLite(ShardedDict):
     def __init__(self, context, path, pd_path=None, name=None, 
                     loglevel=logging.INFO, **kwargs):
         self.context = context
@@ -229,7 +308,9 @@ class ScannerLite(PersistentDict):
             pd_file = f"{pd_path}/{self.pd_filename}"
         else:
             pd_file = f"{self.path}/{self.pd_filename}"
-        super().__init__(pd_file, lazy_write=lazy_write) 
+        shards = self.config.get(context, "STATE SHARDS", 1)
+        super().__init__(pd_file, shards=shards, lazy_write=lazy_write)
+        self.total = sum(self.values())
         self.logger = logging.getLogger(logger_str(__class__) + " " + name)
         self.logger.setLevel(loglevel)
         self.ignored_suffixes = {}
@@ -272,9 +353,8 @@ class ScannerLite(PersistentDict):
 
 
     def ignoring(self, ignorals, filename):
-        # always ignore state files
-        if filename.endswith(self.pd_filename) \
-            or filename.endswith(self.pd_filename + ".tmp"):
+        # always ignore state files, sharded or not
+        if filename.startswith(f".cb.{self.context}-lite."):
             return True
         for suffix in ignorals:
            # we only ignore suffixes "magically"
@@ -360,12 +440,28 @@ class ScannerLite(PersistentDict):
         return changed
 
 
+    # running total of bytes held, maintained on every set/delete
+    # so consumption() doesn't have to walk the whole dict
+    def read(self, verbose = False):
+        super().read(verbose)
+        self.total = sum(self.values())
+
+
+    def __setitem__(self, key, value):
+        if key in self:
+            self.total -= self[key]
+        super().__setitem__(key, value)
+        self.total += value
+
+
+    def __delitem__(self, key):
+        size = self[key]
+        super().__delitem__(key)
+        self.total -= size
+
+
     def consumption(self):
-        total = 0
-        filenames = list(self.keys())
-        for filename, size in self.items():
-            total += size
-        return total
+        return self.total
 
 
     def audit(self):
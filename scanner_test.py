@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import unittest, scanner, config, logging, os, shutil
+import unittest, scanner, config, logging, os, shutil, tempfile, file_state
 import subprocess
 
 class TestMethods(unittest.TestCase):
@@ -85,6 +85,108 @@ class TestMethods(unittest.TestCase):
         os.remove(f"{dir}/.cb.test-lite.json.bz2")
 
 
+    def test_lite_consumption(self):
+        with tempfile.TemporaryDirectory() as path:
+            for name, size in (("one", 1000), ("two", 2000)):
+                with open(f"{path}/{name}", "wb") as f:
+                    f.write(b"\0" * size)
+            s = scanner.ScannerLite("test_lite", path)
+            s.scan()
+            self.assertEqual(s.consumption(), 3000)
+            s["one"] = 1000
+            self.assertEqual(s.consumption(), 3000)
+            s["one"] = 1500
+            self.assertEqual(s.consumption(), 3500)
+            s.drop("two")
+            self.assertEqual(s.consumption(), 1500)
+            s.write()
+            s2 = scanner.ScannerLite("test_lite", path)
+            self.assertEqual(s2.consumption(), 1500)
+
+
+    def test_lite_sharded(self):
+        cfg = config.Config.instance()
+        cfg.data = { "test_shards": { "STATE SHARDS": 3 } }
+        try:
+            with tempfile.TemporaryDirectory() as path:
+                for i in range(10):
+                    with open(f"{path}/{i}", "wb") as f:
+                        f.write(b"\0" * 100)
+                s = scanner.ScannerLite("test_shards", path)
+                s.scan()
+                s.scan()        # the state files aren't scanned
+                self.assertEqual(len(s), 10)
+                self.assertEqual(s.consumption(), 1000)
+                self.assertTrue(os.path.exists(
+                    f"{path}/.cb.test_shards-lite.2-of-3.json.bz2"))
+                s.drop("3")
+                s.write()
+                s2 = scanner.ScannerLite("test_shards", path)
+                self.assertEqual(s2.consumption(), 900)
+                self.assertNotIn("3", s2)
+        finally:
+            cfg.reset()
+
+
+    def test_checksum_pool(self):
+        with tempfile.TemporaryDirectory() as path:
+            for i in range(20):
+                with open(f"{path}/{i}", "wb") as f:
+                    f.write(os.urandom(1000 * i))
+            s = scanner.Scanner("test_pool", path)
+            s.scan()
+            self.assertEqual(len(s.keys()), 20)
+            for filename in s.keys():
+                self.assertEqual(s[filename]["checksum"],
+                    file_state.sum_sha256(f"{path}/{filename}"))
+            self.assertIsNone(s.pool)
+            # outside a scan, update() checksums inline
+            with open(f"{path}/1", "wb") as f:
+                f.write(b"changed")
+            s.update("1")
+            self.assertEqual(s["1"]["checksum"],
+                                file_state.sum_sha256(f"{path}/1"))
+
+
+    def test_checksum_cache(self):
+        hashed = []
+        sum_hash = file_state.sum_hash
+        def counting_sum_hash(fname, *args, **kwargs):
+            hashed.append(fname)
+            return sum_hash(fname, *args, **kwargs)
+        file_state.sum_hash = counting_sum_hash
+        try:
+            with tempfile.TemporaryDirectory() as path:
+                with open(f"{path}/one", "wb") as f:
+                    f.write(os.urandom(1000))
+                s = scanner.Scanner("test_cache", path)
+                s.scan()
+                self.assertEqual(len(hashed), 1)
+                checksum = s["./one"]["checksum"]
+                s.scan()                            # unchanged: keep it
+                self.assertEqual(len(hashed), 1)
+                os.makedirs(f"{path}/moved")
+                os.rename(f"{path}/one", f"{path}/moved/uno")
+                s.scan()
+                self.assertEqual(len(hashed), 1)     # no re-read
+                self.assertEqual(s["moved/uno"]["checksum"], checksum)
+                with open(f"{path}/moved/uno", "ab") as f:
+                    f.write(b"more")
+                s.scan()
+                self.assertEqual(len(hashed), 2)
+                # a new algorithm means new checksums
+                cfg = config.Config.instance()
+                cfg.data = { "global": { "HASH": "blake2b" } }
+                s.scan()
+                cfg.reset()
+                self.assertEqual(len(hashed), 3)
+                self.assertEqual(s["moved/uno"]["algorithm"], "blake2b")
+                self.assertEqual(s["moved/uno"]["checksum"],
+                    file_state.sum_hash(f"{path}/moved/uno", "blake2b"))
+        finally:
+            file_state.sum_hash = sum_hash
+
+
 if __name__ == "__main__":
     suite = unittest.TestLoader().loadTestsFromTestCase(TestMethods)
     unittest.TextTestRunner(verbosity=2).run(suite)
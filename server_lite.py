@@ -1,12 +1,15 @@
 #!/usr/bin/env python3
 
-import _thread, time
-from threading import Thread
+import _thread, time, os, tarfile, tempfile, threading
+import multiprocessing, multiprocessing.connection
+from threading import Thread, Event
 from http.server import BaseHTTPRequestHandler, HTTPServer
 
-import config, stats, scanner, lock, utils, elapsed
+import config, stats, scanner, lock, utils, elapsed, bandwidth, metrics, tracing
+import profiler, file_state
 from datagram import *
-from persistent_dict import PersistentDict
+from persistent_dict import PersistentDict, ShardedDict
+from checksum_cache import ChecksumCache
 
 
  #####
@@ -24,7 +27,38 @@ Servlet protocol:
         returns "ack" or None
     unclaim(client, [filename, ]): decrements the nclaims for each filename
         returns "ack" or None
+    checksum(client, filename): returns { 'size', 'mtime', 'checksum' }
+    read range(client, filename, offset, length): returns [ offset, length ]
+        then streams that many bytes of the file, raw
+    bundle(client, [filename, ]): returns [ filename, ] it will send, then
+        streams a tar of them in raw hunks, ending with an empty one
+    bandwidth(client): returns the client's share of this host's upload
+        budget, bytes/s (0 == unlimited)
+    profile(client, seconds): profiles this whole process for seconds;
+        returns where the results will be, or None if already profiling
 """
+
+# a response that's file contents, not JSON: Server.handler streams it
+class FileRange:
+    def __init__(self, path, offset, length):
+        self.path = path
+        self.offset = offset
+        self.length = length
+
+
+# likewise: a tar of filenames (relative to path), streamed
+class Bundle:
+    def __init__(self, path, filenames):
+        self.path = path
+        self.filenames = filenames
+
+
+# for PersistentDict.modify(): claims, less client's
+def unclaimer(client):
+    return lambda claims: { other: stamp for other, stamp in claims.items() \
+                                if other != client }
+
+
 class Servlet(Thread):
     def __init__(self, context):
         super().__init__()
@@ -39,29 +73,86 @@ class Servlet(Thread):
         self.path = config.path_for(self.config.get(self.context, "source"))
         self.scanner = scanner.ScannerLite(self.context, self.path)
         self.rescan = utils.get_interval(self.config, "rescan", self.context)
+        self.config.subscribe(self.reconfigure, ("copies", "rescan"),
+                                (self.context, "global"))
 
         lazy_write = self.config.get(context, "LAZY WRITE", 5)
         lazy_write = utils.str_to_duration(lazy_write)
         # self.clients: { filename : { client: expiry_time, } }
+        #   expiry_time None: until the client's lease expires
         clients_state = f"/tmp/cb.{context}-clients.json.bz2"
-        self.clients = PersistentDict(clients_state, lazy_write=5)
+        shards = self.config.get(context, "STATE SHARDS", 1)
+        self.clients = ShardedDict(clients_state, shards=shards, lazy_write=5)
+        # self.leases: { client: [ token, expiry_time ] }
+        leases_state = f"/tmp/cb.{context}-leases.json.bz2"
+        self.leases = PersistentDict(leases_state, lazy_write=5)
+        # checksums served, by stat identity; pruned each rescan of
+        #   whatever wasn't asked for since the one before
+        checksums_state = f"/tmp/cb.{context}-checksums.json.bz2"
+        self.checksums = ChecksumCache(checksums_state, lazy_write=5)
         self.stats = stats.Stats()
+        self.metrics = metrics.Registry.instance()
+        self.buckets = {}       # the last audit's copy_buckets()
+        self.handling = False
+        self.bailout = False
+        self.wakeup = Event()
+        self.broker = None      # the Server's bandwidth.Broker
+
+
+    # Config subscriber: copies and rescan take effect right away
+    def reconfigure(self, changes):
+        self.copies = int(self.config.get(self.context, "copies", 2))
+        self.rescan = utils.get_interval(self.config, "rescan", self.context)
+        self.logger.info(f"reconfigured: {self.copies} copies, " \
+                         f"rescan every {utils.duration_to_str(self.rescan)}")
+
+
+    # the source went away: stop serving, stop scanning
+    def stop(self):
+        self.config.unsubscribe(self.reconfigure)
         self.handling = False
+        self.bailout = True
+        self.wakeup.set()
+        self.metrics.forget(context=self.context)
 
 
+    # a file's claims, { client: expiry_time }, are never changed in
+    #   place: modify() swaps in a new dict, so readers needn't lock
     def expire_claims(self):
+        now = time.time()
+        with self.leases.snapshot() as leases:
+            lapsed = [ client for client, (token, expiry) in leases.items() \
+                            if expiry <= now ]
+        for client in lapsed:
+            with self.leases.lock:      # not if it was just renewed
+                lease = self.leases.get(client)
+                if lease is not None and lease[1] <= now:
+                    self.logger.info(f"{client}'s lease expired")
+                    del self.leases[client]
+
+        # the lease as it is now, not as it was: a lease() may have
+        #   re-claimed the file since the scan below
+        def live(client, stamp):
+            if stamp is None:
+                lease = self.leases.get(client)
+                return lease is not None and lease[1] > now
+            return stamp > now
+
         expires = 0
-        if True or self.logger.getEffectiveLevel() < logging.DEBUG:
-            for filename in self.clients:
-                for client, stamp in self.clients[filename].items():
-                    if stamp < time.time():
-                        expires += 1
+        expired = []
+        with self.clients.snapshot() as clients:
+            for filename, claims in clients.items():
+                n = sum(1 for client, stamp in claims.items() \
+                            if not live(client, stamp))
+                if n:
+                    expires += n
+                    expired.append(filename)
         if expires:
             self.logger.warn(f"Warning: about to expire {expires} files")
-        for filename in self.clients:
-            self.clients[filename] = { client: stamp \
-                for client, stamp in self.clients[filename].items() \
-                    if stamp > time.time() }
+        for filename in expired:
+            self.clients.modify(filename, lambda claims: \
+                { client: stamp for client, stamp in claims.items() \
+                    if live(client, stamp) }, {})
 
 
     # metadata(): returns a dict({'copies': ##, 'rescan': ##})
@@ -75,13 +166,10 @@ class Servlet(Thread):
         self.logger.debug(f"Listing all for {client}")
         listing = {}
         self.expire_claims()
-        for filename in self.scanner:
-            size = self.scanner[filename]
-            if filename in self.clients:
-                nclients = len(self.clients[filename])
-            else:
-                nclients = 0
-            listing[filename] = [ size, nclients ]
+        with self.scanner.snapshot() as files, \
+                self.clients.snapshot() as clients:
+            for filename, size in files.items():
+                listing[filename] = [ size, len(clients.get(filename, ())) ]
         self.stats['files listed'].incr(len(listing))
         self.logger.debug(f"Returning {len(listing)} to {client}: {str(listing)[:200]}...")
         return listing
@@ -93,12 +181,52 @@ class Servlet(Thread):
         client, files = args[:2]
         n = len(files)
         self.logger.debug(f"claiming {n} files for client {client}")
+        expiry = time.time() + self.rescan
+        for filename in files:
+            self.clients.modify(filename,
+                lambda claims: { **claims, client: expiry }, {})
+        self.stats['files claimed'].incr(len(files))
+        self.logger.debug(f"{len(self.clients)} files claimed in all")
+        return "ack"
+
+
+    # lease(client, [filename,]): claims exactly these files for client,
+    #    for as long as it renews the lease; returns the lease's token
+    def handle_lease(self, args):
+        client, files = args[:2]
+        token = os.urandom(8).hex()
+        self.leases[client] = [ token, time.time() + self.rescan ]
+        files = set(files)
+        with self.clients.snapshot() as clients:
+            stale = [ filename for filename, claims in clients.items() \
+                        if client in claims and filename not in files ]
+        for filename in stale:
+            self.clients.modify(filename, unclaimer(client), {})
         for filename in files:
-            if filename not in self.clients:
-                self.clients[filename] = {}
-            self.clients[filename][client] = time.time() + self.rescan
+            self.clients.modify(filename,
+                lambda claims: { **claims, client: None }, {})
+        self.logger.debug(f"leased {len(files)} files to {client}")
         self.stats['files claimed'].incr(len(files))
-        self.logger.debug(str(self.clients.data)[:200])
+        self.stats['files unclaimed'].incr(len(stale))
+        return token
+
+
+    # renew lease(client, token, [added,], [removed,]): extends the lease,
+    #    and every claim under it; returns "ack", or "expired" if the
+    #    client has to take a new lease()
+    def handle_renew_lease(self, args):
+        client, token, added, removed = args[:4]
+        lease = self.leases.get(client)
+        if lease is None or lease[0] != token or lease[1] < time.time():
+            return "expired"
+        self.leases[client] = [ token, time.time() + self.rescan ]
+        for filename in added:
+            self.clients.modify(filename,
+                lambda claims: { **claims, client: None }, {})
+        for filename in removed:
+            self.clients.modify(filename, unclaimer(client), {})
+        self.stats['files claimed'].incr(len(added))
+        self.stats['files unclaimed'].incr(len(removed))
         return "ack"
 
 
@@ -110,47 +238,58 @@ class Servlet(Thread):
         n = len(files)
         self.logger.debug(f"unclaiming {n} files for client {client}")
         for filename in files:
-            if filename in self.clients:
-                if len(self.clients[filename]) < self.copies:
+            claims = self.clients.get(filename)
+            if claims is not None:
+                if len(claims) < self.copies:
                     self.logger.warn(f"WARNING: {client} dropping {filename} prematurely\n" * 10)
-                if client in self.clients[filename]:
-                    del self.clients[filename][client]
+                if client in claims:
+                    self.clients.modify(filename, unclaimer(client), {})
         self.stats['files unclaimed'].incr(n)
         return "ack"
         
 
-    # unclaim_all(client): deletes all claims for this client
+    # unclaim_all(client): deletes all claims (and the lease) for this client
     #     returns "ack" or None
     def handle_unclaim_all(self, args):
         client = args[0]
-
-        for filename in self.clients.keys():
-            if client in self.clients[filename]:
-                del self.clients[filename][client]
-                self.stats['files unclaimed'].incr(1)
+        if client in self.leases:
+            del self.leases[client]
+
+        with self.clients.snapshot() as clients:
+            claimed = [ filename for filename, claims in clients.items() \
+                            if client in claims ]
+        for filename in claimed:
+            self.clients.modify(filename, unclaimer(client), {})
+        self.stats['files unclaimed'].incr(len(claimed))
         return "ack" 
 
 
-    def histogram(self):
-        hist = f"{len(self.scanner)} total files, need {self.copies} copies\n"
+    # { ncopies: number of files }, { ncopies: bytes in those files }
+    def copy_buckets(self):
         buckets = { 0: 0 }
         bucketsize = { 0: 0 }
         self.expire_claims()
 
-        with self.scanner:
-            scanned_files = self.scanner.keys()
-        for filename in scanned_files:
-            size = self.scanner[filename]
-            if filename in self.clients:
-                bucket = len(self.clients[filename])
-                if bucket not in buckets:
-                    buckets[bucket] = 0
-                    bucketsize[bucket] = 0
-                buckets[bucket] += 1
-                bucketsize[bucket] += size
-            else:
-                buckets[0] += 1
-                bucketsize[0] += size
+        with self.scanner.snapshot() as files, \
+                self.clients.snapshot() as clients:
+            for filename, size in files.items():
+                if filename in clients:
+                    bucket = len(clients[filename])
+                    if bucket not in buckets:
+                        buckets[bucket] = 0
+                        bucketsize[bucket] = 0
+                    buckets[bucket] += 1
+                    bucketsize[bucket] += size
+                else:
+                    buckets[0] += 1
+                    bucketsize[0] += size
+        return buckets, bucketsize
+
+
+    def histogram(self):
+        hist = f"{len(self.scanner)} total files, need {self.copies} copies\n"
+        buckets, bucketsize = self.copy_buckets()
+        self.publish_buckets(buckets, bucketsize)
         for bucket in sorted(buckets.keys(), reverse=True):
             if buckets[bucket]:
                 size = utils.bytes_to_str(bucketsize[bucket])
@@ -162,17 +301,32 @@ class Servlet(Thread):
         return hist
 
 
+    # the audit's numbers, for /metrics; buckets that emptied go to 0
+    def publish_buckets(self, buckets, bucketsize):
+        for bucket in set(self.buckets) | set(buckets):
+            self.metrics.gauge("cb_copy_bucket_files",
+                                "files with this many copies",
+                                context=self.context, copies=bucket) \
+                .set(buckets.get(bucket, 0))
+            self.metrics.gauge("cb_copy_bucket_bytes",
+                                "bytes in files with this many copies",
+                                context=self.context, copies=bucket) \
+                .set(bucketsize.get(bucket, 0))
+        self.buckets = buckets
+
+
     def dump(self):
         message = ""
-        for filename in self.clients:
-            message += f"{filename}: "
-            for client in sorted(self.clients[filename].keys()):
-                stamp = self.clients[filename][client]
-                if stamp < time.time():
-                    message += f"{client}! "
-                else:
-                    message += f"{client} "
-            message += "\n"
+        with self.clients.snapshot() as clients:
+            for filename, claims in clients.items():
+                message += f"{filename}: "
+                for client in sorted(claims.keys()):
+                    stamp = claims[client]
+                    if stamp is not None and stamp < time.time():
+                        message += f"{client}! "
+                    else:
+                        message += f"{client} "
+                message += "\n"
         return message
                 
 
@@ -185,6 +339,77 @@ class Servlet(Thread):
 
 
 
+    # only hand out files I've scanned: no ../ games
+    def local_path(self, filename):
+        if filename not in self.scanner:
+            return None
+        return f"{self.path}/{filename}"
+
+
+    # checksum(client, filename): { size, mtime, checksum, algorithm } in
+    #    the "HASH" algorithm; cached while the file's size and mtime stay
+    def handle_checksum(self, args):
+        client_context, filename = args
+        path = self.local_path(filename)
+        if path is None:
+            return None
+        algorithm = file_state.hash_algorithm()
+        try:
+            stat = os.stat(path)
+            data = { 'dev': stat.st_dev, 'ino': stat.st_ino,
+                     'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns }
+            checksum = self.checksums.lookup(data)
+            if checksum is None:
+                checksum = file_state.sum_hash(path, algorithm)
+                after = os.stat(path)
+                if (after.st_size, after.st_mtime_ns) != \
+                        (stat.st_size, stat.st_mtime_ns):
+                    return None     # changed under us; the client retries
+                self.checksums.store({ **data, 'checksum': checksum,
+                                       'algorithm': algorithm })
+        except OSError:
+            self.logger.exception(f"checksumming {filename}")
+            return None
+        if checksum is None:
+            return None
+        return { 'size': stat.st_size, 'mtime': stat.st_mtime,
+                 'checksum': checksum, 'algorithm': algorithm }
+
+
+    def handle_read_range(self, args):
+        client_context, filename, offset, length = args
+        path = self.local_path(filename)
+        if path is None:
+            return None
+        try:
+            size = os.path.getsize(path)
+        except OSError:
+            return None
+        offset = min(max(int(offset), 0), size)
+        length = min(max(int(length), 0), size - offset)
+        return FileRange(path, offset, length)
+
+
+    def handle_bundle(self, args):
+        client_context, filenames = args
+        filenames = [ filename for filename in filenames \
+                        if self.local_path(filename) is not None ]
+        return Bundle(self.path, filenames)
+
+
+    def handle_bandwidth(self, args):
+        client_context = args[0]
+        if self.broker is None:
+            return 0
+        return self.broker.grant(client_context)
+
+
+    def handle_profile(self, args):
+        client_context, seconds = args[:2]
+        self.logger.info(f"{client_context} asked for a {seconds}s profile")
+        return profiler.start(seconds=min(float(seconds), 3600), name="server")
+
+
     # handle an incoming action(args)
     # called in parallel from many serving threads
     def handle(self, action, args):
@@ -195,29 +420,49 @@ class Servlet(Thread):
                     'claim':        self.handle_claim,
                     'unclaim':      self.handle_unclaim,
                     'unclaim all':  self.handle_unclaim_all,
+                    'lease':        self.handle_lease,
+                    'renew lease':  self.handle_renew_lease,
                     'metadata':     self.handle_metadata,
+                    'checksum':     self.handle_checksum,
+                    'read range':   self.handle_read_range,
+                    'bundle':       self.handle_bundle,
+                    'bandwidth':    self.handle_bandwidth,
+                    'profile':      self.handle_profile,
                    }
         response = actions[action](args)
         # self.logger.debug(f"responding: {action} {args} -> {response}")
         return response
 
 
+    def publish_scan(self, duration):
+        nfiles = len(self.scanner)
+        self.metrics.gauge("cb_scan_seconds", "duration of the last scan",
+                            context=self.context).set(duration)
+        self.metrics.gauge("cb_scan_files", "files found by the last scan",
+                            context=self.context).set(nfiles)
+        self.metrics.gauge("cb_scan_files_per_second",
+                            "scan rate of the last scan",
+                            context=self.context).set(nfiles / max(duration, 1e-6))
+
+
     # Server will call into my datagram functions; I just brood
     def run(self):
-        self.bailout = False
         # pre-scan
         self.scanner.scan()
         self.logger.info("Ready to serve")
-        self.handling = True
+        self.handling = not self.bailout
         while not self.bailout:
             timer = elapsed.ElapsedTimer()
-            self.config.load()
-            self.rescan = utils.get_interval(self.config, "rescan", self.context)
-            self.scanner.scan()
+            with tracing.span("scan", context=self.context):
+                self.scanner.scan()
+            self.publish_scan(timer.elapsed())
+            self.checksums.prune()
+            self.checksums.clear_dirtybits()
             sleepy_time = max(self.rescan - timer.elapsed(), 10)
             sleep_msg = utils.duration_to_str(sleepy_time)
             self.logger.info(f"sleeping {sleep_msg} til next rescan")
-            time.sleep(sleepy_time)
+            self.wakeup.wait(sleepy_time)
+        self.logger.info("Stopped")
 
 
  #####
@@ -229,34 +474,219 @@ class Servlet(Thread):
  #####  ###### #    #   ##   ###### #    #
 
 
-# https://ruslanspivak.com/lsbaws-part1/
+# GET /metrics: metrics.Registry, Prometheus text format
+# GET /status:  each servlet's last audit histogram
+# on "METRICS PORT" (default 0: off)
 class WebServer(Thread):
     def __init__(self, servlets, port=8888):
-        super().__init__()
-        self.servlets = {}
+        super().__init__(daemon=True)
+        self.servlets = servlets
         self.port = port
         self.logger = logging.getLogger(utils.logger_str(__class__))
+        self.httpd = HTTPServer(("", port), self.request_handler())
+        self.port = self.httpd.server_address[1]
+
+
+    def request_handler(self):
+        web_server = self
+
+        class RequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path == "/metrics":
+                    body = metrics.Registry.instance().render()
+                    content_type = "text/plain; version=0.0.4"
+                elif self.path in ("/", "/status"):
+                    body = web_server.status()
+                    content_type = "text/plain"
+                else:
+                    self.send_error(404)
+                    return
+                body = body.encode()
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                web_server.logger.debug(format % args)
+
+        return RequestHandler
+
+
+    # from the last audit; nothing is recounted here
+    def status(self):
+        status = ""
+        for context, servlet in list(self.servlets.items()):
+            status += f"{context} {servlet.path}: {servlet.copies} copies\n"
+            for bucket in sorted(servlet.buckets, reverse=True):
+                status += f"{servlet.buckets[bucket]:8d} files with {bucket}\n"
+        return status
 
 
     def run(self):
-        listen_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        listen_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        listen_socket.bind(("", self.port))
-        listen_socket.listen(1)
         self.logger.info(f"Serving HTTP on 0:{self.port}")
+        self.httpd.serve_forever()
+
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+
+# "SERVLET PROCESSES: n" (default 0: threads, in-process) runs the
+# servlets in n worker processes instead, context -> process
+# int(context, 16) % n, so one context's bz2 writes, scans and listings
+# don't hold the GIL while another's requests wait.  The Server stays
+# the front end: it owns the Datagram port, the bandwidth Broker and the
+# metrics, and relays each request over a per-thread unix socket.
+# Servlet-side gauges (copy buckets, scans) stay in the workers.
+
+# a response as it crosses the process boundary
+def to_wire(response):
+    if isinstance(response, FileRange):
+        return [ "range", response.path, response.offset, response.length ]
+    if isinstance(response, Bundle):
+        return [ "bundle", response.path, response.filenames ]
+    return [ "value", response ]
+
+
+def from_wire(reply):
+    if reply is None:
+        return None
+    kind, *fields = reply
+    if kind == "range":
+        return FileRange(*fields)
+    if kind == "bundle":
+        return Bundle(*fields)
+    return fields[0]
+
+
+# front-end stand-in for a Servlet in a ServletShard
+class RemoteServlet:
+    def __init__(self, shard, context):
+        self.shard = shard
+        self.context = context
+        cfg = config.Config.instance()
+        self.path = config.path_for(cfg.get(context, "source"))
+        self.copies = int(cfg.get(context, "copies", 2))
+        self.buckets = {}
+        self.broker = None
+
+
+    def start(self):
+        self.shard.call("start", self.context)
+
+
+    def stop(self):
+        self.shard.call("stop", self.context)
+
+
+    def audit(self):
+        pass        # the shard audits its own
+
+
+    def handle(self, action, args):
+        if action == 'bandwidth':       # one budget for the whole host
+            return self.broker.grant(args[0]) if self.broker else 0
+        return from_wire(self.shard.call("handle", self.context, action, args))
+
+
+# a worker process, and the front end's connections to it
+class ServletShard:
+    def __init__(self, index):
+        self.logger = logging.getLogger(f"{utils.logger_str(__class__)} {index}")
+        self.address = f"{tempfile.gettempdir()}/cb.servlets-{os.getpid()}-{index}"
+        self.authkey = os.urandom(16)
+        self.local = threading.local()
+        cfg = config.Config.instance()
+        spawn = multiprocessing.get_context("spawn")
+        self.process = spawn.Process(target=serve_shard, daemon=True,
+                            name=f"servlets-{index}",
+                            args=(cfg.filename, cfg.primary_keys, cfg.hostname,
+                                    cfg.testing, self.address, self.authkey))
+        self.process.start()
+
+
+    def connection(self):
+        if not hasattr(self.local, "connection"):
+            deadline = time.time() + 60
+            while True:
+                try:
+                    self.local.connection = multiprocessing.connection.Client(
+                                            self.address, authkey=self.authkey)
+                    break
+                except (FileNotFoundError, ConnectionRefusedError):
+                    if time.time() > deadline or not self.process.is_alive():
+                        raise
+                    time.sleep(0.1)
+        return self.local.connection
+
+
+    def call(self, *request):
+        try:
+            connection = self.connection()
+            connection.send(request)
+            return connection.recv()
+        except (OSError, EOFError):
+            self.logger.exception(f"lost the servlet process on {request[:3]}")
+            if hasattr(self.local, "connection"):
+                self.local.connection.close()
+                del self.local.connection
+            return None
+
+
+    def stop(self):
+        self.process.terminate()
+        self.process.join()
+        if os.path.exists(self.address):
+            os.remove(self.address)
+
+
+# a ServletShard's process: servlets, their audits, and a thread per
+#   front-end connection
+def serve_shard(filename, primary_keys, hostname, testing, address, authkey):
+    logging.basicConfig(format='%(asctime)s [%(name)s] %(message)s',
+                            level=logging.INFO)
+    cfg = config.Config.instance()
+    cfg.init(filename, *primary_keys, hostname=hostname, testing=testing)
+    tracing.configure()
+    listener = multiprocessing.connection.Listener(address, family="AF_UNIX",
+                                                    authkey=authkey)
+    servlets = {}
+
+    def serve(connection):
+        try:
+            while True:
+                command, context, *request = connection.recv()
+                if command == "handle":
+                    servlet = servlets.get(context)
+                    response = servlet.handle(*request) if servlet else None
+                    connection.send(to_wire(response))
+                elif command == "start":
+                    if context not in servlets:
+                        servlets[context] = Servlet(context)
+                        servlets[context].start()
+                    connection.send("ack")
+                elif command == "stop":
+                    if context in servlets:
+                        servlets.pop(context).stop()
+                    connection.send("ack")
+        except (EOFError, OSError):
+            connection.close()
+
+    def auditor():
         while True:
-            client_connection, client_address = listen_socket.accept()
-            request = client_connection.recv(1024)
-            self.logger.debug(request)
+            time.sleep(15)
+            cfg.load()
+            for servlet in list(servlets.values()):
+                servlet.audit()
 
-            http_response = """\
-        HTTP/1.1 200 OK
+    _thread.start_new_thread(auditor, ())
+    while True:
+        _thread.start_new_thread(serve, (listener.accept(), ))
 
-        Hello, World!
-        """
-            client_connection.sendall(bytes(http_response, 'ascii'))
-            client_connection.close()
-        
 
 class Server(Thread):
     def __init__(self, hostname):
@@ -267,8 +697,14 @@ class Server(Thread):
         # self.logger.setLevel(logging.INFO)
         self.contexts = self.get_contexts()
         self.servlets = {}
+        self.broker = bandwidth.Broker()
+        self.metrics = metrics.Registry.instance()
+        self.running = False
+        self.shards = [ ServletShard(i) for i in \
+                        range(int(self.config.get("global", "SERVLET PROCESSES", 0))) ]
         self.build_servlets()
         self.stats = stats.Stats()
+        self.config.subscribe(self.reconfigure, ("source", ))
 
 
     def get_contexts(self):
@@ -283,16 +719,45 @@ class Server(Thread):
 
     def build_servlets(self):
         for context in self.contexts:
-            self.servlets[context] = Servlet(context)
+            self.add_servlet(context)
+
+
+    def add_servlet(self, context):
+        if self.shards:
+            shard = self.shards[int(context, 16) % len(self.shards)]
+            servlet = RemoteServlet(shard, context)
+        else:
+            servlet = Servlet(context)
+        servlet.broker = self.broker
+        self.servlets[context] = servlet
+        return servlet
+
+
+    # Config subscriber: sources came or went; spin servlets up or down
+    def reconfigure(self, changes):
+        self.contexts = self.get_contexts()
+        for context in self.contexts:
+            if context not in self.servlets:
+                self.logger.info(f"new source {self.contexts[context]}")
+                servlet = self.add_servlet(context)
+                if self.running:
+                    servlet.start()
+        for context in list(self.servlets):
+            if context not in self.contexts:
+                self.logger.info(f"source {context} is gone")
+                self.servlets.pop(context).stop()
 
 
     def auditor(self):
         timer = elapsed.ElapsedTimer()
         while True:
             time.sleep(15)
+            self.config.load()      # subscribers do the rest
             self.logger.info(f"aggregate qps: {self.stats['handler'].qps()}")
+            for labels, latency in self.metrics.series("cb_handle_seconds").items():
+                self.logger.info(f"{dict(labels)['action']} latency: {latency}")
             self.logger.info("Servlet status update: ")
-            for context, servlet in self.servlets.items():
+            for context, servlet in list(self.servlets.items()):
                 self.logger.info(f"{context} qps: {self.stats[context].qps()}")
                 servlet.audit()
 
@@ -300,18 +765,36 @@ class Server(Thread):
     # client sends to a specific server context
     # [ action, server context, client context, arguments ]
     def handle(self, request):
+        request, parent = tracing.extract(request)
         action, server_context = request[:2]
         args = request[2:]
-        if server_context not in self.servlets:
+        servlet = self.servlets.get(server_context)
+        if servlet is None:
             return None
         self.logger.log(5, f"acting: {server_context} => {action}({args})")
         self.stats[server_context].incr(1)
-        response = self.servlets[server_context].handle(action, args)
-
+        self.metrics.counter("cb_requests_total", "requests handled",
+                                context=server_context, action=action).incr()
+        latency = self.metrics.summary("cb_handle_seconds",
+                                        "time to handle a request, by action",
+                                        action=action)
+        with latency.timer(), tracing.span(f"handle {action}", parent=parent,
+                                            context=server_context):
+            response = servlet.handle(action, args)
         return response
 
 
     def handler(self, datagram):
+        connections = self.metrics.gauge("cb_open_connections",
+                                            "open client connections")
+        connections.incr()
+        try:
+            self.serve_connection(datagram)
+        finally:
+            connections.decr()
+
+
+    def serve_connection(self, datagram):
         while datagram:
             self.stats['handler'].incr(1)
             request = datagram.value()
@@ -319,6 +802,14 @@ class Server(Thread):
                 self.logger.debug(f"received {str(request)[:140]}...")
                 self.logger.log(5, f"received {str(request)}...")
                 response = self.handle(request)
+                if isinstance(response, FileRange):
+                    self.stream(datagram, response)
+                    datagram.receive()
+                    continue
+                if isinstance(response, Bundle):
+                    self.stream_bundle(datagram, response)
+                    datagram.receive()
+                    continue
                 self.logger.debug(f"returning {str(response)[:140]}...")
                 self.logger.log(5, f"returning {str(response)}...")
                 datagram.respond(response)
@@ -329,6 +820,45 @@ class Server(Thread):
         datagram.close()
 
 
+    # [ offset, length ], then the bytes themselves
+    def stream(self, datagram, file_range):
+        try:
+            with open(file_range.path, "rb") as f:
+                datagram.respond([ file_range.offset, file_range.length ])
+                datagram.send_file(f, file_range.offset, file_range.length,
+                                    throttle=self.broker.bucket.take)
+        except OSError:
+            self.logger.exception(f"streaming {file_range.path}")
+            datagram.respond(None)
+
+
+    # [ filename, ], then the tar; a file that's vanished is just left out
+    def stream_bundle(self, datagram, bundle):
+        datagram.respond(bundle.filenames)
+        writer = DatagramWriter(datagram, throttle=self.broker.bucket.take)
+        try:
+            with tarfile.open(fileobj=writer, mode="w|", bufsize=2**20) as tar:
+                for filename in bundle.filenames:
+                    try:
+                        f = open(f"{bundle.path}/{filename}", "rb")
+                    except OSError:
+                        self.logger.debug(f"bundle: skipping {filename}")
+                        continue
+                    # the header's size is fstat's; more is cut off, less
+                    #   (it shrank) raises, below: there's no skipping a
+                    #   member that's half written
+                    with f:
+                        info = tar.gettarinfo(arcname=filename, fileobj=f)
+                        tar.addfile(info, f)
+            writer.close()
+        except BrokenPipeError:
+            self.logger.debug("bundle: client went away")
+        except OSError:
+            self.logger.info("bundle: a file changed as it was sent; " \
+                             "ending the bundle", exc_info=True)
+            datagram.close()
+
+
     def serve(self):
         ADDRESS = self.hostname
         PORT = int(self.config.get("global", "PORT", "5005"))
@@ -345,11 +875,13 @@ class Server(Thread):
         if not self.servlets:
             self.logger.info("No serving tasks; exiting Server")
             return
-        for context, servlet in self.servlets.items():
+        self.running = True
+        for context, servlet in list(self.servlets.items()):
             servlet.start()
         _thread.start_new_thread(self.auditor, ())
-        # ws = WebServer(self.servlets)
-        # ws.start()
+        port = int(self.config.get("global", "METRICS PORT", 0))
+        if port:
+            WebServer(self.servlets, port).start()
         self.serve() # forever
 
 
@@ -401,6 +933,8 @@ def main(args):
     assert type(options["hostname"]) is str
 
     cfg.init(options['configfile'], "source", "backup")
+    tracing.configure()
+    profiler.install("server")
 
     s = Server(options['hostname'])
     s.start()
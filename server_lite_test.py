@@ -0,0 +1,144 @@
+#!/usr/bin/env python3
+
+import unittest, logging, tempfile, threading, time, os
+import config, server_lite
+
+class TestClaims(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(format='%(asctime)s [%(name)s] %(message)s',
+                            level=logging.ERROR)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        source = f"{self.tmpdir.name}/source"
+        os.makedirs(source)
+        self.files = [ f"{i:04d}" for i in range(500) ]
+        for filename in self.files:
+            with open(f"{source}/{filename}", "wb") as f:
+                f.write(b"\0" * 100)
+        filename = f"{self.tmpdir.name}/config.txt"
+        with open(filename, "w") as f:
+            f.write(f"rescan: 1h\n")
+            f.write(f"source: localhost:{source}\n")
+        cfg = config.Config.instance()
+        cfg.init(filename, "source", "backup", hostname="localhost")
+        self.context = list(cfg.get_contexts_for_key("source"))[0]
+        self.servlet = server_lite.Servlet(self.context)
+        self.servlet.scanner.scan()
+        self.servlet.handling = True
+
+    def tearDown(self):
+        self.servlet.stop()
+        self.tmpdir.cleanup()
+        for state in ("clients", "leases", "checksums"):
+            filename = f"/tmp/cb.{self.context}-{state}.json.bz2"
+            if os.path.exists(filename):
+                os.remove(filename)
+        config.Config.instance().reset()
+
+
+    # claimers, unclaimers and listers all at once: nothing may see a
+    #   dict change under it, and no claim may be lost
+    def test_stress(self):
+        servlet = self.servlet
+        errors = []
+        counts = { 'claim': 0, 'list': 0 }
+        deadline = time.monotonic() + 2
+        clients = [ f"client {i}" for i in range(6) ]
+
+        def claimer(client):
+            try:
+                odd = self.files[1::2]
+                while time.monotonic() < deadline:
+                    servlet.handle("claim", [ client, self.files ])
+                    servlet.handle("unclaim", [ client, odd ])
+                    counts['claim'] += 1
+                servlet.handle("claim", [ client, self.files[::2] ])
+            except Exception as e:
+                errors.append(e)
+
+        def lister():
+            try:
+                while time.monotonic() < deadline:
+                    listing = servlet.handle("list", [ "lister" ])
+                    self.assertEqual(len(listing), len(self.files))
+                    servlet.copy_buckets()
+                    servlet.handle("unclaim all", [ "nobody" ])
+                    counts['list'] += 1
+            except Exception as e:
+                errors.append(e)
+
+        threads = [ threading.Thread(target=claimer, args=(client, )) \
+                        for client in clients ]
+        threads += [ threading.Thread(target=lister) for i in range(3) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(errors, [])
+
+        listing = servlet.handle("list", [ "lister" ])
+        for i, filename in enumerate(self.files):
+            self.assertEqual(listing[filename][1],
+                                len(clients) if i % 2 == 0 else 0)
+        self.assertGreater(counts['claim'], 0)
+        self.assertGreater(counts['list'], 0)
+
+        servlet.handle("unclaim all", [ clients[0] ])
+        listing = servlet.handle("list", [ "lister" ])
+        self.assertEqual(listing[self.files[0]][1], len(clients) - 1)
+
+
+    def test_lease(self):
+        servlet = self.servlet
+        def nclaims(filename):
+            return servlet.handle("list", [ "lister" ])[filename][1]
+
+        token = servlet.handle("lease", [ "a", self.files[:3] ])
+        servlet.handle("claim", [ "b", self.files[:1] ])
+        self.assertEqual(nclaims(self.files[0]), 2)
+        self.assertEqual(servlet.handle("renew lease",
+                            [ "a", token, self.files[3:4], self.files[:1] ]),
+                            "ack")
+        self.assertEqual(nclaims(self.files[0]), 1)
+        self.assertEqual(nclaims(self.files[3]), 1)
+        self.assertEqual(servlet.handle("renew lease",
+                            [ "a", "stale token", [], [] ]), "expired")
+
+        # a lapsed lease takes every claim under it, and only those
+        servlet.leases["a"] = [ token, time.time() - 1 ]
+        self.assertEqual(nclaims(self.files[1]), 0)
+        self.assertEqual(nclaims(self.files[0]), 1)         # b's
+        self.assertNotIn("a", servlet.leases)
+        self.assertEqual(servlet.handle("renew lease", [ "a", token, [], [] ]),
+                            "expired")
+
+        # a new lease replaces whatever was claimed before
+        servlet.handle("lease", [ "b", self.files[5:6] ])
+        self.assertEqual(nclaims(self.files[0]), 0)
+        self.assertEqual(nclaims(self.files[5]), 1)
+        servlet.handle("unclaim all", [ "b" ])
+        self.assertEqual(nclaims(self.files[5]), 0)
+        self.assertNotIn("b", servlet.leases)
+
+
+    # a lease() landing between expire_claims' scan and its modify()s
+    #   keeps the claims it just made
+    def test_lease_race(self):
+        servlet = self.servlet
+        token = servlet.handle("lease", [ "a", self.files[:3] ])
+        servlet.leases["a"] = [ token, time.time() - 1 ]
+        modify = servlet.clients.modify
+        def leasing_modify(*args):
+            servlet.clients.modify = modify
+            servlet.handle("lease", [ "a", self.files[:3] ])
+            modify(*args)
+        servlet.clients.modify = leasing_modify
+        servlet.expire_claims()
+        self.assertIs(servlet.clients.modify, modify)       # it ran
+        listing = servlet.handle("list", [ "lister" ])
+        for filename in self.files[:3]:
+            self.assertEqual(listing[filename][1], 1)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,336 @@
+#!/usr/bin/env python3
+
+"""
+Offline planner simulator: N sources, M clientlets, one process,
+no network, no rsync, no real files.
+
+    cluster = SimCluster(nsources=3, nbackups=4, nfiles=1000,
+                         copies=2, allocation="5g")
+    report = cluster.run(max_rounds=20)
+    print(cluster.summary(report))
+
+Sources are real server_lite.Servlets (fed a synthetic inventory);
+clientlets are real client_lite.Clientlets whose send() calls straight
+into the servlets and whose "rsync" just records the files in their
+(in-memory) scanners.  Each round, every clientlet crawls once.
+
+Reports per round and in total:
+    bytes copied
+    bytes churned (copied by the simulation, then dropped again)
+    planner CPU time (Clientlet.plan())
+and the round in which the cluster converged (nobody copied or dropped).
+
+File sizes come from a distribution:
+    fixed       every file is MEAN bytes
+    uniform     1 .. 2*MEAN
+    lognormal   lognormal around MEAN (lots of small, a few huge)
+"""
+
+import os, json, math, random, time, tempfile, shutil, logging
+import config, scanner, client_lite, server_lite, utils
+from utils import bytes_to_str, str_to_bytes
+
+
+# just enough of a Datagram for Clientlet: truthy, value(), len()
+class SimDatagram:
+    def __init__(self, value):
+        # round-trip like the wire would (tuples -> lists, etc)
+        self.data = json.loads(json.dumps(value))
+
+
+    def value(self):
+        return self.data
+
+
+    def __bool__(self):
+        return True
+
+
+    def __len__(self):
+        if not self.data:
+            return 0
+        return len(self.data)
+
+
+# a ScannerLite which never looks at the disk: what the simulation
+# "copied" is what it has
+class SimScanner(scanner.ScannerLite):
+    def __init__(self, *args, on_drop=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_drop = on_drop
+
+
+    def scan(self, **kwargs):
+        return False
+
+
+    def drop(self, filename):
+        if filename in self:
+            size = self[filename]
+            del self[filename]
+            if self.on_drop:
+                self.on_drop(self.context, filename, size)
+
+
+class SimServlet(server_lite.Servlet):
+    def __init__(self, context, files):
+        super().__init__(context)
+        for filename, size in files.items():
+            self.scanner[filename] = size
+        self.handling = True
+
+
+class SimClientlet(client_lite.Clientlet):
+    def __init__(self, context, cluster):
+        self.cluster = cluster
+        super().__init__(context)
+
+
+    def build_sources(self):
+        super().build_sources()
+        for source_context in self.scanners:
+            self.scanners[source_context] = \
+                SimScanner(source_context, self.paths[source_context],
+                            pd_path=self.path, loglevel=logging.WARNING,
+                            name=f"{self.context}:{source_context}",
+                            on_drop=self.dropped)
+
+
+    def dropped(self, source_context, filename, size):
+        self.cluster.record_drop(self.context, source_context, filename, size)
+
+
+    # "transport": straight into the servlet, as Server.handle would
+    def send(self, source_context, command, *args):
+        servlet = self.cluster.servlets[source_context]
+        response = servlet.handle(command, [ self.context ] + list(args))
+        return SimDatagram(response)
+
+
+    # "copy": anything I intend to have, and don't, I now have
+    def rsync_everything(self):
+        for source_context in self.backups:
+            scanner = self.scanners[source_context]
+            for filename, size in list(self.backups[source_context].items()):
+                if filename not in scanner:
+                    scanner[filename] = size
+                    self.cluster.record_copy(self.context, source_context,
+                                                filename, size)
+
+
+class SimCluster:
+    def __init__(self, nsources=3, nbackups=4, nfiles=1000, copies=2,
+                    allocation="10g", distribution="lognormal",
+                    mean="4m", seed=0):
+        self.logger = logging.getLogger(utils.logger_str(__class__))
+        self.random = random.Random(seed)
+        self.mean = str_to_bytes(mean)
+        self.distribution = distribution
+        self.tmpdir = tempfile.mkdtemp(prefix="cb-sim.")
+        self.configure(nsources, nbackups, copies, allocation)
+        self.reset_counters()
+
+        cfg = config.Config.instance()
+        self.servlets = {}
+        for source_context in sorted(cfg.get_contexts_for_key("source")):
+            files = { f"file-{i:08d}": self.filesize() for i in range(nfiles) }
+            self.servlets[source_context] = SimServlet(source_context, files)
+        self.clientlets = {}
+        for context in sorted(cfg.get_contexts_for_key("backup")):
+            self.clientlets[context] = SimClientlet(context, self)
+
+
+    def configure(self, nsources, nbackups, copies, allocation):
+        filename = f"{self.tmpdir}/sim-config.txt"
+        with open(filename, "w") as f:
+            f.write("LAZY WRITE: 1d\n")
+            f.write("rescan: 1h\n")
+            for i in range(nsources):
+                f.write(f"source: sim:{self.tmpdir}/source{i}\n")
+                f.write(f"copies: {copies}\n")
+            for i in range(nbackups):
+                os.makedirs(f"{self.tmpdir}/backup{i}")
+                f.write(f"backup: sim:{self.tmpdir}/backup{i}\n")
+                f.write(f"size: {allocation}\n")
+        cfg = config.Config.instance()
+        cfg.init(filename, "source", "backup", hostname="sim")
+
+
+    def filesize(self):
+        if self.distribution == "fixed":
+            return self.mean
+        if self.distribution == "uniform":
+            return self.random.randint(1, 2*self.mean)
+        if self.distribution == "lognormal":
+            # sigma=1.5: median ~mean/3, a long tail of big files
+            sigma = 1.5
+            mu = math.log(self.mean) - sigma**2/2
+            return max(1, int(self.random.lognormvariate(mu, sigma)))
+        raise ValueError(f"unknown distribution {self.distribution}")
+
+
+    def reset_counters(self):
+        self.copied = {}    # { (client, source, filename): size }
+        self.bytes_copied = 0
+        self.bytes_churned = 0
+        self.ncopies = 0
+        self.ndrops = 0
+
+
+    def record_copy(self, context, source_context, filename, size):
+        self.copied[(context, source_context, filename)] = size
+        self.bytes_copied += size
+        self.ncopies += 1
+
+
+    def record_drop(self, context, source_context, filename, size):
+        self.ndrops += 1
+        if (context, source_context, filename) in self.copied:
+            del self.copied[(context, source_context, filename)]
+            self.bytes_churned += size
+
+
+    # one crawl per clientlet; returns this round's numbers
+    def round(self):
+        before = (self.bytes_copied, self.bytes_churned,
+                    self.ncopies, self.ndrops)
+        planner = 0
+        for context, clientlet in self.clientlets.items():
+            clientlet.update_allocation()
+            start = time.process_time()
+            clientlet.plan()
+            planner += time.process_time() - start
+            clientlet.execute()
+        return { 'copied': self.bytes_copied - before[0],
+                 'churned': self.bytes_churned - before[1],
+                 'copies': self.ncopies - before[2],
+                 'drops': self.ndrops - before[3],
+                 'planner': planner }
+
+
+    def run(self, max_rounds=20):
+        rounds = []
+        converged = None
+        for i in range(max_rounds):
+            result = self.round()
+            rounds.append(result)
+            self.logger.info(f"round {i+1}: {self.format_round(result)}")
+            if result['copies'] == 0 and result['drops'] == 0:
+                converged = i + 1
+                break
+        return { 'rounds': rounds,
+                 'converged': converged,
+                 'copied': self.bytes_copied,
+                 'churned': self.bytes_churned,
+                 'planner': sum(r['planner'] for r in rounds),
+                 'coverage': self.coverage() }
+
+
+    # { copies: nfiles } across all sources
+    def coverage(self):
+        counts = {}
+        for servlet in self.servlets.values():
+            for filename in servlet.scanner:
+                n = len(servlet.clients[filename]) \
+                    if filename in servlet.clients else 0
+                counts[n] = counts.get(n, 0) + 1
+        return counts
+
+
+    def format_round(self, result):
+        return f"copied {bytes_to_str(result['copied'])} " \
+               f"({result['copies']} files), " \
+               f"churned {bytes_to_str(result['churned'])} " \
+               f"({result['drops']} drops), " \
+               f"planner {result['planner']:.3f}s"
+
+
+    def summary(self, report):
+        message = ""
+        for i, result in enumerate(report['rounds']):
+            message += f"round {i+1:3d}: {self.format_round(result)}\n"
+        if report['converged']:
+            message += f"converged in {report['converged']} rounds\n"
+        else:
+            message += f"did not converge in {len(report['rounds'])} rounds\n"
+        message += f"copied {bytes_to_str(report['copied'])}, " \
+                   f"churned {bytes_to_str(report['churned'])}, " \
+                   f"planner {report['planner']:.3f}s CPU\n"
+        for n in sorted(report['coverage'], reverse=True):
+            message += f"{report['coverage'][n]:8d} files with {n} copies\n"
+        return message
+
+
+    def cleanup(self):
+        for context in self.servlets:
+            for state in ("clients", "leases", "checksums"):
+                filename = f"/tmp/cb.{context}-{state}.json.bz2"
+                if os.path.exists(filename):
+                    os.remove(filename)
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+
+
+#    #   ##   # #    #
+##  ##  #  #  # ##   #
+# ## # #    # # # #  #
+#    # ###### # #  # #
+#    # #    # # #   ##
+#    # #    # # #    #
+
+
+import getopt, sys
+
+
+def getopts():
+    options = { 'nsources': 3, 'nbackups': 4, 'nfiles': 1000, 'copies': 2,
+                'allocation': "10g", 'distribution': "lognormal",
+                'mean': "4m", 'seed': 0, 'rounds': 20, 'verbose': False }
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "s:b:n:c:a:d:m:S:r:v")
+    except getopt.GetoptError as err:
+        print(err)
+        sys.exit(1)
+    for opt, arg in opts:
+        if opt == "-s":
+            options['nsources'] = int(arg)
+        elif opt == "-b":
+            options['nbackups'] = int(arg)
+        elif opt == "-n":
+            options['nfiles'] = int(arg)
+        elif opt == "-c":
+            options['copies'] = int(arg)
+        elif opt == "-a":
+            options['allocation'] = arg
+        elif opt == "-d":
+            options['distribution'] = arg
+        elif opt == "-m":
+            options['mean'] = arg
+        elif opt == "-S":
+            options['seed'] = int(arg)
+        elif opt == "-r":
+            options['rounds'] = int(arg)
+        elif opt == "-v":
+            options['verbose'] = True
+        else:
+            assert False, "Unhandled option"
+    return options
+
+
+def main():
+    options = getopts()
+    level = logging.INFO if options['verbose'] else logging.ERROR
+    logging.basicConfig(format='%(asctime)s [%(name)s] %(message)s',
+                            level=level)
+    rounds = options.pop('rounds')
+    del options['verbose']
+    cluster = SimCluster(**options)
+    try:
+        report = cluster.run(max_rounds=rounds)
+        print(cluster.summary(report), end="")
+    finally:
+        cluster.cleanup()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+
+import unittest, logging
+import config, simulator
+
+class TestMethods(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(format='%(asctime)s [%(name)s] %(message)s',
+                            level=logging.ERROR)
+
+    def tearDown(self):
+        pass
+
+
+    def test_plenty_of_space(self):
+        cluster = simulator.SimCluster(nsources=2, nbackups=3, nfiles=50,
+                                        copies=2, allocation="1g",
+                                        distribution="fixed", mean="1m")
+        try:
+            report = cluster.run(max_rounds=5)
+        finally:
+            cluster.cleanup()
+        self.assertIsNotNone(report['converged'])
+        self.assertEqual(report['churned'], 0)
+        # greedy: everybody holds everything
+        self.assertEqual(report['coverage'], {3: 100})
+        self.assertEqual(report['copied'], 3 * 100 * 2**20)
+
+
+    def test_tight_space(self):
+        # 100 files x 1m x 2 copies == 200m; 3 x 80m is just enough
+        cluster = simulator.SimCluster(nsources=2, nbackups=3, nfiles=50,
+                                        copies=2, allocation="80m",
+                                        distribution="fixed", mean="1m")
+        try:
+            report = cluster.run(max_rounds=10)
+        finally:
+            cluster.cleanup()
+        underserved = sum(n for copies, n in report['coverage'].items() \
+                            if copies < 2)
+        self.assertEqual(underserved, 0)
+        self.assertGreater(report['planner'], 0)
+
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestMethods)
+    unittest.TextTestRunner(verbosity=2).run(suite)
@@ -1,6 +1,19 @@
 #!/usr/bin/env python3
 
-import time, random
+"""
+    stats = Stats()
+    stats['files claimed'].incr(n)          # a Statistic: counts, qps()
+    with stats.histogram('claim').timer():  # a Histogram: latencies
+        ...
+    stats.histogram('claim').percentile(99) # seconds
+
+A Histogram's buckets are log-scaled, each ~9% wider than the last, from
+1us to ~40h: a percentile is good to within a bucket.  Recording is a
+log() and an add under a lock; histograms with the same buckets merge().
+"""
+
+import time, random, math, threading
+from contextlib import contextmanager
 
 # a single event counter
 class Statistic:
@@ -21,10 +34,11 @@ class Statistic:
 
 
     def incr(self, value=1):
+        now = time.time()
         for bucket in self.buckets:
-            if bucket and self.starts[bucket] + bucket < time.time():
+            if bucket and self.starts[bucket] + bucket < now:
                self.data[bucket] = 0
-               self.starts[bucket] = time.time()
+               self.starts[bucket] = now
             self.data[bucket] += value
         return self.data[0]
 
@@ -43,10 +57,103 @@ class Statistic:
         return times
 
 
+# a latency (or any positive value) distribution
+class Histogram:
+    def __init__(self, minimum=1e-6, growth=1.09, nbuckets=300):
+        self.minimum = minimum
+        self.growth = growth
+        self.log_growth = math.log(growth)
+        self.lock = threading.Lock()
+        self.counts = [ 0 ] * nbuckets
+        self.count = 0
+        self.sum = 0
+
+
+    def bucket(self, value):
+        if value <= self.minimum:
+            return 0
+        index = int(math.log(value / self.minimum) / self.log_growth) + 1
+        return min(index, len(self.counts) - 1)
+
+
+    # bucket index's upper edge
+    def bound(self, index):
+        return self.minimum * self.growth ** index
+
+
+    def record(self, value):
+        index = self.bucket(value)
+        with self.lock:
+            self.counts[index] += 1
+            self.count += 1
+            self.sum += value
+
+
+    # with histogram.timer(): ... records the elapsed seconds
+    @contextmanager
+    def timer(self):
+        start = time.monotonic()
+        try:
+            yield self
+        finally:
+            self.record(time.monotonic() - start)
+
+
+    def merge(self, other):
+        assert (self.minimum, self.growth, len(self.counts)) == \
+            (other.minimum, other.growth, len(other.counts)), \
+            "can't merge histograms with different buckets"
+        with other.lock:
+            counts, count, total = list(other.counts), other.count, other.sum
+        with self.lock:
+            for index, n in enumerate(counts):
+                self.counts[index] += n
+            self.count += count
+            self.sum += total
+        return self
+
+
+    def reset(self):
+        with self.lock:
+            self.counts = [ 0 ] * len(self.counts)
+            self.count = 0
+            self.sum = 0
+
+
+    def mean(self):
+        return self.sum / self.count if self.count else 0
+
+
+    # the value p% of recordings are at or below (a bucket's upper edge)
+    def percentile(self, p):
+        with self.lock:
+            counts, count = list(self.counts), self.count
+        if not count:
+            return 0
+        target = max(1, math.ceil(count * p / 100))
+        seen = 0
+        for index, n in enumerate(counts):
+            seen += n
+            if seen >= target:
+                return self.bound(index)
+        return self.bound(len(counts) - 1)
+
+
+    def percentiles(self, ps=(50, 90, 99)):
+        return { p: self.percentile(p) for p in ps }
+
+
+    def __str__(self):
+        ps = ", ".join(f"p{p}={seconds*1000:.1f}ms" \
+                        for p, seconds in self.percentiles().items())
+        return f"n={self.count} {ps}"
+
+
 # holds multiple event counters
 class Stats:
     def __init__(self, *args, **kwargs):
         self.data = {}
+        self.histograms = {}
         self.args = args
         self.kwargs = kwargs
 
@@ -54,6 +161,15 @@ class Stats:
     def reset(self):
         for stat in self.data:
             self.data[stat].set(0)
+        for histogram in self.histograms.values():
+            histogram.reset()
+
+
+    # likewise magic: a new name starts empty
+    def histogram(self, key):
+        if key not in self.histograms:
+            self.histograms.setdefault(key, Histogram())
+        return self.histograms[key]
 
 
     def __setitem__(self, key, value):
@@ -39,6 +39,30 @@ class TestMethods(unittest.TestCase):
         self.assertEqual(int(s['all']), 100)
 
 
+    def test_histogram(self):
+        h = stats.Histogram()
+        for ms in range(1, 101):
+            h.record(ms / 1000)
+        self.assertEqual(h.count, 100)
+        # a bucket is ~9% wide
+        self.assertAlmostEqual(h.percentile(50), 0.050, delta=0.005)
+        self.assertAlmostEqual(h.percentile(99), 0.099, delta=0.009)
+        self.assertGreaterEqual(h.percentile(100), 0.100)
+        other = stats.Histogram()
+        for i in range(100):
+            other.record(10)
+        h.merge(other)
+        self.assertEqual(h.count, 200)
+        self.assertAlmostEqual(h.percentile(90), 10, delta=1)
+        with h.timer():
+            time.sleep(0.01)
+        self.assertEqual(h.count, 201)
+        h.reset()
+        self.assertEqual(h.percentile(50), 0)
+        s = stats.Stats()
+        self.assertIs(s.histogram("claim"), s.histogram("claim"))
+
+
 if __name__ == "__main__":
     suite = unittest.TestLoader().loadTestsFromTestCase(TestMethods)
     unittest.TextTestRunner(verbosity=2).run(suite)
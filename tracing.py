@@ -0,0 +1,278 @@
+#!/usr/bin/env python3
+
+"""
+Spans: where a crawl's time went, across the client and its servers.
+
+    import tracing
+    tracing.configure()         # after cfg.init(); follows "TRACE" changes
+    with tracing.span("plan", context=self.context):
+        with tracing.span("get inventories"):
+            ...
+
+"TRACE" turns it on:
+    TRACE: /var/tmp/cb-trace.jsonl  # spans go to this file (and memory)
+    TRACE: memory                   # only the last RING spans, in memory
+    TRACE SIZE: 10MB                # the file rolls over to .1 at this size
+Unset, span() hands back one shared do-nothing span: a flag check.
+
+A span nests in whatever span is open on its thread, and shares its
+trace id.  Datagram requests carry the open span along: Clientlet.send()
+and Fetcher.request() append header(), a trailing
+    { "__trace__": [ trace id, span id ] }
+and Server.handle() strips it with extract() and opens its span as a
+child.  So a client's trace file and its servers' files can be read
+together:
+
+    ./tracing.py [-t trace id] client.jsonl server.jsonl ...
+
+prints the spans as a tree, heaviest first, with repeated children
+(every "handle list" under one crawl) folded together:
+    crawl                       1  2400.000s 100.0%
+      plan                      1   300.000s  12.5%
+        send list               5   290.000s  12.1%
+          handle list           5   250.000s  10.4%
+"""
+
+import os, sys, json, time, random, threading, logging, getopt, collections
+import config
+
+RING = 10000
+TRAILER = "__trace__"
+
+ENABLED = False
+logger = logging.getLogger("tracing")
+
+
+class Span:
+    def __init__(self, name, trace, parent, attributes):
+        self.name = name
+        self.trace = trace
+        self.parent = parent
+        self.id = f"{random.getrandbits(64):016x}"
+        self.attributes = attributes
+
+
+    def __enter__(self):
+        self.stack = stack()
+        self.stack.append(self)
+        self.start = time.time()
+        self.started = time.monotonic()
+        return self
+
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        duration = time.monotonic() - self.started
+        self.stack.pop()
+        record = { 'trace': self.trace, 'span': self.id,
+                   'parent': self.parent, 'name': self.name,
+                   'start': self.start, 'duration': duration,
+                   'thread': threading.current_thread().name }
+        if self.attributes:
+            record['attributes'] = self.attributes
+        if exc_type is not None:
+            record['error'] = exc_type.__name__
+        TRACER.emit(record)
+
+
+# what span() returns when tracing is off
+class NullSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
+
+
+NULL_SPAN = NullSpan()
+local = threading.local()
+
+
+def stack():
+    if not hasattr(local, "stack"):
+        local.stack = []
+    return local.stack
+
+
+# parent: [ trace id, span id ] from extract(), for a span on behalf of
+#   a remote caller; otherwise the span open on this thread, if any
+def span(name, parent=None, **attributes):
+    if not ENABLED:
+        return NULL_SPAN
+    if parent is None:
+        spans = stack()
+        if spans:
+            parent = [ spans[-1].trace, spans[-1].id ]
+    if parent is None:
+        return Span(name, f"{random.getrandbits(64):016x}", None, attributes)
+    return Span(name, parent[0], parent[1], attributes)
+
+
+# the trailer to append to a request, or None
+def header():
+    if not ENABLED:
+        return None
+    spans = stack()
+    if not spans:
+        return None
+    return { TRAILER: [ spans[-1].trace, spans[-1].id ] }
+
+
+# request, less any trailer -> (request, [ trace id, span id ] or None)
+def extract(request):
+    if request and isinstance(request[-1], dict) and TRAILER in request[-1]:
+        return request[:-1], request[-1][TRAILER]
+    return request, None
+
+
+class Tracer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.ring = collections.deque(maxlen=RING)
+        self.file = None
+        self.filename = None
+        self.max_size = 0
+
+
+    def emit(self, record):
+        with self.lock:
+            self.ring.append(record)
+            if self.file is None:
+                return
+            self.file.write(json.dumps(record) + "\n")
+            if self.file.tell() >= self.max_size:
+                self.rotate()
+
+
+    def rotate(self):
+        self.file.close()
+        os.replace(self.filename, f"{self.filename}.1")
+        self.file = open(self.filename, "a", buffering=1)
+
+
+    def open(self, filename, max_size):
+        with self.lock:
+            self.close_file()
+            self.filename = filename
+            self.max_size = max_size
+            if filename:
+                self.file = open(filename, "a", buffering=1)
+
+
+    def close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+    def records(self):
+        with self.lock:
+            return list(self.ring)
+
+
+TRACER = Tracer()
+
+
+# (re)read "TRACE" and "TRACE SIZE"; called again whenever they change
+def configure(changes=None):
+    global ENABLED
+    cfg = config.Config.instance()
+    if changes is None:
+        cfg.subscribe(configure, ("TRACE", "TRACE SIZE"), ("global", ))
+    where = cfg.get("global", "TRACE")
+    max_size = cfg.get_bytes("global", "TRACE SIZE", "10MB")
+    try:
+        TRACER.open(where if where and where != "memory" else None, max_size)
+    except OSError:
+        logger.exception(f"can't trace to {where}")
+        where = None
+    ENABLED = bool(where)
+    if where:
+        logger.info(f"tracing to {where}")
+
+
+ ####  #    # #    # #    #   ##   #####  #   #
+#      #    # ##  ## ##  ##  #  #  #    #  # #
+ ####  #    # # ## # # ## # #    # #    #   #
+     # #    # #    # #    # ###### #####    #
+#    # #    # #    # #    # #    # #   #    #
+ ####   ####  #    # #    # #    # #    #   #
+
+
+def read(filenames):
+    records = []
+    for filename in filenames:
+        with open(filename) as f:
+            for line in f:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    pass    # a torn last line
+    return records
+
+
+# { path: [ count, seconds ] } where path is a tuple of span names from
+#   the root, for every root in trace (None: the most recent root)
+def fold(records, trace=None):
+    spans = { record['span']: record for record in records }
+    children = collections.defaultdict(list)
+    roots = []
+    for record in records:
+        if record['parent'] in spans:
+            children[record['parent']].append(record)
+        else:
+            roots.append(record)
+    if trace is None and roots:
+        trace = max(roots, key=lambda record: record['start'])['trace']
+    folded = collections.defaultdict(lambda: [ 0, 0 ])
+
+    def walk(record, path):
+        path = path + (record['name'], )
+        folded[path][0] += 1
+        folded[path][1] += record['duration']
+        for child in children[record['span']]:
+            walk(child, path)
+
+    for root in roots:
+        if root['trace'] == trace:
+            walk(root, ())
+    return folded
+
+
+def report(folded):
+    total = sum(seconds for path, (count, seconds) in folded.items() \
+                    if len(path) == 1) or 1
+    lines = []
+
+    def walk(path):
+        kids = [ p for p in folded if len(p) == len(path) + 1 \
+                    and p[:len(path)] == path ]
+        for kid in sorted(kids, key=lambda p: folded[p][1], reverse=True):
+            count, seconds = folded[kid]
+            name = "  " * len(path) + kid[-1]
+            lines.append(f"{name:<40} {count:6d} {seconds:11.3f}s " \
+                         f"{100 * seconds / total:5.1f}%")
+            walk(kid)
+
+    walk(())
+    return "\n".join(lines)
+
+
+def main():
+    trace = None
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], "t:")
+    except getopt.GetoptError as err:
+        print(err)
+        print(__doc__)
+        sys.exit(1)
+    for opt, arg in opts:
+        if opt == "-t":
+            trace = arg
+    if not args:
+        print(__doc__)
+        sys.exit(1)
+    print(report(fold(read(args), trace)))
+
+
+if __name__ == "__main__":
+    main()
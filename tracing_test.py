@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+
+import unittest, tempfile, os
+import config, tracing
+
+class TestMethods(unittest.TestCase):
+
+    def setUp(self):
+        self.cfg = config.Config.instance()
+        self.cfg.reset()
+
+    def tearDown(self):
+        self.cfg.reset()
+        tracing.configure()
+
+
+    def test_disabled(self):
+        tracing.configure()
+        self.assertIs(tracing.span("nothing"), tracing.NULL_SPAN)
+        with tracing.span("nothing"):
+            self.assertIsNone(tracing.header())
+
+
+    def test_spans(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = f"{tmpdir}/trace.jsonl"
+            self.cfg.data = { "global": { "TRACE": filename } }
+            tracing.configure()
+            with tracing.span("crawl") as crawl:
+                for i in range(3):
+                    with tracing.span("send list"):
+                        request = [ "list", "server", "client" ]
+                        request.append(tracing.header())
+                        # the server's side
+                        request, parent = tracing.extract(request)
+                        self.assertEqual(request, [ "list", "server", "client" ])
+                        with tracing.span("handle list", parent=parent):
+                            pass
+            self.cfg.data = { "global": {} }
+            tracing.configure()     # closes the file
+
+            records = tracing.read([ filename ])
+            self.assertEqual(len(records), 7)
+            self.assertTrue(all(record['trace'] == crawl.trace \
+                                for record in records))
+            folded = tracing.fold(records)
+            self.assertEqual(folded[("crawl", )][0], 1)
+            self.assertEqual(folded[("crawl", "send list")][0], 3)
+            self.assertEqual(folded[("crawl", "send list", "handle list")][0], 3)
+            lines = tracing.report(folded).split("\n")
+            self.assertTrue(lines[0].startswith("crawl"))
+            self.assertTrue(lines[2].startswith("    handle list"))
+
+
+    def test_extract(self):
+        request = [ "claim", "server", "client", [ "a" ] ]
+        self.assertEqual(tracing.extract(request), (request, None))
+
+
+if __name__ == "__main__":
+    unittest.main()
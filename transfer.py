@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+
+"""
+usage:
+    scheduler = transfer.TransferScheduler.instance()
+    batch = scheduler.batch()
+    job = batch.add(source, dest, { filename: size, },
+                    host=src_host, listdir=..., name=..., prefix=...)
+    ... more batch.add()s, one per source
+    batch.wait()
+    job.results     # { filename: rsync exit code }
+    job.failed()    # [ filename, ] with a non-zero exit
+    job.metrics     # utils.RsyncMetrics: bytes, files, errors, retries
+    job.latency     # stats.Histogram: seconds per rsync (or fetch, copy)
+
+One TransferScheduler per process, shared by every Clientlet.  Each
+job's file list is split into size-balanced shards; each shard is one
+rsync --files-from, run on its own thread.  No more than "RSYNC WORKERS"
+rsyncs run at once on this host, and no more than "RSYNC WORKERS PER
+HOST" against any one source host.
+
+Every file gets its own exit code: 0 if rsync says it sent it or the
+shard succeeded.  When a shard ends in a partial transfer (23, 24) and
+rsync named the files that failed or vanished, only those get the code;
+otherwise every file it didn't send does.  A failed shard doesn't stop
+the others.
+
+Jobs added with local=True (source and backup on the same host) skip
+rsync: local_copy copies the files in-process on a pool of "LOCAL COPY
+WORKERS" threads, and every file gets its own exit code.
+
+Jobs added with servlet={ server, port, server_context, client_context }
+can skip rsync too, pulling over the Datagram port and holding the same
+slots an rsync would:
+    stream=True:    fetch every file, "RSYNC WORKERS PER HOST" connections
+    bundled=[ filename, ]: those files come as tar bundles on their own
+                    thread; the rest go by rsync (or stream)
+
+Bandwidth: a job's bwlimit (bytes/s, the source's grant) is split among
+its shards, and this host's "DOWNLOAD BANDWIDTH" profile among every
+running rsync; each rsync gets the smaller share as its --bwlimit, fixed
+when it starts.
+"""
+
+import heapq, logging, threading
+import config, utils, local_copy, fetch, bandwidth, stats
+from singleton import Singleton
+
+PARTIAL = (23, 24)      # rsync: some files failed, some files vanished
+
+
+# split { filename: weight } into nshards dicts of ~equal total weight
+# (greedy: heaviest file to the lightest shard)
+def shard(files, nshards):
+    nshards = max(1, min(nshards, len(files)))
+    shards = [ {} for i in range(nshards) ]
+    heap = [ (0, i) for i in range(nshards) ]
+    for filename in sorted(files, key=lambda f: files[f], reverse=True):
+        total, i = heapq.heappop(heap)
+        shards[i][filename] = files[filename]
+        heapq.heappush(heap, (total + files[filename], i))
+    return shards
+
+
+# one file's exit code, from its shard's
+def file_result(exitcode, filename, metrics):
+    if exitcode == 0 or filename in metrics.files:
+        return 0
+    if exitcode in PARTIAL and metrics.failures \
+            and not metrics.failed(filename):
+        return 0
+    return exitcode
+
+
+class Job:
+    def __init__(self, name, files):
+        self.name = name
+        self.files = files
+        self.results = {}       # { filename: exit code }
+        self.threads = []
+        self.metrics = utils.RsyncMetrics()     # summed over its shards
+        self.latency = stats.Histogram()        # one per shard run
+        self.bwlimit = 0        # bytes/s for all its rsyncs; 0 == unlimited
+        self.running = 0
+
+
+    def failed(self):
+        return [ filename for filename, exitcode in self.results.items() \
+                    if exitcode != 0 ]
+
+
+class Batch:
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
+        self.jobs = []
+
+
+    # start copying files = { filename: weight } from source to dest
+    def add(self, source, dest, files, host=None, listdir="/tmp",
+                name="transfer", prefix=None, local=False, servlet=None,
+                stream=False, bundled=(), bwlimit=0):
+        job = Job(name, files)
+        job.bwlimit = bwlimit
+        self.jobs.append(job)
+        if local:
+            thread = threading.Thread(target=self.scheduler.run_local,
+                                        args=(job, source, dest))
+            job.threads.append(thread)
+            thread.start()
+            return job
+        if servlet and bundled:
+            bundled = [ filename for filename in files if filename in bundled ]
+            thread = threading.Thread(target=self.scheduler.run_bundles,
+                                        args=(job, host, dest, servlet, bundled))
+            job.threads.append(thread)
+            thread.start()
+            files = { filename: weight for filename, weight in files.items() \
+                        if filename not in bundled }
+            if not files:
+                return job
+        if servlet and stream:
+            thread = threading.Thread(target=self.scheduler.run_stream,
+                                        args=(job, host, dest, servlet, files))
+            job.threads.append(thread)
+            thread.start()
+            return job
+        shards = shard(files, self.scheduler.workers_per_host)
+        for i, files_shard in enumerate(shards):
+            listname = f"{listdir}/{name}.rsync.{i}.txt"
+            if not self.scheduler.write_list(listname, files_shard):
+                continue
+            thread = threading.Thread(target=self.scheduler.run_shard,
+                            args=(job, host, source, dest, listname,
+                                    files_shard, prefix))
+            job.threads.append(thread)
+            thread.start()
+        return job
+
+
+    def wait(self):
+        for job in self.jobs:
+            for thread in job.threads:
+                thread.join()
+        return self.jobs
+
+
+@Singleton
+class TransferScheduler:
+    def __init__(self):
+        self.logger = logging.getLogger(utils.logger_str(__class__))
+        self.lock = threading.Lock()
+        self.rsync = utils.rsync
+        self.configure()
+
+
+    def configure(self):
+        cfg = config.Config.instance()
+        self.workers = int(cfg.get("global", "RSYNC WORKERS", 4))
+        self.workers_per_host = int(cfg.get("global",
+                                            "RSYNC WORKERS PER HOST", 2))
+        self.local_workers = int(cfg.get("global", "LOCAL COPY WORKERS", 4))
+        self.slots = threading.BoundedSemaphore(self.workers)
+        self.host_slots = {}    # { host: BoundedSemaphore }
+        self.running = 0        # rsyncs, for the download budget
+
+
+    def host_slot(self, host):
+        with self.lock:
+            if host not in self.host_slots:
+                self.host_slots[host] = \
+                    threading.BoundedSemaphore(self.workers_per_host)
+            return self.host_slots[host]
+
+
+    def batch(self):
+        return Batch(self)
+
+
+    # returns False if there's nothing to copy
+    def write_list(self, listname, files):
+        nfiles = 0
+        with open(listname, "w") as listfile:
+            for filename in files:
+                try:
+                    listfile.write(f"{filename}\n")
+                    nfiles += 1
+                except UnicodeEncodeError:
+                    self.logger.exception(f"JFYI, caught this while writing {filename}")
+                    self.logger.warn(f"Skipping this file, but plz fixit")
+        return nfiles > 0
+
+
+    def run_shard(self, job, host, source, dest, listname, files, prefix):
+        # always host, then global: nobody holds a global slot waiting
+        with self.host_slot(host), self.slots:
+            bwlimit = self.start(job)
+            options = (f"--files-from={listname}", )
+            metrics = utils.RsyncMetrics()      # this shard's
+            try:
+                with job.latency.timer():
+                    exitcode = self.rsync(source, dest, options, prefix=prefix,
+                                        metrics=metrics, bwlimit=bwlimit)
+            except Exception:
+                self.logger.exception(f"rsync {listname} blew up")
+                exitcode = -1
+            finally:
+                self.finish(job)
+                job.metrics.merge(metrics)
+        if exitcode != 0:
+            self.logger.warning(f"{listname}: rsync returned {exitcode} " \
+                                f"for {len(files)} files")
+        for filename in files:
+            job.results[filename] = file_result(exitcode, filename, metrics)
+
+
+    # count an rsync in; returns its fair share of bandwidth, bytes/s
+    def start(self, job):
+        cfg = config.Config.instance()
+        download = bandwidth.rate_now(cfg.get("global",
+                                                "DOWNLOAD BANDWIDTH", 0))
+        with self.lock:
+            self.running += 1
+            job.running += 1
+            shares = [ download // self.running if download else 0,
+                       job.bwlimit // job.running if job.bwlimit else 0 ]
+        shares = [ share for share in shares if share ]
+        return max(1, min(shares)) if shares else 0
+
+
+    def finish(self, job):
+        with self.lock:
+            self.running -= 1
+            job.running -= 1
+
+
+    # source & dest are local paths: copy in-process, file by file
+    def run_local(self, job, source, dest):
+        with job.latency.timer():
+            results = local_copy.copy_files(source.rstrip("/"),
+                                            dest.rstrip("/"), list(job.files),
+                                            workers=self.local_workers)
+        self.record(job, results, "local copies")
+
+
+    # pull over the Datagram port; servlet = { server, port,
+    #   server_context, client_context }
+    def run_stream(self, job, host, dest, servlet, files):
+        with self.host_slot(host), self.slots, job.latency.timer():
+            results = fetch.fetch_files(dest_dir=dest.rstrip("/"),
+                                        filenames=list(files),
+                                        workers=self.workers_per_host,
+                                        **servlet)
+        self.record(job, results, "fetches")
+
+
+    def run_bundles(self, job, host, dest, servlet, files):
+        with self.host_slot(host), self.slots, job.latency.timer():
+            results = fetch.fetch_bundles(dest_dir=dest.rstrip("/"),
+                                            filenames=files, **servlet)
+        self.record(job, results, "bundled files")
+
+
+    def record(self, job, results, what):
+        failed = [ filename for filename in results if results[filename] ]
+        if failed:
+            self.logger.warn(f"{job.name}: {len(failed)} of {len(results)} " \
+                             f"{what} failed")
+        job.results.update(results)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+
+import unittest, logging, tempfile, threading, time, os
+import config, transfer
+
+class TestMethods(unittest.TestCase):
+
+    def setUp(self):
+        logging.basicConfig(format='%(asctime)s [%(name)s] %(message)s',
+                            level=logging.ERROR)
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.scheduler = transfer.TransferScheduler.instance()
+        self.scheduler.workers = 3
+        self.scheduler.workers_per_host = 2
+        self.scheduler.slots = threading.BoundedSemaphore(3)
+        self.scheduler.host_slots = {}
+        self.scheduler.running = 0
+        self.running = {}
+        self.peak = {}
+        self.bwlimits = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.scheduler.rsync = transfer.utils.rsync
+        self.tmpdir.cleanup()
+
+
+    # stands in for utils.rsync: counts concurrency per source
+    def fake_rsync(self, source, dest, options, prefix=None, metrics=None,
+                    bwlimit=0):
+        with self.lock:
+            self.bwlimits.append(bwlimit)
+            self.running[source] = self.running.get(source, 0) + 1
+            self.running['all'] = self.running.get('all', 0) + 1
+            for key in source, 'all':
+                self.peak[key] = max(self.peak.get(key, 0), self.running[key])
+        time.sleep(0.05)
+        with self.lock:
+            self.running[source] -= 1
+            self.running['all'] -= 1
+        listname = options[0].split("=", 1)[1]
+        with open(listname) as listfile:
+            lines = listfile.readlines()
+        if "bad\n" in lines:
+            return 23
+        if "gone\n" in lines:
+            metrics.parse(f'file has vanished: "{source}/gone"')
+            return 24
+        return 0
+
+
+    def test_shard(self):
+        files = { 'a': 100, 'b': 60, 'c': 50, 'd': 40, 'e': 10 }
+        shards = transfer.shard(files, 2)
+        self.assertEqual(len(shards), 2)
+        self.assertEqual(sorted(sum(s.values()) for s in shards), [ 120, 140 ])
+        self.assertEqual(len(transfer.shard(files, 10)), 5)
+        self.assertEqual(transfer.shard({}, 3), [ {} ])
+
+
+    def test_batch(self):
+        self.scheduler.rsync = self.fake_rsync
+        batch = self.scheduler.batch()
+        jobs = []
+        for host in "one", "two", "three":
+            files = { f"{host}-{i}": i for i in range(10) }
+            if host == "two":
+                files["bad"] = 5
+            jobs.append(batch.add(f"{host}:/src", "/dest", files, host=host,
+                                    listdir=self.tmpdir.name, name=host))
+        batch.wait()
+        self.assertEqual(self.peak['all'], 3)
+        for host in "one", "two", "three":
+            self.assertLessEqual(self.peak[f"{host}:/src"], 2)
+        self.assertEqual(jobs[0].failed(), [])
+        self.assertEqual(len(jobs[0].results), 10)
+        # one bad shard doesn't sink the rest of the batch
+        self.assertIn("bad", jobs[1].failed())
+        self.assertLess(len(jobs[1].failed()), len(jobs[1].results))
+
+
+    # rsync named the one file that vanished: only it failed
+    def test_partial(self):
+        self.scheduler.rsync = self.fake_rsync
+        batch = self.scheduler.batch()
+        files = { f"file-{i}": i for i in range(10) }
+        files["gone"] = 5
+        job = batch.add("one:/src", "/dest", files, host="one",
+                        listdir=self.tmpdir.name, name="one")
+        batch.wait()
+        self.assertEqual(job.failed(), [ "gone" ])
+        self.assertEqual(job.results["gone"], 24)
+        self.assertEqual(len(job.results), 11)
+        self.assertEqual(job.metrics.errors, 1)
+
+
+    def test_bwlimit(self):
+        self.scheduler.rsync = self.fake_rsync
+        batch = self.scheduler.batch()
+        files = { f"file-{i}": i for i in range(10) }
+        batch.add("one:/src", "/dest", files, host="one",
+                    listdir=self.tmpdir.name, name="one", bwlimit=4*2**20)
+        batch.wait()
+        self.assertEqual(len(self.bwlimits), 2)
+        self.assertIn(2*2**20, self.bwlimits)     # split between shards
+        self.assertEqual(self.scheduler.running, 0)
+
+
+    def test_local_batch(self):
+        self.scheduler.rsync = self.fake_rsync
+        source = f"{self.tmpdir.name}/src"
+        os.makedirs(source)
+        for i in range(5):
+            with open(f"{source}/{i}", "w") as f:
+                f.write(str(i) * i)
+        files = { str(i): i for i in range(5) }
+        files["missing"] = 1
+        batch = self.scheduler.batch()
+        job = batch.add(f"{source}/", f"{self.tmpdir.name}/dest/", files,
+                            host="localhost", name="local", local=True)
+        batch.wait()
+        self.assertEqual(self.peak, {})     # no rsync at all
+        self.assertEqual(job.failed(), [ "missing" ])
+        with open(f"{self.tmpdir.name}/dest/3") as f:
+            self.assertEqual(f.read(), "333")
+
+
+
+if __name__ == "__main__":
+    suite = unittest.TestLoader().loadTestsFromTestCase(TestMethods)
+    unittest.TextTestRunner(verbosity=2).run(suite)
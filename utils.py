@@ -1,6 +1,6 @@
 #!/usr/bin/env python3
 
-import hashlib, config, re, logging
+import hashlib, config, re, logging, os, sys, threading, time
 
 
 # <class '__main__.GhettoCluster'> -> GhettoCluster
@@ -56,13 +56,13 @@ def str_to_bytes(data):
         return 0
     nr = float(data[:i])
     if len(data) > i:
-        if data[i] is "k":
+        if data[i] == "k":
             return int(nr * 2**10)
-        if data[i] is "m":
+        if data[i] == "m":
             return int(nr * 2**20)
-        if data[i] is "g":
+        if data[i] == "g":
             return int(nr * 2**30)
-        if data[i] is "t":
+        if data[i] == "t":
             return int(nr * 2**40)
         # FALLTHROUGH
     return int(nr)
@@ -97,7 +97,7 @@ def str_to_duration(string):
     nr = 0
     total = 0
     string = str(string).lower()
-    while string is not "":
+    while string != "":
         if string[0].isdigit():
             nr = nr*10 + int(string[0])
         elif string[0] == "d":
@@ -141,6 +141,140 @@ def looks_remote(string):
 
 
 
+# ssh options that share one multiplexed connection per remote host:
+#   the first rsync to a host opens a ControlMaster, later ones ride it
+#   and skip the handshake.  The master lingers "SSH PERSIST" after the
+#   last use; "SSH PERSIST: 0" turns this off.
+def ssh_transport(cfg):
+    persist = cfg.get_duration("global", "SSH PERSIST", "10m")
+    if not persist:
+        return []
+    control_dir = cfg.get("global", "SSH CONTROL DIR",
+                            f"/tmp/cb.ssh-{os.getuid()}")
+    os.makedirs(control_dir, mode=0o700, exist_ok=True)
+    ssh = f"ssh -o ControlMaster=auto -o ControlPath={control_dir}/%C " \
+            f"-o ControlPersist={persist}"
+    return [ "-e", ssh ]
+
+
+# one line per file rsync transfers: op, length, bytes sent, name
+RSYNC_OUT_FORMAT = "CB|%o|%l|%b|%n"
+
+
+# what one or more rsyncs did, parsed from their output; shared by
+#   parallel rsyncs, hence the lock
+class RsyncMetrics:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = {}     # { filename: bytes sent }
+        self.size = 0       # total length of the files transferred
+        self.bytes = 0      # bytes actually sent (deltas, not files)
+        self.errors = 0
+        self.retries = 0
+        self.elapsed = 0    # summed rsync wall time
+        self.failures = []  # paths named in errors, eg vanished files
+
+
+    # returns what the line was: "file", "retry", "error" or None
+    def parse(self, line):
+        if line.startswith("CB|"):
+            fields = line.split("|", 4)
+            if len(fields) == 5 and fields[2].isdigit() \
+                    and fields[3].isdigit():
+                op, length, sent, filename = fields[1:]
+                if not filename.endswith("/"):      # directories
+                    with self.lock:
+                        self.files[filename] = int(sent)
+                        self.size += int(length)
+                        self.bytes += int(sent)
+                return "file"
+        if "(will try again)" in line:
+            with self.lock:
+                self.retries += 1
+            return "retry"
+        if line.startswith("rsync:") or line.startswith("rsync error:") \
+                or line.startswith("file has vanished:"):
+            with self.lock:
+                self.errors += 1
+                self.failures += re.findall(r'"([^"]+)"', line)
+            return "error"
+        return None
+
+
+    # did an error name this file (a path relative to the source)?
+    def failed(self, filename):
+        return any(path == filename or path.endswith(f"/{filename}") \
+                    for path in self.failures)
+
+
+    # add another run's numbers to these
+    def merge(self, other):
+        with self.lock, other.lock:
+            self.files.update(other.files)
+            self.size += other.size
+            self.bytes += other.bytes
+            self.errors += other.errors
+            self.retries += other.retries
+            self.elapsed += other.elapsed
+            self.failures += other.failures
+
+
+    # bytes/s per rsync; compare with "RSYNC BWLIMIT" (KB/s)
+    def rate(self):
+        return self.bytes / max(self.elapsed, 0.001)
+
+
+    # into a stats.Stats
+    def record(self, stats):
+        stats['rsync files'].incr(len(self.files))
+        stats['rsync size'].incr(self.size)
+        stats['rsync bytes'].incr(self.bytes)
+        stats['rsync errors'].incr(self.errors)
+        stats['rsync retries'].incr(self.retries)
+
+
+# run an rsync command, feeding its output to metrics; only errors
+#   & retries are logged, unless verbose.  returns the exit code
+def run_rsync(command, logger, metrics=None, verbose=False):
+    # https://stackoverflow.com/questions/21953835/run-subprocess-and-print-output-to-logging#comment33261012_21953835
+    from subprocess import Popen, PIPE, STDOUT
+
+    if metrics is None:
+        metrics = RsyncMetrics()
+    command = [ s.encode() for s in command ]
+    start = time.time()
+    process = Popen(command, stdout=PIPE, stderr=STDOUT)
+    try:
+        with process.stdout:
+            for line in process.stdout:
+                line = line.decode(errors="replace").rstrip()
+                kind = metrics.parse(line)
+                if kind in ("error", "retry"):
+                    logger.warning("> %s", line)
+                elif verbose and kind is None:
+                    logger.debug("> %s", line)
+            exitcode = process.wait()
+        with metrics.lock:
+            metrics.elapsed += time.time() - start
+        return exitcode
+    except KeyboardInterrupt:
+        process.terminate()
+        raise
+    except Exception:
+        # this runs on worker threads: report a failed run, don't exit
+        process.terminate()
+        logger.exception("rsync run failed")
+        return -1
+
+
+# rsync's --bwlimit is KB/s unless it has a suffix
+def bwlimit_kb(string):
+    string = str(string)
+    if string.isdigit():
+        return int(string)
+    return max(1, str_to_bytes(string) // 1024)
+
+
 # returns a Unix exit code: 0 == good, !0 == bad
 # TODO: move options into kwargs
 def rsync(source, dest, options = [], verbose=False, dryrun=False, **kwargs):
@@ -160,47 +294,31 @@ def rsync(source, dest, options = [], verbose=False, dryrun=False, **kwargs):
     RSYNC_TIMEOUT = str(cfg.get("global", "RSYNC TIMEOUT", 180))
     RSYNC_BWLIMIT = str(cfg.get("global", "RSYNC BWLIMIT", 0))
     command = [ RSYNC, "-a", "--inplace", "--partial", \
-                "--timeout", RSYNC_TIMEOUT, source, dest ]
+                "--timeout", RSYNC_TIMEOUT, \
+                f"--out-format={RSYNC_OUT_FORMAT}", source, dest ]
     if len(options) > 0:
         command += options
     # if len(ignorals) > 0:
     #     command += [ f"--exclude={item}" for item in ignorals ] 
     if verbose:
         command += ["-v", "--progress"]
+    if kwargs.get("bwlimit"):   # bytes/s, from the bandwidth budgets
+        bwlimit = max(1, kwargs["bwlimit"] // 1024)
+        if RSYNC_BWLIMIT != "0":
+            bwlimit = min(bwlimit, bwlimit_kb(RSYNC_BWLIMIT))
+        RSYNC_BWLIMIT = str(bwlimit)
     if RSYNC_BWLIMIT != "0":
         command += ["--bwlimit", RSYNC_BWLIMIT]
+    if looks_remote(source) or looks_remote(dest):
+        command += ssh_transport(cfg)
     logger = logging.getLogger(logger_str)
-    logger.setLevel(logging.DEBUG)
     # logger.debug(command)
     logger.debug(f"executing: {' '.join(command)}")
     if dryrun:
         logger.info("> " + " ".join(command))
         return 0
     else:
-        # https://stackoverflow.com/questions/21953835/run-subprocess-and-print-output-to-logging#comment33261012_21953835
-        from subprocess import Popen, PIPE, STDOUT
-
-        # if "stfu" in kwargs and kwargs["stfu"]:
-        #     loghole = logger.debug
-        # else:
-        #     loghole = logger.info
-        loghole = logger.debug
-
-        command = [ s.encode() for s in command ]
-
-        process = Popen(command, stdout=PIPE, stderr=STDOUT)
-        try:
-            with process.stdout:
-                for line in iter(process.stdout.readline, b''):
-                    # b'\n'-separated lines
-                    loghole("> %s", line.decode().strip())
-                exitcode = process.wait()
-            return exitcode
-        except BaseException:
-            process.terminate()
-            logger.exception("Caught ...something")
-            sys.exit()
-        return None
+        return run_rsync(command, logger, kwargs.get("metrics"), verbose)
 
 
 if __name__ == "__main__":
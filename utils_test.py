@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
-import unittest, utils
+import unittest, tempfile, logging
+import config, utils
 
 class TestMethods(unittest.TestCase):
 
@@ -33,6 +34,51 @@ class TestMethods(unittest.TestCase):
         self.assertEquals(utils.duration_to_str(3*60*60+11),"3h11s")
         self.assertEquals(utils.duration_to_str(8*60+3*60*60*24+11),"3d8m11s")
 
+    def test_ssh_transport(self):
+        cfg = config.Config.instance()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cfg.data = { "global": { "SSH CONTROL DIR": f"{tmpdir}/ssh" } }
+            option, ssh = utils.ssh_transport(cfg)
+            self.assertEqual(option, "-e")
+            self.assertIn(f"ControlPath={tmpdir}/ssh/%C", ssh)
+            self.assertIn("ControlPersist=600", ssh)
+            cfg.data = { "global": { "SSH PERSIST": "0" } }
+            self.assertEqual(utils.ssh_transport(cfg), [])
+        cfg.reset()
+
+
+    def test_rsync_metrics(self):
+        metrics = utils.RsyncMetrics()
+        self.assertEqual(metrics.parse("CB|recv|100|40|a/file"), "file")
+        self.assertEqual(metrics.parse("CB|recv|4096|0|a/"), "file")
+        self.assertEqual(metrics.parse("CB|recv|7|7|b|c"), "file")
+        self.assertEqual(metrics.parse("rsync: open failed"), "error")
+        self.assertIsNone(metrics.parse("sending incremental file list"))
+        self.assertEqual(metrics.files, { "a/file": 40, "b|c": 7 })
+        self.assertEqual((metrics.size, metrics.bytes), (107, 47))
+        self.assertEqual(metrics.errors, 1)
+        metrics.parse('file has vanished: "/src/a/gone"')
+        self.assertTrue(metrics.failed("a/gone"))
+        self.assertFalse(metrics.failed("gone/a"))
+
+        # any command will do
+        command = [ "sh", "-c", "echo 'CB|recv|10|10|x'; " \
+                    "echo 'x failed verification (will try again)'; exit 23" ]
+        logger = logging.getLogger("rsync")
+        self.assertEqual(utils.run_rsync(command, logger, metrics), 23)
+        self.assertEqual(metrics.files["x"], 10)
+        self.assertEqual(metrics.retries, 1)
+        self.assertGreater(metrics.elapsed, 0)
+
+        # a failure while reading fails the run; it doesn't exit
+        class Broken(utils.RsyncMetrics):
+            def parse(self, line):
+                raise ValueError(line)
+        logger.disabled = True
+        self.assertEqual(utils.run_rsync(command, logger, Broken()), -1)
+        logger.disabled = False
+
+
 if __name__ == "__main__":
     suite = unittest.TestLoader().loadTestsFromTestCase(TestMethods)
     unittest.TextTestRunner(verbosity=2).run(suite)